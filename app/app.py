@@ -8,7 +8,15 @@ import subprocess
 import time
 
 from client_dfple import *
-from flask import Flask, request, send_from_directory
+from dns_propagation import parse_nameservers
+from flask import Flask, Response, abort, jsonify, request
+from jobs import JobQueue
+from metrics import CHALLENGE_REQUESTS, StateCollector
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, generate_latest
+from ratelimit import RateLimiter
+from reconciler import ServiceReconciler
+from retry import RetryScheduler
+from scheduler import RenewalScheduler
 
 
 LEVELS = {'debug': logging.DEBUG,
@@ -31,32 +39,120 @@ if docker_socket_path and os.path.exists(docker_socket_path):
         base_url='unix:/{}'.format(docker_socket_path),
         version='1.25')
 
+# a single docker-flow-proxy client, connections are reused across requests.
+dfp_client = DockerFlowProxyAPIClient(
+    timeout=float(os.environ.get('DF_PROXY_TIMEOUT', 10)),
+    pool_size=int(os.environ.get('DF_PROXY_CONCURRENCY', 10)),
+    concurrency=int(os.environ.get('DF_PROXY_CONCURRENCY', 10)),
+    fanout=os.environ.get('DF_PROXY_FANOUT', 'false').lower() == 'true')
+
+# forwards and certificates PUT to docker-flow-proxy that failed are retried
+# in background, with an exponential backoff starting at RETRY_INTERVAL seconds.
+retries = RetryScheduler(
+    retries=int(os.environ.get('RETRY', 10)) - 1,
+    interval=float(os.environ.get('RETRY_INTERVAL', 5)),
+    max_interval=float(os.environ.get('RETRY_MAX_INTERVAL', 300)),
+    executor=dfp_client.map)
+retries.start()
+
 args = {
+    'certbot_bin': os.environ.get('CERTBOT_BIN', 'certbot'),
     'certbot_path': os.environ.get('CERTBOT_PATH', '/etc/letsencrypt'),
+    'certbot_engine': os.environ.get('CERTBOT_ENGINE', 'certbot'),
     'certbot_challenge': os.environ.get('CERTBOT_CHALLENGE', 'http'),
     'certbot_webroot_path': CERTBOT_WEBROOT_PATH,
     'certbot_options': os.environ.get('CERTBOT_OPTIONS', ''),
     'certbot_manual_auth_hook': os.environ.get('CERTBOT_MANUAL_AUTH_HOOK'),
     'certbot_manual_cleanup_hook': os.environ.get('CERTBOT_MANUAL_CLEANUP_HOOK'),
+    'certbot_renew_before': int(os.environ.get('CERTBOT_RENEW_BEFORE', 30)),
+    'acme_directory_url': os.environ.get('ACME_DIRECTORY_URL'),
+    'acme_staging_directory_url': os.environ.get('ACME_STAGING_DIRECTORY_URL'),
+    'dns_provider': os.environ.get('DNS_PROVIDER'),
+    'dns_challenge_state': os.environ.get('DNS_CHALLENGE_STATE'),
+    'dns_propagation_timeout': int(os.environ.get('DNS_PROPAGATION_TIMEOUT', 300)),
+    'dns_propagation_nameservers': parse_nameservers(os.environ.get('DNS_PROPAGATION_NAMESERVERS')),
     'docker_client': docker_client,
     'docker_socket_path': docker_socket_path,
     'dfp_service_name': os.environ.get('DF_PROXY_SERVICE_NAME'),
+    'dfp_client': dfp_client,
+    'retries': retries,
+    'dfp_update_debounce': float(os.environ.get('DF_PROXY_UPDATE_DEBOUNCE', 5)),
+    'issue_concurrency': int(os.environ.get('ISSUE_CONCURRENCY', 1)),
+    'failed_requests_max_age': int(os.environ.get('FAILED_REQUESTS_MAX_AGE', 7 * 86400)),
+    'secrets_gc': os.environ.get('SECRETS_GC', 'false').lower() == 'true',
+    'secrets_gc_keep': int(os.environ.get('SECRETS_GC_KEEP', 2)),
+    'secrets_gc_dry_run': os.environ.get('SECRETS_GC_DRY_RUN', 'false').lower() == 'true',
+    'secrets_gc_batch_size': int(os.environ.get('SECRETS_GC_BATCH_SIZE', 50)),
+    'secrets_gc_interval': int(os.environ.get('SECRETS_GC_INTERVAL', 86400)),
+    'rate_limiter': RateLimiter(
+        orders=int(os.environ.get('RATE_LIMIT_ORDERS', 300)),
+        certs_per_domain=int(os.environ.get('RATE_LIMIT_CERTS_PER_DOMAIN', 50)),
+        failed_validations=int(os.environ.get('RATE_LIMIT_FAILED_VALIDATIONS', 5)),
+        max_wait=int(os.environ.get('RATE_LIMIT_MAX_WAIT', 60))),
 }
 
 client = DFPLEClient(**args)
 
+# certificates are generated by background workers, the reconfigure request
+# never waits for certbot to complete.
+# identical requests (same domains, email and testing flag) received while a
+# job is pending or shortly after it succeeded share that job.
+jobs = JobQueue(
+    workers=int(os.environ.get('JOB_WORKERS', args['issue_concurrency'])),
+    coalesce_ttl=int(os.environ.get('JOB_COALESCE_TTL', 60)))
+jobs.start()
+
+# each certificate is renewed at its own time, once 2/3 of its lifetime
+# elapsed, instead of every due certificate at LETSENCRYPT_RENEWAL_CRON.
+renewals = None
+if os.environ.get('RENEWAL_SCHEDULER', 'true').lower() == 'true':
+    renewals = RenewalScheduler(client.cert_index,
+        lambda names: jobs.submit(client.renew, kwargs={'names': names},
+            description='renew {}'.format(','.join(names)), key='renew:{}'.format(','.join(names))),
+        ratio=float(os.environ.get('RENEWAL_RATIO', 2 / 3.0)),
+        jitter=float(os.environ.get('RENEWAL_JITTER', 0.05)),
+        concurrency=int(os.environ.get('RENEWAL_CONCURRENCY', 1)),
+        interval=int(os.environ.get('RENEWAL_INTERVAL', 3600)),
+        retry_interval=int(os.environ.get('RENEWAL_RETRY_INTERVAL', 3600)),
+        retry_failed=lambda: jobs.submit(client.retry_failed, description='retry failed requests', key='retry-failed'),
+        lineages=client.requested_lineages)
+    renewals.start()
+
+# certificates requested by service labels are issued from docker service
+# events, without waiting for swarm-listener notifications.
+if os.environ.get('SERVICE_EVENTS', 'false').lower() == 'true' and client.docker_cache is not None:
+    reconciler = ServiceReconciler(client,
+        lambda requests: jobs.submit(client.process_many, args=(requests,),
+            description='services reconcile: {}'.format(' '.join(','.join(x[0]) for x in requests)),
+            key=('reconcile',) + tuple(sorted((request_key(*x) for x in requests), key=repr))),
+        debounce=float(os.environ.get('SERVICE_EVENTS_DEBOUNCE', 5)))
+    client.docker_cache.listeners.append(reconciler.handle)
+
+# docker events are watched from here, listeners are registered.
+client.start()
+
+REGISTRY.register(StateCollector(client, jobs, retries))
+
 app = Flask(__name__)
 
 @app.route("/.well-known/acme-challenge/<path>")
 def acme_challenge(path):
-    return send_from_directory(CERTBOT_WEBROOT_PATH,
-        ".well-known/acme-challenge/{}".format(path))
+    # answered from memory, a miss costs a single stat of the challenge folder.
+    validation = client.certbot.tokens.get(path)
+    CHALLENGE_REQUESTS.labels('miss' if validation is None else 'hit').inc()
+    if validation is None:
+        abort(404)
+    return Response(validation, mimetype='text/plain')
+
+@app.route("/metrics")
+def metrics():
+    return Response(generate_latest(REGISTRY), mimetype=CONTENT_TYPE_LATEST)
 
 @app.route("/v<int:version>/docker-flow-proxy-letsencrypt/reconfigure")
 def reconfigure(version):
 
-    dfp_client = DockerFlowProxyAPIClient()
     args = request.args
+    job = None
 
     if version != 1:
         logger.error('Unable to use version : {}. Forwarding initial request to docker-flow-proxy service.'.format(version))
@@ -78,27 +174,86 @@ def reconfigure(version):
                 if isinstance(testing, basestring):
                     testing = True if testing.lower() == 'true' else False
 
-            client.process(args['letsencrypt.host'].split(','), args['letsencrypt.email'], testing=testing)
+            domains = args['letsencrypt.host'].split(',')
+            job = jobs.submit(client.process,
+                args=(domains, args['letsencrypt.email']),
+                kwargs={'testing': testing},
+                description='service={} domains={}'.format(args.get('serviceName'), args['letsencrypt.host']),
+                key=request_key(domains, args['letsencrypt.email'], testing))
+            logger.info('certificates generation handled by job {}'.format(job.id))
 
     # proxy requests to docker-flow-proxy
     # sometimes we can get an error back from DFP, this can happen when DFP is not fully loaded.
-    # resend the request until response status code is 200 (${RETRY} times waiting ${RETRY_INTERVAL} seconds between retries)
-    t = 0
-    while t < os.environ.get('RETRY', 10):
-        t += 1
-
-        logger.debug('forwarding request to docker-flow-proxy ({})'.format(t))
+    # failed requests are retried in background, the response does not wait for them.
+    def forward(url):
         try:
-            response = dfp_client.get(dfp_client.url(version, '/reconfigure?{}'.format(
-                '&'.join(['{}={}'.format(k, v) for k, v in request.args.items()]))))
-            if response.status_code == 200:
-                break
+            return dfp_client.get(url).status_code == 200
         except Exception, e:
             logger.error('Error while trying to forward request: {}'.format(e))
-        logger.debug('waiting for retry')
-        time.sleep(os.environ.get('RETRY_INTERVAL', 5))
+            return False
+
+    urls = dfp_client.urls(version, '/reconfigure?{}'.format(
+        '&'.join(['{}={}'.format(k, v) for k, v in request.args.items()])))
+    logger.debug('forwarding request to docker-flow-proxy')
+    # replicas are called concurrently, only failed ones are retried.
+    for url, ok in zip(urls, dfp_client.map(forward, urls)):
+        if not ok:
+            retries.schedule(forward, args=(url,), description='forward {}'.format(url))
+
+    return jsonify(status='OK', job=job.id if job else None)
+
+@app.route("/v<int:version>/docker-flow-proxy-letsencrypt/renew")
+def renew(version):
+    # renew every certificate due for renewal in a single certbot run.
+    job = jobs.submit(client.renew, kwargs={'version': version}, description='renew', key='renew')
+    logger.info('certificates renewal handled by job {}'.format(job.id))
+    return jsonify(status='OK', job=job.id)
+
+@app.route("/v<int:version>/docker-flow-proxy-letsencrypt/renewals")
+def renewals_status(version):
+    if renewals is None:
+        abort(404)
+    return jsonify(renewals.stats())
+
+@app.route("/v<int:version>/docker-flow-proxy-letsencrypt/dns/<action>", methods=['POST'])
+def dns_hook(version, action):
+    # called by certbot manual hooks (hooks/dns), from the container only.
+    if request.remote_addr not in ('127.0.0.1', '::1') or client.certbot.dns is None:
+        abort(404)
+    form = request.form
+    if action == 'auth':
+        visible = client.certbot.dns.auth(form['domain'], form['validation'],
+            int(form.get('remaining') or 0), form.get('all_domains'))
+        return jsonify(status='OK', visible=visible)
+    if action == 'cleanup':
+        deleted = client.certbot.dns.cleanup(form['domain'], form['validation'], form.get('all_domains'))
+        return jsonify(status='OK', deleted=deleted)
+    abort(404)
+
+@app.route("/v<int:version>/docker-flow-proxy-letsencrypt/retries")
+def retries_status(version):
+    return jsonify(retries.stats())
+
+@app.route("/v<int:version>/docker-flow-proxy-letsencrypt/jobs/<job_id>")
+def job_status(version, job_id):
+    job = jobs.get(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job.to_dict())
 
-    return "OK"
+def shutdown(timeout=None):
+    """
+        Complete background work before the process exits.
+    """
+    if renewals is not None:
+        renewals.stop()
+    logger.info('shutting down, waiting for {} pending jobs.'.format(jobs.size()))
+    if not jobs.stop(timeout):
+        logger.warning('jobs still running after {}s, exiting anyway.'.format(timeout))
+    # apply pending secrets changes now instead of waiting for the debounce delay.
+    client.attachments.flush()
+    retries.stop()
 
 if __name__ == "__main__":
-    app.run(host='0.0.0.0', port=8080, debug=True, threaded=True)
\ No newline at end of file
+    # development server, the docker image runs gunicorn (see gunicorn_conf.py).
+    app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 8080)), debug=os.environ.get('DEBUG', 'false').lower() == 'true', threaded=True, use_reloader=False)
\ No newline at end of file
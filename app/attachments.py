@@ -0,0 +1,212 @@
+import collections
+import threading
+import time
+
+import logging
+logger = logging.getLogger('letsencrypt')
+
+
+class ServiceUpdateError(Exception):
+    def __init__(self, message, status_code=None, explanation=None):
+        Exception.__init__(self, message)
+        self.status_code = status_code
+        self.explanation = explanation or ''
+        # the service version used for the update is not the current one.
+        self.conflict = status_code == 409 or 'out of sequence' in self.explanation
+
+
+def secret_file_name(domain):
+    return 'cert-{}'.format(domain)
+
+
+class SecretAttachmentReconciler():
+    """
+        Collect the certificate secrets to attach to the DFP service and apply
+        them with a single service update.
+
+        Changes are applied `debounce` seconds after the first pending change,
+        or immediately if debounce is 0. Every service update restarts the
+        proxy tasks, batching changes avoids rolling the proxy again and again.
+
+        Changes that could not be applied are kept pending and applied again
+        after `retry_delay` seconds, doubled on each failure up to
+        `retry_max_delay`. Updates refused by the docker engine for another
+        reason than a version conflict fail the same way when retried: the
+        changes are dropped after `give_up_after` such failures in a row, and
+        counted in `stats()`.
+    """
+
+    def __init__(self, client, debounce=0, retries=5, retry_delay=30, retry_max_delay=600, give_up_after=5):
+        # DFPLEClient providing access to the dfp service.
+        self.client = client
+        self.debounce = debounce
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.retry_max_delay = retry_max_delay
+        self.give_up_after = give_up_after
+        # functions called once the service has been updated, with the
+        # secrets of the service in `applied`.
+        self.listeners = []
+        self.applied = None
+
+        # secret reference by secret file name.
+        self.pending = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._timer = None
+        # consecutive failed flushes, and consecutive updates refused by the engine.
+        self._failures = 0
+        self._refused = 0
+
+        self.updated = 0
+        self.failed = 0
+        self.given_up = 0
+
+    def attach(self, domain, secret):
+        with self._lock:
+            self.pending[secret_file_name(domain)] = {
+                'SecretID': secret.id,
+                'SecretName': secret.name,
+                'File': {
+                    'Name': secret_file_name(domain),
+                    'UID': '0',
+                    'GID': '0',
+                    'Mode': 0}
+                }
+
+    @staticmethod
+    def key(secret):
+        return (secret['File']['Name'], secret.get('SecretID'), secret.get('SecretName'))
+
+    def apply(self, secrets, changes=None):
+        """
+            Return the secrets list once pending changes are applied.
+        """
+        if changes is None:
+            with self._lock:
+                changes = dict(self.pending)
+        secrets = [x for x in secrets if x['File']['Name'] not in changes]
+        secrets.extend(changes.values())
+        return secrets
+
+    def commit(self):
+        """
+            Schedule pending changes to be applied.
+        """
+        if self.debounce <= 0 and not self._failures:
+            self.flush()
+            return
+        with self._lock:
+            if self.pending:
+                self._schedule(self.debounce)
+
+    def _schedule(self, delay):
+        # self._lock must be held.
+        if self._timer is None:
+            logger.debug('dfp service update scheduled in {}s'.format(delay))
+            self._timer = threading.Timer(delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def flush(self):
+        """
+            Apply pending changes to the dfp service.
+
+            :return: True if the service has been updated
+        """
+        with self._flush_lock:
+            with self._lock:
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+                changes = self.pending
+                self.pending = collections.OrderedDict()
+            if not changes:
+                return False
+
+            refused = False
+            try:
+                updated = self._update(changes)
+            except ServiceUpdateError as e:
+                logger.error('dfp service update failed ({}): {}'.format(e.status_code, e))
+                updated = None
+                refused = True
+            except Exception as e:
+                logger.error('dfp service update failed: {}'.format(e))
+                updated = None
+
+            if updated is None:
+                self._retry(changes, refused)
+                return False
+            with self._lock:
+                self._failures = 0
+                self._refused = 0
+                if updated:
+                    self.updated += 1
+            if updated:
+                for listener in self.listeners:
+                    try:
+                        listener()
+                    except Exception as e:
+                        logger.error('dfp service update listener failed: {}'.format(e))
+            return updated
+
+    def _update(self, changes):
+        """
+            :return: True if the service has been updated, False if it was
+                already up to date, None if it kept conflicting.
+            :raises ServiceUpdateError: if the engine refused the update
+        """
+        for attempt in range(1, self.retries + 1):
+            # always start from the latest service version, the update fails
+            # if the service has been updated in between.
+            service = self.client.services(self.client.dfp_service_name)[0]
+            current = self.client.service_get_secrets(service)
+            secrets = self.apply(current, changes)
+            if set(self.key(x) for x in secrets) == set(self.key(x) for x in current):
+                logger.debug('dfp service secrets already up to date.')
+                return False
+
+            logger.info('updating dfp service secrets: {}'.format(', '.join(changes.keys())))
+            try:
+                self.client.service_update_secrets(service, secrets)
+            except ServiceUpdateError as e:
+                if not e.conflict:
+                    raise
+                logger.warning('dfp service updated in between, retrying (attempt {}/{})'.format(attempt, self.retries))
+                if attempt < self.retries:
+                    time.sleep(min(2 ** attempt * 0.1, 5))
+                continue
+
+            self.applied = secrets
+            return True
+        return None
+
+    def _retry(self, changes, refused=False):
+        with self._lock:
+            self.failed += 1
+            self._refused = self._refused + 1 if refused else 0
+            if self._refused >= self.give_up_after:
+                logger.error('dfp service update refused {} times, giving up: {}'.format(
+                    self._refused, ', '.join(changes.keys())))
+                self.given_up += len(changes)
+                self._failures = 0
+                self._refused = 0
+                return
+            # changes made since have precedence over the failed ones.
+            for name, secret in changes.items():
+                self.pending.setdefault(name, secret)
+            delay = min(self.retry_delay * 2 ** self._failures, self.retry_max_delay)
+            self._failures += 1
+            logger.error('unable to update dfp service secrets, retrying in {}s.'.format(delay))
+            self._schedule(delay)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'pending': len(self.pending),
+                'failures': self._failures,
+                'updated': self.updated,
+                'failed': self.failed,
+                'given_up': self.given_up,
+            }
@@ -0,0 +1,173 @@
+import time
+from mock import MagicMock
+from unittest import TestCase
+
+from attachments import SecretAttachmentReconciler, ServiceUpdateError
+
+
+class Secret():
+
+	def __init__(self, id, name):
+		self.id = id
+		self.name = name
+
+
+class Service():
+
+	def __init__(self, secrets, version):
+		self.attrs = {
+			'Version': {'Index': version},
+			'Spec': {'TaskTemplate': {'ContainerSpec': {'Secrets': secrets}}}}
+
+
+class FakeClient():
+	"""
+	Stands for DFPLEClient, the dfp service is updated in memory.
+	"""
+
+	dfp_service_name = 'proxy'
+
+	def __init__(self, conflicts=0, errors=0, missing=0):
+		self.secrets = []
+		self.missing = missing
+		self.version = 1
+		self.updates = 0
+		self.attempts = 0
+		self.conflicts = conflicts
+		self.errors = errors
+
+	def services(self, name):
+		if self.missing:
+			self.missing -= 1
+			return []
+		return [Service(list(self.secrets), self.version)]
+
+	def service_get_secrets(self, service):
+		return service.attrs['Spec']['TaskTemplate']['ContainerSpec']['Secrets']
+
+	def service_update_secrets(self, service, secrets):
+		self.attempts += 1
+		if self.errors:
+			self.errors -= 1
+			raise ServiceUpdateError('invalid spec', status_code=400, explanation='invalid spec')
+		if self.conflicts:
+			self.conflicts -= 1
+			self.version += 1
+			raise ServiceUpdateError('update failed', status_code=500, explanation='rpc error: code = Unknown desc = update out of sequence')
+		assert service.attrs['Version']['Index'] == self.version
+		self.secrets = secrets
+		self.version += 1
+		self.updates += 1
+
+
+class SecretAttachmentReconcilerTestCase(TestCase):
+
+	def test_attach(self):
+		client = FakeClient()
+		reconciler = SecretAttachmentReconciler(client)
+		reconciler.attach('a.domain.com', Secret('1', 'a.domain.com.pem-20170101-000000'))
+		reconciler.attach('b.domain.com', Secret('2', 'b.domain.com.pem-20170101-000000'))
+		reconciler.commit()
+		self.assertEqual(client.updates, 1)
+		self.assertEqual(sorted(x['File']['Name'] for x in client.secrets), ['cert-a.domain.com', 'cert-b.domain.com'])
+
+		# replace secret of a.domain.com
+		reconciler.attach('a.domain.com', Secret('3', 'a.domain.com.pem-20170201-000000'))
+		reconciler.commit()
+		self.assertEqual(client.updates, 2)
+		self.assertEqual(sorted(x['SecretID'] for x in client.secrets), ['2', '3'])
+
+		# nothing changed, no update
+		reconciler.attach('a.domain.com', Secret('3', 'a.domain.com.pem-20170201-000000'))
+		reconciler.commit()
+		self.assertEqual(client.updates, 2)
+
+	def test_debounce(self):
+		client = FakeClient()
+		reconciler = SecretAttachmentReconciler(client, debounce=0.2)
+		for i in range(5):
+			reconciler.attach('{}.domain.com'.format(i), Secret(str(i), '{}.domain.com.pem'.format(i)))
+			reconciler.commit()
+		self.assertEqual(client.updates, 0)
+		self.assertEqual(len(reconciler.apply([])), 5)
+		time.sleep(0.5)
+		self.assertEqual(client.updates, 1)
+		self.assertEqual(len(client.secrets), 5)
+
+	def test_conflict(self):
+		client = FakeClient(conflicts=2)
+		reconciler = SecretAttachmentReconciler(client, retries=3)
+		reconciler.attach('a.domain.com', Secret('1', 'a.domain.com.pem'))
+		self.assertTrue(reconciler.flush())
+		self.assertEqual(client.updates, 1)
+
+	def test_failure(self):
+		client = FakeClient(conflicts=5)
+		reconciler = SecretAttachmentReconciler(client, retries=2)
+		reconciler.attach('a.domain.com', Secret('1', 'a.domain.com.pem'))
+		self.assertFalse(reconciler.flush())
+		# changes are kept for next update
+		self.assertIn('cert-a.domain.com', reconciler.pending)
+
+	def test_error_not_retried(self):
+		client = FakeClient(errors=1)
+		reconciler = SecretAttachmentReconciler(client, retries=3)
+		reconciler.attach('a.domain.com', Secret('1', 'a.domain.com.pem'))
+		self.assertFalse(reconciler.flush())
+		self.assertEqual(client.attempts, 1)
+		self.assertTrue(reconciler.flush())
+
+	def test_give_up(self):
+		# refused by the engine, retrying fails the same way
+		client = FakeClient(errors=10)
+		reconciler = SecretAttachmentReconciler(client, give_up_after=2, retry_delay=60)
+		reconciler.attach('a.domain.com', Secret('1', 'a.domain.com.pem'))
+		self.assertFalse(reconciler.flush())
+		self.assertIn('cert-a.domain.com', reconciler.pending)
+		self.assertFalse(reconciler.flush())
+		self.assertEqual(reconciler.pending, {})
+		self.assertEqual(reconciler.stats(), {'pending': 0, 'failures': 0, 'updated': 0, 'failed': 2, 'given_up': 1})
+		self.assertIsNone(reconciler._timer)
+
+	def test_retry(self):
+		client = FakeClient(errors=1)
+		reconciler = SecretAttachmentReconciler(client, retry_delay=0.1)
+		reconciler.attach('a.domain.com', Secret('1', 'a.domain.com.pem'))
+		reconciler.commit()
+		self.assertEqual(client.updates, 0)
+		time.sleep(0.3)
+		self.assertEqual(client.updates, 1)
+		self.assertEqual([x['SecretID'] for x in client.secrets], ['1'])
+		self.assertFalse(reconciler.pending)
+
+	def test_retry_exception(self):
+		# the dfp service can not be found.
+		client = FakeClient(missing=2)
+		reconciler = SecretAttachmentReconciler(client, retry_delay=0.1)
+		reconciler.attach('a.domain.com', Secret('1', 'a.domain.com.pem'))
+		self.assertFalse(reconciler.flush())
+		self.assertIn('cert-a.domain.com', reconciler.pending)
+		# changes made while failing wait for the retry.
+		reconciler.attach('b.domain.com', Secret('2', 'b.domain.com.pem'))
+		reconciler.commit()
+		self.assertEqual(client.updates, 0)
+		# second attempt fails too, next one after 0.2s.
+		time.sleep(0.15)
+		self.assertEqual(client.updates, 0)
+		time.sleep(0.3)
+		self.assertEqual(client.updates, 1)
+		self.assertEqual(sorted(x['SecretID'] for x in client.secrets), ['1', '2'])
+
+	def test_listeners(self):
+		client = FakeClient(conflicts=1)
+		reconciler = SecretAttachmentReconciler(client, retries=3)
+		listener = MagicMock()
+		reconciler.listeners.append(listener)
+		reconciler.attach('a.domain.com', Secret('1', 'a.domain.com.pem'))
+		self.assertTrue(reconciler.flush())
+		listener.assert_called_once_with()
+		self.assertEqual([x['SecretID'] for x in reconciler.applied], ['1'])
+		# nothing to update
+		reconciler.attach('a.domain.com', Secret('1', 'a.domain.com.pem'))
+		self.assertFalse(reconciler.flush())
+		listener.assert_called_once_with()
@@ -0,0 +1,199 @@
+import calendar
+import json
+import os
+import threading
+import time
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.x509.oid import ExtensionOID, NameOID
+
+import logging
+logger = logging.getLogger('letsencrypt')
+
+
+# files of a lineage watched for changes.
+LINEAGE_FILES = ('fullchain.pem', 'privkey.pem')
+
+def _timestamp(cert, attr):
+    # cryptography >= 42 exposes timezone aware dates, older versions naive UTC ones.
+    value = getattr(cert, '{}_utc'.format(attr), None) or getattr(cert, attr)
+    return calendar.timegm(value.utctimetuple())
+
+def load_cert(path):
+    """
+        Parse the first certificate of a PEM file.
+
+        :return: dict with keys domains, not_before, not_after, fingerprint
+    """
+    with open(path, 'rb') as f:
+        cert = x509.load_pem_x509_certificate(f.read(), default_backend())
+
+    try:
+        san = cert.extensions.get_extension_for_oid(ExtensionOID.SUBJECT_ALTERNATIVE_NAME)
+        domains = san.value.get_values_for_type(x509.DNSName)
+    except x509.ExtensionNotFound:
+        domains = [x.value for x in cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME)]
+
+    return {
+        'domains': sorted(set(d.lower() for d in domains)),
+        'issuer': cert.issuer.rfc4514_string(),
+        'not_before': _timestamp(cert, 'not_valid_before'),
+        'not_after': _timestamp(cert, 'not_valid_after'),
+        'fingerprint': ''.join('{:02x}'.format(b) for b in bytearray(cert.fingerprint(hashes.SHA256()))),
+    }
+
+
+def lineage_staging(certbot_path, name, issuer=None):
+    """
+        Whether the certificate of a lineage was issued by a staging server,
+        None if unknown: read from the metadata written by the ACME engine,
+        from the server of the certbot renewal configuration, or guessed from
+        the letsencrypt staging issuer name.
+    """
+    try:
+        with open(os.path.join(certbot_path, 'live', name, 'dfple.json')) as f:
+            meta = json.load(f)
+        if 'testing' in meta:
+            return bool(meta['testing'])
+    except (IOError, OSError, ValueError):
+        pass
+    try:
+        with open(os.path.join(certbot_path, 'renewal', '{}.conf'.format(name))) as f:
+            for line in f:
+                key, _, value = line.partition('=')
+                if key.strip() == 'server':
+                    return 'staging' in value.lower()
+    except (IOError, OSError):
+        pass
+    if issuer is not None:
+        return 'STAGING' in issuer or 'Fake LE' in issuer
+    return None
+
+
+class CertIndex():
+    """
+        Index of the lineages found in `<certbot_path>/live`, persisted in
+        `<certbot_path>/dfple-index.json`.
+
+        Entries are refreshed lazily: a lineage is parsed again only when the
+        mtime or size of one of its files changed.
+    """
+
+    def __init__(self, certbot_path, renew_before=30, index_file=None):
+        self.certbot_path = certbot_path
+        self.live_path = os.path.join(certbot_path, 'live')
+        self.index_file = index_file or os.path.join(certbot_path, 'dfple-index.json')
+        # renew certificates expiring in less than `renew_before` days.
+        self.renew_before = renew_before
+
+        self.entries = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        if os.path.exists(self.index_file):
+            try:
+                with open(self.index_file) as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                logger.warning('invalid certificates index {}, rebuilding it.'.format(self.index_file))
+                self.entries = {}
+
+    def save(self):
+        tmp_file = '{}.tmp'.format(self.index_file)
+        with open(tmp_file, 'w') as f:
+            json.dump(self.entries, f)
+        os.rename(tmp_file, self.index_file)
+
+    def _stat(self, name):
+        stats = {}
+        for filename in LINEAGE_FILES:
+            try:
+                st = os.stat(os.path.join(self.live_path, name, filename))
+            except OSError:
+                return None
+            stats[filename] = [st.st_mtime, st.st_size]
+        return stats
+
+    def _refresh_lineage(self, name):
+        """
+            Update the entry of the given lineage if its files changed.
+
+            :return: True if the index changed
+        """
+        stats = self._stat(name)
+        entry = self.entries.get(name)
+
+        if stats is None:
+            if entry is None:
+                return False
+            logger.debug('lineage {} removed from index'.format(name))
+            del self.entries[name]
+            return True
+
+        # entries indexed by previous versions lack the issuing server.
+        if entry is not None and entry['files'] == stats and 'staging' in entry:
+            return False
+
+        try:
+            entry = load_cert(os.path.join(self.live_path, name, 'fullchain.pem'))
+        except Exception as e:
+            logger.debug('unable to parse certificate of lineage {}: {}'.format(name, e))
+            entry = {'error': str(e)}
+        entry['staging'] = lineage_staging(self.certbot_path, name, entry.get('issuer'))
+        entry['name'] = name
+        entry['files'] = stats
+        self.entries[name] = entry
+        logger.debug('lineage {} indexed'.format(name))
+        return True
+
+    def refresh(self, names=None):
+        """
+            Refresh the given lineages, or every lineage if names is None.
+        """
+        with self._lock:
+            if names is None:
+                names = set(self.entries.keys())
+                if os.path.isdir(self.live_path):
+                    names.update(x for x in os.listdir(self.live_path)
+                                 if os.path.isdir(os.path.join(self.live_path, x)))
+            changed = False
+            for name in names:
+                changed = self._refresh_lineage(name) or changed
+            if changed:
+                self.save()
+            return changed
+
+    def snapshot(self):
+        """
+            Copy of the entries, safe to iterate while other threads refresh the index.
+        """
+        with self._lock:
+            return dict(self.entries)
+
+    def get(self, name):
+        self.refresh([name])
+        return self.entries.get(name)
+
+    def needs_update(self, domains, staging=None):
+        """
+            Check if certbot has to be called for the given domains.
+
+            :param staging: the certificate has to be issued by the staging server (True) or
+                the production one (False), None if either will do
+            :return: reason why the certificate needs to be (re)generated, None if up to date.
+        """
+        entry = self.get(domains[0])
+        if entry is None:
+            return 'missing'
+        if 'error' in entry:
+            return 'unreadable'
+        if entry['domains'] != sorted(set(d.lower() for d in domains)):
+            return 'domains changed'
+        if staging is not None and entry.get('staging') is not None and entry['staging'] != staging:
+            return 'server changed'
+        if entry['not_after'] - time.time() < self.renew_before * 86400:
+            return 'expiring'
+        return None
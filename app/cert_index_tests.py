@@ -0,0 +1,127 @@
+import datetime
+import os
+import shutil
+import tempfile
+import time
+from unittest import TestCase
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+from cert_index import CertIndex, load_cert
+
+
+def generate_cert(path, domains, days=90, age=0):
+	"""
+	Write a self signed certificate for domains into the lineage directory path.
+	"""
+	key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+	not_before = datetime.datetime.utcnow() - datetime.timedelta(days=age)
+	name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, domains[0])])
+	cert = x509.CertificateBuilder() \
+		.subject_name(name) \
+		.issuer_name(name) \
+		.public_key(key.public_key()) \
+		.serial_number(x509.random_serial_number()) \
+		.not_valid_before(not_before) \
+		.not_valid_after(not_before + datetime.timedelta(days=days)) \
+		.add_extension(x509.SubjectAlternativeName([x509.DNSName(d) for d in domains]), critical=False) \
+		.sign(key, hashes.SHA256(), default_backend())
+
+	if not os.path.exists(path):
+		os.makedirs(path)
+	with open(os.path.join(path, 'fullchain.pem'), 'wb') as f:
+		f.write(cert.public_bytes(serialization.Encoding.PEM))
+	with open(os.path.join(path, 'privkey.pem'), 'wb') as f:
+		f.write(key.private_bytes(
+			serialization.Encoding.PEM,
+			serialization.PrivateFormat.TraditionalOpenSSL,
+			serialization.NoEncryption()))
+
+
+class CertIndexTestCase(TestCase):
+
+	def setUp(self):
+		self.certbot_path = tempfile.mkdtemp()
+		self.live_path = os.path.join(self.certbot_path, 'live')
+		self.domains = ['site.domain.com', 'www.domain.com']
+
+	def tearDown(self):
+		shutil.rmtree(self.certbot_path)
+
+	def test_load_cert(self):
+		generate_cert(os.path.join(self.live_path, self.domains[0]), self.domains, days=10)
+		info = load_cert(os.path.join(self.live_path, self.domains[0], 'fullchain.pem'))
+		self.assertEqual(info['domains'], sorted(self.domains))
+		self.assertAlmostEqual(info['not_after'] - time.time(), 10 * 86400, delta=60)
+		self.assertEqual(len(info['fingerprint']), 64)
+
+	def test_needs_update(self):
+		index = CertIndex(self.certbot_path, renew_before=30)
+		self.assertEqual(index.needs_update(self.domains), 'missing')
+
+		generate_cert(os.path.join(self.live_path, self.domains[0]), self.domains)
+		self.assertIsNone(index.needs_update(self.domains))
+		self.assertIsNone(index.needs_update([self.domains[0], self.domains[1].upper()]))
+		self.assertEqual(index.needs_update(self.domains + ['new.domain.com']), 'domains changed')
+
+		generate_cert(os.path.join(self.live_path, self.domains[0]), self.domains, days=90, age=70)
+		os.utime(os.path.join(self.live_path, self.domains[0], 'fullchain.pem'), (0, 0))
+		self.assertEqual(index.needs_update(self.domains), 'expiring')
+
+	def test_snapshot(self):
+		generate_cert(os.path.join(self.live_path, self.domains[0]), self.domains)
+		index = CertIndex(self.certbot_path)
+		index.refresh()
+		entries = index.snapshot()
+		self.assertEqual(list(entries), [self.domains[0]])
+		# refreshing the index leaves the copy untouched
+		shutil.rmtree(os.path.join(self.live_path, self.domains[0]))
+		index.refresh()
+		self.assertEqual(index.entries, {})
+		self.assertEqual(list(entries), [self.domains[0]])
+
+	def test_server_changed(self):
+		generate_cert(os.path.join(self.live_path, self.domains[0]), self.domains)
+		index = CertIndex(self.certbot_path)
+		# self signed certificate, issuing server unknown
+		self.assertIsNone(index.needs_update(self.domains, staging=False))
+
+		os.makedirs(os.path.join(self.certbot_path, 'renewal'))
+		with open(os.path.join(self.certbot_path, 'renewal', '{}.conf'.format(self.domains[0])), 'w') as f:
+			f.write('version = 1.0\n[renewalparams]\nserver = https://acme-staging-v02.api.letsencrypt.org/directory\n')
+		generate_cert(os.path.join(self.live_path, self.domains[0]), self.domains)
+		self.assertIsNone(index.needs_update(self.domains, staging=True))
+		self.assertIsNone(index.needs_update(self.domains))
+		self.assertEqual(index.needs_update(self.domains, staging=False), 'server changed')
+
+		# written by the ACME engine
+		with open(os.path.join(self.live_path, self.domains[0], 'dfple.json'), 'w') as f:
+			f.write('{"email": "email@domain.com", "testing": false}')
+		generate_cert(os.path.join(self.live_path, self.domains[0]), self.domains)
+		self.assertIsNone(index.needs_update(self.domains, staging=False))
+		self.assertEqual(index.needs_update(self.domains, staging=True), 'server changed')
+
+	def test_unreadable(self):
+		base_path = os.path.join(self.live_path, self.domains[0])
+		os.makedirs(base_path)
+		for x in ('privkey.pem', 'fullchain.pem'):
+			open(os.path.join(base_path, x), 'a').close()
+		index = CertIndex(self.certbot_path)
+		self.assertEqual(index.needs_update(self.domains), 'unreadable')
+
+	def test_persistent(self):
+		generate_cert(os.path.join(self.live_path, self.domains[0]), self.domains)
+		index = CertIndex(self.certbot_path)
+		index.refresh()
+		self.assertIn(self.domains[0], index.entries)
+
+		index = CertIndex(self.certbot_path)
+		self.assertIn(self.domains[0], index.entries)
+
+		shutil.rmtree(os.path.join(self.live_path, self.domains[0]))
+		index.refresh()
+		self.assertNotIn(self.domains[0], index.entries)
@@ -0,0 +1,99 @@
+import os
+import threading
+import time
+
+import logging
+logger = logging.getLogger('letsencrypt')
+
+
+CHALLENGE_PATH = os.path.join('.well-known', 'acme-challenge')
+
+
+class TokenStore():
+    """
+        http-01 key authorizations by token, answered from memory.
+
+        The acme engine adds tokens as challenges are provisioned. Tokens
+        written in the webroot by certbot, another web worker or manual hooks
+        are loaded by scanning the challenge folder on a lookup miss. The scan
+        is gated by the folder mtime: an unknown token costs a single `stat`,
+        the folder is listed again only once a file was added or removed.
+        Tokens expire after `ttl` seconds.
+    """
+
+    def __init__(self, webroot_path=None, ttl=3600, clock=time.time):
+        self.path = os.path.join(webroot_path, CHALLENGE_PATH) if webroot_path else None
+        self.ttl = ttl
+        self.clock = clock
+
+        # (key authorization, expiry) by token.
+        self._tokens = {}
+        # tokens loaded from the webroot, and challenge folder mtime at last scan.
+        self._files = set()
+        self._scanned = None
+        self._lock = threading.Lock()
+
+    def add(self, token, validation, ttl=None):
+        with self._lock:
+            self._tokens[token] = (validation, self.clock() + (ttl or self.ttl))
+
+    def remove(self, token):
+        with self._lock:
+            self._tokens.pop(token, None)
+            self._files.discard(token)
+
+    def _get(self, token):
+        entry = self._tokens.get(token)
+        if entry is None:
+            return None
+        if entry[1] <= self.clock():
+            del self._tokens[token]
+            self._files.discard(token)
+            return None
+        return entry[0]
+
+    def get(self, token):
+        """
+            Key authorization of token, None if unknown or expired.
+        """
+        with self._lock:
+            validation = self._get(token)
+            if validation is None:
+                self._scan()
+                validation = self._get(token)
+            return validation
+
+    def __len__(self):
+        with self._lock:
+            return len(self._tokens)
+
+    def _scan(self):
+        if self.path is None:
+            return
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return
+        if mtime == self._scanned:
+            return
+        self._scanned = mtime
+
+        tokens = set(os.listdir(self.path))
+        # files removed by certbot cleanup
+        for token in self._files - tokens:
+            self._tokens.pop(token, None)
+        self._files &= tokens
+        for token in tokens - self._files:
+            try:
+                with open(os.path.join(self.path, token), 'rb') as f:
+                    validation = f.read().decode('ascii').strip()
+            except (IOError, OSError, UnicodeDecodeError) as e:
+                logger.warning('unable to read challenge {}: {}'.format(token, e))
+                continue
+            if not validation:
+                # file still being written, read it again on next scan.
+                self._scanned = None
+                continue
+            self._tokens[token] = (validation, self.clock() + self.ttl)
+            self._files.add(token)
+        logger.debug('{} challenge tokens loaded from {}'.format(len(self._files), self.path))
@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+from mock import patch
+from unittest import TestCase
+
+from challenge_store import CHALLENGE_PATH, TokenStore
+
+
+class Clock():
+
+	def __init__(self):
+		self.now = 1000.0
+
+	def __call__(self):
+		return self.now
+
+
+class TokenStoreTestCase(TestCase):
+
+	def setUp(self):
+		self.webroot_path = tempfile.mkdtemp()
+		self.path = os.path.join(self.webroot_path, CHALLENGE_PATH)
+		os.makedirs(self.path)
+		self.clock = Clock()
+		self.store = TokenStore(self.webroot_path, ttl=60, clock=self.clock)
+
+	def tearDown(self):
+		shutil.rmtree(self.webroot_path)
+
+	def write(self, token, validation):
+		with open(os.path.join(self.path, token), 'w') as f:
+			f.write(validation)
+
+	def test_add(self):
+		self.store.add('token', 'token.thumbprint')
+		self.assertEqual(self.store.get('token'), 'token.thumbprint')
+		self.store.remove('token')
+		self.assertIsNone(self.store.get('token'))
+
+	def test_expiry(self):
+		self.store.add('token', 'token.thumbprint')
+		self.clock.now += 59
+		self.assertEqual(self.store.get('token'), 'token.thumbprint')
+		self.clock.now += 1
+		self.assertIsNone(self.store.get('token'))
+		self.assertEqual(len(self.store), 0)
+
+	def test_unknown(self):
+		self.store.get('unknown')
+		# the folder is unchanged, a miss costs a single stat
+		with patch('challenge_store.os.listdir') as listdir, patch('challenge_store.open', create=True) as open_:
+			self.assertIsNone(self.store.get('token'))
+			self.assertFalse(listdir.called)
+			self.assertFalse(open_.called)
+
+	def test_scan(self):
+		self.assertIsNone(self.store.get('token'))
+		self.write('token', 'token.thumbprint')
+		self.write('other', 'other.thumbprint')
+		os.utime(self.path, (0, 1))
+		self.assertEqual(self.store.get('token'), 'token.thumbprint')
+		# loaded tokens are answered from memory, no scan while the folder is unchanged
+		with patch('challenge_store.os.listdir') as listdir, patch('challenge_store.os.stat') as stat:
+			self.assertEqual(self.store.get('other'), 'other.thumbprint')
+			self.assertFalse(stat.called)
+		with patch('challenge_store.os.listdir') as listdir:
+			self.assertIsNone(self.store.get('unknown'))
+			self.assertFalse(listdir.called)
+		# removed by certbot cleanup, dropped on next scan
+		os.remove(os.path.join(self.path, 'token'))
+		os.utime(self.path, (0, 2))
+		self.assertIsNone(self.store.get('unknown'))
+		self.assertIsNone(self.store.get('token'))
+		self.assertEqual(self.store.get('other'), 'other.thumbprint')
+
+	def test_partial_file(self):
+		self.write('token', '')
+		self.assertIsNone(self.store.get('token'))
+		self.write('token', 'token.thumbprint')
+		self.assertEqual(self.store.get('token'), 'token.thumbprint')
+
+	def test_no_webroot(self):
+		store = TokenStore()
+		self.assertIsNone(store.get('token'))
@@ -0,0 +1,265 @@
+import datetime
+import json
+import os
+import subprocess
+import threading
+import time
+
+import josepy as jose
+from acme import challenges, client as acme_client, crypto_util, errors, messages
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from cert_index import load_cert
+from client_certbot import CertResult, Engine
+from dns_challenge import challenge_name
+
+import logging
+logger = logging.getLogger('letsencrypt')
+
+
+DIRECTORY_URL = 'https://acme-v02.api.letsencrypt.org/directory'
+STAGING_DIRECTORY_URL = 'https://acme-staging-v02.api.letsencrypt.org/directory'
+USER_AGENT = 'docker-flow-proxy-letsencrypt'
+
+def generate_key_pem(bits=2048):
+    key = rsa.generate_private_key(public_exponent=65537, key_size=bits, backend=default_backend())
+    return key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.TraditionalOpenSSL,
+        serialization.NoEncryption())
+
+def write_file(path, data, mode=0o644):
+    tmp_path = '{}.tmp'.format(path)
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.rename(tmp_path, path)
+
+
+class AcmeEngine(Engine):
+    """
+        Speak ACME (RFC 8555) in-process instead of running certbot.
+
+        The account key, directory and nonces are kept between orders.
+        Certificates are written in `<certbot_path>/live/<domain>/`, using
+        the same file names as certbot.
+    """
+
+    def __init__(self, certbot, directory_url=None, staging_directory_url=None, verify_ssl=True, renew_before=30):
+        Engine.__init__(self, certbot)
+        self.path = os.path.join(certbot.path, 'dfple-acme')
+        self.live_path = os.path.join(certbot.path, 'live')
+        self.directory_url = directory_url or DIRECTORY_URL
+        self.staging_directory_url = staging_directory_url or STAGING_DIRECTORY_URL
+        self.verify_ssl = verify_ssl
+        self.renew_before = renew_before
+
+        # ACME clients by directory url.
+        self._clients = {}
+        self._lock = threading.Lock()
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        self.account_key = self._load_account_key()
+
+    def _load_account_key(self):
+        key_path = os.path.join(self.path, 'account.pem')
+        if not os.path.exists(key_path):
+            logger.info('generating ACME account key.')
+            write_file(key_path, generate_key_pem(), 0o600)
+        with open(key_path, 'rb') as f:
+            key = serialization.load_pem_private_key(f.read(), password=None, backend=default_backend())
+        return jose.JWKRSA(key=key)
+
+    def _account_file(self, directory_url):
+        return os.path.join(self.path, 'account-{}.json'.format(
+            ''.join(c if c.isalnum() else '_' for c in directory_url)))
+
+    def client(self, directory_url, email):
+        """
+            ACME client of the given directory, registered with the account key.
+        """
+        with self._lock:
+            if directory_url in self._clients:
+                return self._clients[directory_url]
+
+            net = acme_client.ClientNetwork(self.account_key, user_agent=USER_AGENT, verify_ssl=self.verify_ssl)
+            directory = messages.Directory.from_json(net.get(directory_url).json())
+            client = acme_client.ClientV2(directory, net=net)
+
+            account_file = self._account_file(directory_url)
+            if os.path.exists(account_file):
+                with open(account_file) as f:
+                    regr = messages.RegistrationResource.json_loads(f.read())
+                net.account = regr
+            else:
+                logger.info('registering ACME account on {}'.format(directory_url))
+                regr = client.new_account(messages.NewRegistration.from_data(
+                    email=email, terms_of_service_agreed=True))
+                write_file(account_file, regr.json_dumps().encode('utf-8'), 0o600)
+
+            self._clients[directory_url] = client
+            return client
+
+    def lineage_valid(self, domains, staging=None):
+        try:
+            info = load_cert(os.path.join(self.live_path, domains[0], 'fullchain.pem'))
+        except Exception:
+            return False
+        testing = self.lineage_meta(domains[0]).get('testing')
+        if staging is not None and testing is not None and bool(testing) != staging:
+            return False
+        return info['domains'] == sorted(set(d.lower() for d in domains)) and \
+            info['not_after'] - time.time() > self.renew_before * 86400
+
+    def issue(self, domains, email, testing=None, force=False):
+        staging = self.certbot.is_staging(testing)
+        if not force and self.lineage_valid(domains, staging):
+            logger.debug('Certificate not yet due for renewal; no action taken.')
+            return CertResult(CertResult.NOOP)
+
+        directory_url = self.staging_directory_url if staging else self.directory_url
+        try:
+            client = self.client(directory_url, email)
+            fullchain_pem, key_pem = self.order(client, domains)
+        except errors.ValidationError as e:
+            error = None
+            for authzr in e.failed_authzrs:
+                for challb in authzr.body.challenges:
+                    if challb.error is not None:
+                        error = challb.error
+            logger.error('Error during ACME challenge for {}: {}'.format(domains, error))
+            return CertResult(CertResult.ERROR,
+                error.typ if error is not None else None,
+                error.detail if error is not None else None)
+        except messages.Error as e:
+            logger.error('ACME error for {}: {}'.format(domains, e))
+            return CertResult(CertResult.ERROR, e.typ, e.detail)
+        except Exception as e:
+            logger.error('Error while requesting certificate for {}: {}'.format(domains, e))
+            return CertResult(CertResult.ERROR, detail=str(e))
+
+        self.write_lineage(domains[0], fullchain_pem, key_pem, {'email': email, 'testing': staging})
+        logger.info('certificate issued for {}'.format(domains))
+        return CertResult(CertResult.ISSUED)
+
+    def renew(self, lineages, force=False, restrict=False):
+        # only the given lineages are renewed, due or not.
+        error = False
+        for name, domains in lineages.items():
+            meta = self.lineage_meta(name)
+            domains = [name] + [x for x in domains if x != name]
+            result = self.issue(domains, meta.get('email'), testing=meta.get('testing'), force=True)
+            if result.error:
+                self.certbot.notify(domains, result, meta.get('testing'))
+            error = error or result.error
+        return error
+
+    def order(self, client, domains):
+        key_pem = generate_key_pem()
+        csr_pem = crypto_util.make_csr(key_pem, domains)
+        orderr = client.new_order(csr_pem)
+
+        provisioned = []
+        dns_records = []
+        try:
+            # authorizations validated by a previous order do not need a challenge.
+            authzrs = [x for x in orderr.authorizations if x.body.status != messages.STATUS_VALID]
+            challbs = [self.select_challenge(authzr) for authzr in authzrs]
+            responses = []
+            for authzr, challb in zip(authzrs, challbs):
+                domain = authzr.body.identifier.value
+                response, validation = challb.response_and_validation(client.net.key)
+                self.provision(domain, challb, validation, len(challbs) - len(provisioned) - 1, domains)
+                provisioned.append((domain, challb, validation))
+                responses.append(response)
+            if self.certbot.dns is not None:
+                # TXT records of every name created at once, a single propagation wait.
+                records = [(challenge_name(domain), validation) for domain, challb, validation in provisioned
+                           if isinstance(challb.chall, challenges.DNS01)]
+                if records:
+                    dns_records = self.certbot.dns.provider.create_records(records)
+                    self.certbot.dns.wait_records(dns_records)
+            for challb, response in zip(challbs, responses):
+                client.answer_challenge(challb, response)
+
+            deadline = datetime.datetime.now() + datetime.timedelta(seconds=90)
+            orderr = client.poll_and_finalize(orderr, deadline)
+        finally:
+            if dns_records:
+                try:
+                    self.certbot.dns.provider.delete_records(dns_records)
+                except Exception as e:
+                    logger.error('Error while deleting TXT records: {}'.format(e))
+            for domain, challb, validation in provisioned:
+                try:
+                    self.cleanup(domain, challb, validation, domains)
+                except Exception as e:
+                    logger.error('Error while cleaning challenge for {}: {}'.format(domain, e))
+
+        return orderr.fullchain_pem.encode('utf-8'), key_pem
+
+    def select_challenge(self, authzr):
+        wanted = challenges.HTTP01 if self.certbot.challenge == 'http' else challenges.DNS01
+        for challb in authzr.body.challenges:
+            if isinstance(challb.chall, wanted):
+                return challb
+        raise Exception('no {} challenge offered for {}'.format(
+            wanted.typ, authzr.body.identifier.value))
+
+    def provision(self, domain, challb, validation, remaining, domains=()):
+        if isinstance(challb.chall, challenges.HTTP01):
+            path = os.path.join(self.certbot.webroot_path, challb.chall.path.lstrip('/'))
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            write_file(path, validation.encode('utf-8'))
+            self.certbot.tokens.add(jose.b64encode(challb.chall.token).decode('ascii'), validation)
+        elif self.certbot.dns is None:
+            self.run_hook(self.certbot.manual_auth_hook, domain, challb, validation, remaining, domains)
+
+    def cleanup(self, domain, challb, validation, domains=()):
+        if isinstance(challb.chall, challenges.HTTP01):
+            path = os.path.join(self.certbot.webroot_path, challb.chall.path.lstrip('/'))
+            if os.path.exists(path):
+                os.remove(path)
+            self.certbot.tokens.remove(jose.b64encode(challb.chall.token).decode('ascii'))
+        elif self.certbot.dns is None:
+            self.run_hook(self.certbot.manual_cleanup_hook, domain, challb, validation, 0, domains)
+
+    def run_hook(self, hook, domain, challb, validation, remaining, domains=()):
+        # same environment as the one provided by certbot to manual hooks.
+        env = dict(os.environ,
+            CERTBOT_DOMAIN=domain,
+            CERTBOT_VALIDATION=validation,
+            CERTBOT_TOKEN=jose.b64encode(challb.chall.token).decode('ascii'),
+            CERTBOT_REMAINING_CHALLENGES=str(remaining),
+            CERTBOT_ALL_DOMAINS=','.join(domains or [domain]))
+        logger.debug('executing hook {} for {}'.format(hook, domain))
+        code = subprocess.call(hook, shell=True, env=env)
+        if code != 0:
+            raise Exception('hook {} returned {}'.format(hook, code))
+
+    def lineage_meta(self, name):
+        meta_path = os.path.join(self.live_path, name, 'dfple.json')
+        if not os.path.exists(meta_path):
+            return {}
+        with open(meta_path) as f:
+            return json.load(f)
+
+    def write_lineage(self, name, fullchain_pem, key_pem, meta):
+        path = os.path.join(self.live_path, name)
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        # the first certificate of the chain is the leaf one.
+        end = b'-----END CERTIFICATE-----\n'
+        cert_pem, chain_pem = fullchain_pem.split(end, 1)
+        cert_pem += end
+
+        write_file(os.path.join(path, 'privkey.pem'), key_pem, 0o600)
+        write_file(os.path.join(path, 'cert.pem'), cert_pem)
+        write_file(os.path.join(path, 'chain.pem'), chain_pem.lstrip())
+        write_file(os.path.join(path, 'fullchain.pem'), fullchain_pem)
+        write_file(os.path.join(path, 'dfple.json'), json.dumps(meta).encode('utf-8'))
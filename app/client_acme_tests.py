@@ -0,0 +1,136 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from mock import MagicMock
+from unittest import TestCase
+
+try:
+	from http.server import HTTPServer, SimpleHTTPRequestHandler
+except ImportError:
+	from BaseHTTPServer import HTTPServer
+	from SimpleHTTPServer import SimpleHTTPRequestHandler
+
+from acme import challenges, messages
+from cert_index import load_cert
+from cert_index_tests import generate_cert
+from client_acme import AcmeEngine
+from client_certbot import CertbotClient, CertResult
+from dns_challenge_tests import FakeProvider
+
+# Integration tests run against a local ACME server, for example pebble:
+#   PEBBLE_DIRECTORY=https://localhost:14000/dir PEBBLE_HTTP_PORT=5002 pytest app/client_acme_tests.py
+PEBBLE_DIRECTORY = os.environ.get('PEBBLE_DIRECTORY')
+PEBBLE_HTTP_PORT = int(os.environ.get('PEBBLE_HTTP_PORT', 5002))
+
+
+class AcmeEngineTestCase(TestCase):
+
+	def setUp(self):
+		self.certbot_path = tempfile.mkdtemp()
+		self.webroot_path = tempfile.mkdtemp()
+		self.domains = ['site.domain.com', 'www.domain.com']
+
+	def tearDown(self):
+		shutil.rmtree(self.certbot_path)
+		shutil.rmtree(self.webroot_path)
+
+	def client(self, **kwargs):
+		return CertbotClient(engine='acme', path=self.certbot_path, challenge='http',
+			webroot_path=self.webroot_path, **kwargs)
+
+	def test_engine(self):
+		self.assertIsInstance(self.client().engine, AcmeEngine)
+
+	def test_account_key_persistent(self):
+		key = self.client().engine.account_key
+		self.assertEqual(self.client().engine.account_key.thumbprint(), key.thumbprint())
+
+	def test_noop(self):
+		generate_cert(os.path.join(self.certbot_path, 'live', self.domains[0]), self.domains)
+		result = self.client().issue(self.domains, 'email@domail.com')
+		self.assertEqual(result.status, CertResult.NOOP)
+
+	def test_lineage_valid_server(self):
+		engine = self.client().engine
+		generate_cert(os.path.join(self.certbot_path, 'live', self.domains[0]), self.domains)
+		self.assertTrue(engine.lineage_valid(self.domains, staging=False))
+		with open(os.path.join(self.certbot_path, 'live', self.domains[0], 'dfple.json'), 'w') as f:
+			f.write('{"email": "email@domail.com", "testing": true}')
+		self.assertTrue(engine.lineage_valid(self.domains, staging=True))
+		self.assertFalse(engine.lineage_valid(self.domains, staging=False))
+
+	def test_write_lineage(self):
+		engine = self.client().engine
+		generate_cert(os.path.join(self.certbot_path, 'live', 'tmp'), self.domains)
+		with open(os.path.join(self.certbot_path, 'live', 'tmp', 'fullchain.pem'), 'rb') as f:
+			fullchain = f.read()
+		engine.write_lineage(self.domains[0], fullchain + fullchain, b'key', {'email': 'email@domail.com', 'testing': True})
+
+		path = os.path.join(self.certbot_path, 'live', self.domains[0])
+		self.assertEqual(load_cert(os.path.join(path, 'cert.pem'))['domains'], sorted(self.domains))
+		self.assertEqual(load_cert(os.path.join(path, 'chain.pem'))['domains'], sorted(self.domains))
+		self.assertEqual(engine.lineage_meta(self.domains[0])['testing'], True)
+
+	def test_provision_http(self):
+		client = self.client()
+		challb = messages.ChallengeBody(
+			chall=challenges.HTTP01(token=b'a' * 16), uri='https://acme/chall/1', status=messages.STATUS_PENDING)
+		token = challb.chall.encode('token')
+		client.engine.provision(self.domains[0], challb, 'validation', 0)
+		self.assertEqual(client.tokens.get(token), 'validation')
+		client.engine.cleanup(self.domains[0], challb, 'validation')
+		self.assertIsNone(client.tokens.get(token))
+
+	def test_order_dns_provider(self):
+		provider = FakeProvider()
+		events = []
+		provider.create_records = lambda records, create=provider.create_records: events.append('create') or create(records)
+		provider.delete_records = lambda records, delete=provider.delete_records: events.append('delete') or delete(records)
+		client = CertbotClient(engine='acme', path=self.certbot_path, challenge='dns', dns_provider=provider)
+		waits = []
+		client.dns.wait = lambda name, value, nameservers=None, timeout=None: waits.append(name) or True
+
+		def authzr(domain):
+			return messages.AuthorizationResource(uri='https://acme/authz/' + domain, body=messages.Authorization(
+				identifier=messages.Identifier(typ=messages.IDENTIFIER_FQDN, value=domain),
+				status=messages.STATUS_PENDING,
+				challenges=[messages.ChallengeBody(chall=challenges.DNS01(token=domain.encode() * 2),
+					uri='https://acme/chall/' + domain, status=messages.STATUS_PENDING)]))
+
+		acme = MagicMock()
+		acme.net.key = client.engine.account_key
+		acme.new_order.return_value.authorizations = [authzr(x) for x in self.domains]
+		acme.answer_challenge.side_effect = lambda challb, response: events.append('answer')
+		acme.poll_and_finalize.return_value.fullchain_pem = 'fullchain'
+
+		self.assertEqual(client.engine.order(acme, self.domains)[0], b'fullchain')
+		# records created at once before answering, deleted once validated
+		self.assertEqual(events, ['create', 'answer', 'answer', 'delete'])
+		self.assertEqual(sorted(waits), ['_acme-challenge.site.domain.com', '_acme-challenge.www.domain.com'])
+		self.assertEqual(provider.records, {})
+
+	@unittest.skipIf(PEBBLE_DIRECTORY is None, 'PEBBLE_DIRECTORY not set')
+	def test_pebble(self):
+		webroot_path = self.webroot_path
+
+		class Handler(SimpleHTTPRequestHandler):
+			def translate_path(self, path):
+				return os.path.join(webroot_path, path.lstrip('/'))
+
+		server = HTTPServer(('0.0.0.0', PEBBLE_HTTP_PORT), Handler)
+		thread = threading.Thread(target=server.serve_forever)
+		thread.daemon = True
+		thread.start()
+		try:
+			client = self.client(acme_directory_url=PEBBLE_DIRECTORY, acme_verify_ssl=False)
+			result = client.issue(self.domains, 'email@domail.com')
+			self.assertEqual(result.status, CertResult.ISSUED, result.detail)
+			self.assertEqual(client.issue(self.domains, 'email@domail.com').status, CertResult.NOOP)
+
+			# the account and the directory are reused.
+			self.assertEqual(len(client.engine._clients), 1)
+			self.assertTrue(client.engine.renew({self.domains[0]: self.domains}) is False)
+		finally:
+			server.shutdown()
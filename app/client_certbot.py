@@ -1,16 +1,299 @@
+import calendar
+import collections
+import os
+import re
 import subprocess
+import threading
+import time
+
+from challenge_store import TokenStore
+from dns_challenge import ChallengeBatch, DNSProvider, provider_from_env
+from metrics import CERTBOT_DURATION
 
 import logging
 logger = logging.getLogger('letsencrypt')
 
 
+HOOKS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hooks')
+
+# ACME error types counted as failed validations.
+VALIDATION_ERRORS = ('unauthorized', 'dns', 'connection', 'incorrectResponse', 'caa', 'tls')
+
+# ACME error printed by certbot (urn:acme:error:<type> with ACME v1).
+ACME_ERROR_RE = re.compile(r'(urn:(?:ietf:params:)?acme:error:\w+)(?:\s*::\s*(.*))?')
+# problems listed by certbot without urn: "Type: unauthorized", "Detail: ..."
+PROBLEM_TYPE_RE = re.compile(r'^\s*Type:\s+(\w+)\s*$', re.M)
+PROBLEM_DETAIL_RE = re.compile(r'^\s*Detail:\s+(.*)$', re.M)
+RETRY_AFTER_RE = re.compile(r'retry after (\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}) UTC')
+# summary of certbot renew: "/etc/letsencrypt/live/<lineage>/fullchain.pem (failure)"
+FAILED_RENEWAL_RE = re.compile(r'live/([^/\s]+)/fullchain\.pem \(failure\)')
+# live/<lineage>/fullchain.pem links to archive/<lineage>/fullchain<version>.pem
+ARCHIVE_VERSION_RE = re.compile(r'fullchain(\d+)\.pem$')
+
+# lines of certbot output kept for classification, every line is logged.
+OUTPUT_LINES = 500
+
+def to_text(data):
+    if data is None:
+        return ''
+    if isinstance(data, bytes):
+        return data.decode('utf-8', 'replace')
+    return data
+
+def lineage_state(live_path, name):
+    """
+        Archive version and stat of the certificate of a lineage, None if it
+        does not exist. Each issuance increments the version of the archive
+        files the live files link to.
+    """
+    path = os.path.join(live_path, name, 'fullchain.pem')
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    version = None
+    if os.path.islink(path):
+        match = ARCHIVE_VERSION_RE.search(os.readlink(path))
+        if match:
+            version = int(match.group(1))
+    return (version, stat.st_ino, stat.st_size, stat.st_mtime)
+
+
+class CertResult():
+    """
+        Outcome of a certificate request.
+    """
+
+    ISSUED = 'issued'
+    NOOP = 'noop'
+    ERROR = 'error'
+
+    def __init__(self, status, error_type=None, detail=None, retry_after=None):
+        self.status = status
+        # ACME error type (urn:...) if known.
+        self.error_type = error_type
+        self.detail = detail
+        # time before which the ACME server refuses new orders, if known.
+        self.retry_after = retry_after
+
+        self.error = status == self.ERROR
+        self.created = status == self.ISSUED
+
+    @classmethod
+    def from_certbot(cls, code, output, error, before=None, after=None):
+        """
+            Result of a certbot run, from its exit code and the state of the
+            lineage before and after the run (see lineage_state).
+        """
+        output, error = to_text(output), to_text(error)
+        if code == 0:
+            if after is not None:
+                return cls(cls.ISSUED if after != before else cls.NOOP)
+            # lineage not found, rely on certbot messages.
+            return cls(cls.NOOP if 'no action taken.' in output else cls.ISSUED)
+
+        text = '{}\n{}'.format(output, error)
+        error_type, detail = None, None
+        match = ACME_ERROR_RE.search(text)
+        if match:
+            error_type, detail = match.group(1), match.group(2)
+        else:
+            match = PROBLEM_TYPE_RE.search(text)
+            if match:
+                error_type = 'urn:ietf:params:acme:error:{}'.format(match.group(1))
+                match = PROBLEM_DETAIL_RE.search(text)
+                detail = match.group(1) if match else None
+        if code is not None and code < 0:
+            detail = 'certbot killed by signal {}'.format(-code)
+        elif detail is None:
+            lines = [x.strip() for x in error.splitlines() if x.strip()]
+            detail = lines[-1] if lines else None
+
+        retry_after = None
+        match = RETRY_AFTER_RE.search(text)
+        if match:
+            retry_after = calendar.timegm(time.strptime(match.group(1), '%Y-%m-%d %H:%M:%S'))
+        return cls(cls.ERROR, error_type, detail and detail.strip(), retry_after)
+
+    def validation_failed(self):
+        """
+            The ACME server refused the challenge response.
+        """
+        return self.error_type is not None and \
+            self.error_type.split(':')[-1] in VALIDATION_ERRORS
+
+    def rate_limited(self):
+        """
+            The ACME server refused the order, a rate limit is reached.
+        """
+        return self.error_type is not None and self.error_type.split(':')[-1] == 'rateLimited'
+
+    def __repr__(self):
+        return '<CertResult {} {}>'.format(self.status, self.error_type or '')
+
+
+class Engine():
+    """
+        Issue certificates on behalf of a CertbotClient.
+    """
+
+    def __init__(self, certbot):
+        self.certbot = certbot
+
+    def issue(self, domains, email, testing=None):
+        """
+            Generate or renew the certificate of the given domains.
+
+            :rtype: CertResult
+        """
+        raise NotImplementedError()
+
+    def renew(self, lineages, force=False, restrict=False):
+        """
+            Renew certificates due for renewal.
+
+            :param lineages: domains by lineage name of the certificates due for renewal
+            :param force: renew the given lineages even if certbot does not consider them due
+            :param restrict: renew only the given lineages, not every lineage certbot considers due
+            :return: True if an error occured
+        """
+        raise NotImplementedError()
+
+
+class CertbotEngine(Engine):
+    """
+        Run the certbot executable.
+
+        Certbot refuses to run while another instance uses the same
+        configuration folder, runs are serialized.
+    """
+
+    def __init__(self, certbot):
+        Engine.__init__(self, certbot)
+        self._lock = threading.Lock()
+
+    def issue(self, domains, email, testing=None):
+        # challenge files written by certbot are picked up by the token store.
+        with self._lock:
+            return self._issue(domains, email, testing)
+
+    def _issue(self, domains, email, testing=None):
+        certbot = self.certbot
+
+        live_path = os.path.join(certbot.path or '', 'live')
+        before = lineage_state(live_path, domains[0])
+
+        c = ''
+        if certbot.challenge == 'http':
+            c = "--webroot --webroot-path {}".format(certbot.webroot_path)
+        if certbot.challenge == 'dns':
+            c = "--manual --manual-public-ip-logging-ok --preferred-challenges dns --manual-auth-hook {} --manual-cleanup-hook {}".format(certbot.manual_auth_hook, certbot.manual_cleanup_hook)
+
+        output, error, code = certbot.run("""{bin} certonly \
+                    --agree-tos \
+                    --domains {domains} \
+                    --email {email} \
+                    --expand \
+                    --noninteractive \
+                    {challenge}
+                    --debug \
+                    {options}""".format(
+                        bin=certbot.bin,
+                        domains=','.join(domains),
+                        email=email,
+                        webroot_path=certbot.webroot_path,
+                        options=certbot.get_options(testing=testing),
+                        challenge=c).split())
+
+        result = CertResult.from_certbot(code, output, error, before, lineage_state(live_path, domains[0]))
+
+        if result.status == CertResult.NOOP:
+            logger.debug('Nothing to do. Skipping.')
+        elif result.error:
+            log_error(result, code)
+        return result
+
+    def renew(self, lineages, force=False, restrict=False):
+        with self._lock:
+            if force or restrict:
+                # certbot renews a single --cert-name lineage per run.
+                args = '--cert-name {} --force-renewal' if force else '--cert-name {}'
+                error = False
+                for name in sorted(lineages):
+                    error = self._renew({name: lineages[name]}, args.format(name)) or error
+                return error
+            return self._renew(lineages)
+
+    def _renew(self, lineages, args=''):
+        # without args certbot renews every lineage it considers due,
+        # challenge and server are read from each lineage renewal configuration.
+        output, error, code = self.certbot.run("""{bin} renew \
+                    --noninteractive \
+                    {args} \
+                    {options}""".format(
+                        bin=self.certbot.bin,
+                        args=args,
+                        options=self.certbot.get_options(testing=False)).split())
+
+        if code != 0:
+            result = CertResult.from_certbot(code, output, error)
+            log_error(result, code)
+            # only the lineages listed as failed account for the error.
+            failed = failed_lineages('{}\n{}'.format(output, error))
+            if not failed and len(lineages) == 1:
+                failed = list(lineages)
+            for name in failed:
+                self.certbot.notify(lineages.get(name) or [name], result, False)
+            return True
+        return False
+
+
+def failed_lineages(output):
+    """
+        Lineages listed in the "following renewals failed" summary of certbot renew.
+    """
+    return sorted(set(FAILED_RENEWAL_RE.findall(output or '')))
+
+
+def log_error(result, code):
+    if result.rate_limited():
+        logger.error('ACME rate limit reached{}: {}'.format(
+            ', retry after {}'.format(time.strftime('%Y-%m-%d %H:%M:%S UTC', time.gmtime(result.retry_after)))
+            if result.retry_after else '', result.detail))
+    elif result.validation_failed():
+        logger.error('Error during ACME challenge ({}), is the domain name associated with the right IP ? {}'.format(
+            result.error_type.split(':')[-1], result.detail or ''))
+    logger.error('Certbot return code: {}. Skipping'.format(code))
+
+
 class CertbotClient():
     def __init__(self, **kwargs):
+        self.bin = kwargs.get('bin', 'certbot')
+        self.path = kwargs.get('path')
         self.challenge = kwargs.get('challenge')
         self.webroot_path = kwargs.get('webroot_path')
         self.manual_auth_hook = kwargs.get('manual_auth_hook')
         self.manual_cleanup_hook = kwargs.get('manual_cleanup_hook')
         self.options = kwargs.get('options', "")
+        # functions called with (domains, result, testing) for each certificate
+        # request and each failed renewal.
+        self.listeners = []
+        # http-01 challenges served by the API, from memory.
+        self.tokens = TokenStore(self.webroot_path)
+
+        # DNS provider used in-process for dns challenges, instead of manual hooks.
+        self.dns = None
+        dns_provider = kwargs.get('dns_provider')
+        if dns_provider:
+            if not isinstance(dns_provider, DNSProvider):
+                dns_provider = provider_from_env(dns_provider)
+            self.dns = ChallengeBatch(dns_provider,
+                state_file=kwargs.get('dns_challenge_state'),
+                propagation_timeout=kwargs.get('dns_propagation_timeout', 300),
+                nameservers=kwargs.get('dns_propagation_nameservers'))
+            # certbot reaches the provider through the API.
+            self.manual_auth_hook = self.manual_auth_hook or os.path.join(HOOKS_PATH, 'dns', 'manual-auth-hook.sh')
+            self.manual_cleanup_hook = self.manual_cleanup_hook or os.path.join(HOOKS_PATH, 'dns', 'manual-cleanup-hook.sh')
 
         if self.challenge not in ("http", "dns"):
             raise Exception('required argument "challenge" not set.')
@@ -19,20 +302,59 @@ class CertbotClient():
         if self.challenge == "dns" and (self.manual_auth_hook is None or self.manual_cleanup_hook is None):
             raise Exception('required argument "manual_auth_hook" or "manual_manual_hook" not set. Required when using challenge "dns"')
 
+        engine = kwargs.get('engine', 'certbot')
+        if engine == 'certbot':
+            self.engine = CertbotEngine(self)
+        elif engine == 'acme':
+            from client_acme import AcmeEngine
+            self.engine = AcmeEngine(self,
+                directory_url=kwargs.get('acme_directory_url'),
+                staging_directory_url=kwargs.get('acme_staging_directory_url'),
+                verify_ssl=kwargs.get('acme_verify_ssl', True),
+                renew_before=kwargs.get('renew_before', 30))
+        elif isinstance(engine, Engine):
+            self.engine = engine
+        else:
+            raise Exception('unknown engine "{}". Use "certbot" or "acme"'.format(engine))
+
 
     def run(self, cmd):
-        # cmd = cmd.split()
+        """
+            Run cmd, its output is logged line by line while it runs.
+
+            :return: output, error (text, last OUTPUT_LINES lines), return code
+        """
         logger.debug('executing cmd : {}'.format(cmd))
-        process = subprocess.Popen(cmd,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE)
-        output, error = process.communicate()
-        logger.debug("o: {}".format(output))
-        if error:
-            logger.debug(error)
-        logger.debug("r: {}".format(process.returncode))
+        with CERTBOT_DURATION.labels(cmd[1] if len(cmd) > 1 else '').time():
+            process = subprocess.Popen(cmd,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE)
+            error = collections.deque(maxlen=OUTPUT_LINES)
+            # both pipes are drained at once, certbot blocks on a full pipe.
+            reader = threading.Thread(target=self._read, args=(process.stderr, 'e', error))
+            reader.daemon = True
+            reader.start()
+            output = self._read(process.stdout, 'o', collections.deque(maxlen=OUTPUT_LINES))
+            reader.join()
+            code = process.wait()
+        logger.debug("r: {}".format(code))
 
-        return output, error, process.returncode
+        return ''.join(output), ''.join(error), code
+
+    def _read(self, stream, prefix, lines):
+        for line in iter(stream.readline, b''):
+            line = to_text(line)
+            logger.debug('{}: {}'.format(prefix, line.rstrip()))
+            lines.append(line)
+        stream.close()
+        return lines
+
+    def notify(self, domains, result, testing=None):
+        for listener in self.listeners:
+            try:
+                listener(domains, result, testing)
+            except Exception as e:
+                logger.error('certbot result listener failed: {}'.format(e))
 
     def get_options(self, testing=None):
 
@@ -47,47 +369,35 @@ class CertbotClient():
 
         return ' '.join(opts)
 
-    def update_cert(self, domains, email, testing=None):
-        """
-        Update certificates
-        """
-
-        c = ''
-        if self.challenge == 'http':
-            c = "--webroot --webroot-path {}".format(self.webroot_path)
-        if self.challenge == 'dns':
-            c = "--manual --manual-public-ip-logging-ok --preferred-challenges dns --manual-auth-hook {} --manual-cleanup-hook {}".format(self.manual_auth_hook, self.manual_cleanup_hook)
+    def is_staging(self, testing=None):
+        return '--staging' in self.get_options(testing=testing).split()
 
-        output, error, code = self.run("""certbot certonly \
-                    --agree-tos \
-                    --domains {domains} \
-                    --email {email} \
-                    --expand \
-                    --noninteractive \
-                    {challenge}
-                    --debug \
-                    {options}""".format(
-                        domains=','.join(domains),
-                        email=email,
-                        webroot_path=self.webroot_path,
-                        options=self.get_options(testing=testing),
-                        challenge=c).split())
+    def issue(self, domains, email, testing=None):
+        """
+        Generate or renew certificates
 
-        ret_error = False
-        ret_created = True
+        :rtype: CertResult
+        """
+        result = self.engine.issue(domains, email, testing=testing)
+        self.notify(domains, result, testing)
+        return result
 
-        if b'urn:acme:error:unauthorized' in error:
-            logger.error('Error during ACME challenge, is the domain name associated with the right IP ?')
-            ret_error = True
-            ret_created = False
+    def update_cert(self, domains, email, testing=None):
+        """
+        Update certificates
 
-        if b'no action taken.' in output:
-            logger.debug('Nothing to do. Skipping.')
-            ret_created = False
+        :return: error, created
+        """
+        result = self.issue(domains, email, testing=testing)
+        return result.error, result.created
 
-        if code != 0:
-            logger.error('Certbot return code: {}. Skipping'.format(code))
-            ret_error = True
-            ret_created = False
+    def renew(self, lineages=None, force=False, restrict=False):
+        """
+        Renew every certificate due for renewal.
 
-        return ret_error, ret_created
+        :param lineages: domains by lineage name of the certificates due for renewal
+        :param force: renew the given lineages even if certbot does not consider them due
+        :param restrict: renew only the given lineages, not every lineage certbot considers due
+        :return: True if an error occured
+        """
+        return self.engine.renew(lineages or {}, force=force, restrict=restrict)
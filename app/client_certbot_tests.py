@@ -1,10 +1,12 @@
 import docker
 import os
 import shutil
+import sys
+import tempfile
 from mock import patch
 from unittest import TestCase
 
-from client_certbot import CertbotClient
+from client_certbot import CertbotClient, CertResult, lineage_state
 
 
 class CertbotClientTestCase(TestCase):
@@ -22,3 +24,138 @@ class CertbotClientTestCase(TestCase):
 		assert '--staging' in certbot_client.get_options(testing=None)
 		certbot_client = CertbotClient(challenge='http', webroot_path='/tmp')
 		assert '--staging' not in certbot_client.get_options(testing=None)
+
+	def test_renew_force(self):
+		certbot_client = CertbotClient(challenge='http', webroot_path='/tmp')
+		with patch.object(certbot_client, 'run', return_value=('', '', 0)) as run:
+			self.assertFalse(certbot_client.renew())
+			self.assertNotIn('--cert-name', run.call_args[0][0])
+
+			run.reset_mock()
+			self.assertFalse(certbot_client.renew({'b.domain.com': ['b.domain.com'], 'a.domain.com': ['a.domain.com']}, force=True))
+			self.assertEqual([x[0][0][x[0][0].index('--cert-name') + 1] for x in run.call_args_list], ['a.domain.com', 'b.domain.com'])
+			self.assertTrue(all('--force-renewal' in x[0][0] for x in run.call_args_list))
+
+	def test_renew_restrict(self):
+		certbot_client = CertbotClient(challenge='http', webroot_path='/tmp')
+		with patch.object(certbot_client, 'run', return_value=('', '', 0)) as run:
+			self.assertFalse(certbot_client.renew({'b.domain.com': ['b.domain.com'], 'a.domain.com': ['a.domain.com']}, restrict=True))
+		self.assertEqual([x[0][0][x[0][0].index('--cert-name') + 1] for x in run.call_args_list], ['a.domain.com', 'b.domain.com'])
+		self.assertFalse(any('--force-renewal' in x[0][0] for x in run.call_args_list))
+
+	def test_run(self):
+		certbot_client = CertbotClient(challenge='http', webroot_path='/tmp')
+		# more output than a pipe buffer on both streams
+		output, error, code = certbot_client.run([sys.executable, '-c',
+			'import sys\nfor i in range(20000):\n  sys.stdout.write("o%d\\n" % i)\n  sys.stderr.write("e%d\\n" % i)\nsys.exit(3)'])
+		self.assertEqual(code, 3)
+		self.assertEqual(output.splitlines()[-1], 'o19999')
+		self.assertEqual(error.splitlines()[-1], 'e19999')
+		self.assertEqual(len(output.splitlines()), 500)
+
+	def test_issue(self):
+		path = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, path)
+		certbot_client = CertbotClient(challenge='http', webroot_path='/tmp', path=path)
+		results = []
+		certbot_client.listeners.append(lambda domains, result, testing: results.append((domains, result.status)))
+
+		def certbot_run(version):
+			# certbot writes a new archive version and links the lineage to it
+			def run(cmd):
+				archive = os.path.join(path, 'archive', 'a.domain.com')
+				live = os.path.join(path, 'live', 'a.domain.com')
+				for folder in (archive, live):
+					if not os.path.exists(folder):
+						os.makedirs(folder)
+				link = os.path.join(live, 'fullchain.pem')
+				target = '../../archive/a.domain.com/fullchain{}.pem'.format(version)
+				if not os.path.lexists(link) or os.readlink(link) != target:
+					open(os.path.join(archive, 'fullchain{}.pem'.format(version)), 'w').close()
+					if os.path.lexists(link):
+						os.remove(link)
+					os.symlink(target, link)
+				return '', b'', 0
+			return run
+
+		with patch.object(certbot_client, 'run', certbot_run(1)):
+			self.assertEqual(certbot_client.issue(['a.domain.com'], 'email@domain.com').status, CertResult.ISSUED)
+		self.assertEqual(lineage_state(os.path.join(path, 'live'), 'a.domain.com')[0], 1)
+		with patch.object(certbot_client, 'run', certbot_run(1)):
+			self.assertEqual(certbot_client.issue(['a.domain.com'], 'email@domain.com').status, CertResult.NOOP)
+		with patch.object(certbot_client, 'run', certbot_run(2)):
+			self.assertEqual(certbot_client.issue(['a.domain.com'], 'email@domain.com').status, CertResult.ISSUED)
+		self.assertEqual([x[1] for x in results], [CertResult.ISSUED, CertResult.NOOP, CertResult.ISSUED])
+
+	def test_renew_error(self):
+		certbot_client = CertbotClient(challenge='http', webroot_path='/tmp')
+		results = []
+		certbot_client.listeners.append(lambda domains, result, testing: results.append((domains, result, testing)))
+		with patch.object(certbot_client, 'run', return_value=('', 'urn:ietf:params:acme:error:rateLimited :: too many certificates', 1)):
+			self.assertTrue(certbot_client.renew({'a.domain.com': ['a.domain.com', 'www.domain.com']}))
+		self.assertEqual(len(results), 1)
+		domains, result, testing = results[0]
+		self.assertEqual(domains, ['a.domain.com', 'www.domain.com'])
+		self.assertTrue(result.rate_limited())
+		self.assertFalse(testing)
+
+
+	def test_renew_error_batch(self):
+		certbot_client = CertbotClient(challenge='http', webroot_path='/tmp')
+		results = []
+		certbot_client.listeners.append(lambda domains, result, testing: results.append(domains))
+		output = '\n'.join([
+			'The following certificates were successfully renewed:',
+			'  /etc/letsencrypt/live/b.domain.com/fullchain.pem (success)',
+			'',
+			'The following renewals failed:',
+			'  /etc/letsencrypt/live/a.domain.com/fullchain.pem (failure)'])
+		with patch.object(certbot_client, 'run', return_value=(output, 'urn:ietf:params:acme:error:unauthorized :: invalid response', 1)):
+			self.assertTrue(certbot_client.renew({'a.domain.com': ['a.domain.com', 'www.domain.com'], 'b.domain.com': ['b.domain.com']}))
+		# the lineage renewed does not account for the failure
+		self.assertEqual(results, [['a.domain.com', 'www.domain.com']])
+
+class CertResultTestCase(TestCase):
+
+	def test_success(self):
+		self.assertEqual(CertResult.from_certbot(0, '', '', None, (1, 2, 3, 4)).status, CertResult.ISSUED)
+		self.assertEqual(CertResult.from_certbot(0, '', '', (1, 2, 3, 4), (2, 5, 3, 6)).status, CertResult.ISSUED)
+		self.assertEqual(CertResult.from_certbot(0, '', '', (1, 2, 3, 4), (1, 2, 3, 4)).status, CertResult.NOOP)
+		# lineage not found
+		self.assertEqual(CertResult.from_certbot(0, b'Certificate not yet due for renewal; no action taken.', b'').status, CertResult.NOOP)
+		self.assertEqual(CertResult.from_certbot(0, b'Congratulations!', b'').status, CertResult.ISSUED)
+
+	def test_unauthorized(self):
+		result = CertResult.from_certbot(1, b'', b'Failed authorization procedure. a.domain.com (http-01): urn:acme:error:unauthorized :: The client lacks sufficient authorization :: Invalid response\n')
+		self.assertTrue(result.error)
+		self.assertEqual(result.error_type, 'urn:acme:error:unauthorized')
+		self.assertTrue(result.validation_failed())
+		self.assertFalse(result.rate_limited())
+		self.assertEqual(result.detail, 'The client lacks sufficient authorization :: Invalid response')
+
+	def test_problem_type(self):
+		result = CertResult.from_certbot(1, '', '''
+			Certbot failed to authenticate some domains (authenticator: manual). The Certificate Authority reported these problems:
+			  Domain: a.domain.com
+			  Type:   dns
+			  Detail: DNS problem: NXDOMAIN looking up TXT for _acme-challenge.a.domain.com
+		''')
+		self.assertEqual(result.error_type, 'urn:ietf:params:acme:error:dns')
+		self.assertTrue(result.validation_failed())
+		self.assertEqual(result.detail, 'DNS problem: NXDOMAIN looking up TXT for _acme-challenge.a.domain.com')
+
+	def test_rate_limited(self):
+		result = CertResult.from_certbot(1, '', 'An unexpected error occurred:\n'
+			'urn:ietf:params:acme:error:rateLimited :: Error creating new order :: too many certificates (5) already issued '
+			'for this exact set of domains in the last 168h0m0s, retry after 2026-10-20 10:00:00 UTC: see https://letsencrypt.org/docs/rate-limits/\n')
+		self.assertTrue(result.rate_limited())
+		self.assertFalse(result.validation_failed())
+		self.assertEqual(result.retry_after, 1792490400)
+
+	def test_unknown_error(self):
+		result = CertResult.from_certbot(1, '', 'An unexpected error occurred:\nConnectionError: connection refused\n')
+		self.assertTrue(result.error)
+		self.assertIsNone(result.error_type)
+		self.assertEqual(result.detail, 'ConnectionError: connection refused')
+		self.assertEqual(CertResult.from_certbot(-9, '', '').detail, 'certbot killed by signal 9')
+
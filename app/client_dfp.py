@@ -1,26 +1,132 @@
 import os
 import requests
+import socket
+import threading
+
+from metrics import DFP_REQUEST_DURATION, DFP_REQUEST_ERRORS
+from multiprocessing.pool import ThreadPool
 
 import logging
 logger = logging.getLogger('letsencrypt')
 
 
 class DockerFlowProxyAPIClient:
-    def __init__(self, DF_PROXY_SERVICE_BASE_URL=None, adaptor=None):
+    """
+        docker-flow-proxy API client.
+
+        Requests go through a single session, connections to the proxy are
+        kept alive and reused. With `fanout`, every proxy replica (resolved
+        through the `tasks.<service>` swarm DNS entry) is called directly and
+        concurrently, instead of letting the receiving replica distribute the
+        request to the others.
+    """
+
+    def __init__(self, DF_PROXY_SERVICE_BASE_URL=None, adaptor=None, timeout=10, pool_size=10, concurrency=10, fanout=False):
         self.base_url = DF_PROXY_SERVICE_BASE_URL
         if self.base_url is None:
             self.base_url = os.environ.get('DF_PROXY_SERVICE_NAME')
 
         self.adaptor = adaptor
         if self.adaptor is None:
-            self.adaptor = requests
+            self.adaptor = requests.Session()
+            self.adaptor.mount('http://', requests.adapters.HTTPAdapter(
+                pool_connections=pool_size, pool_maxsize=pool_size))
+
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.fanout = fanout
+        self._pool = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def url(self, version, url, host=None):
+        return 'http://{}:8080/v{}/docker-flow-proxy'.format(host or self.base_url, version) + url
+
+    def hosts(self):
+        """
+            Addresses of the proxy replicas, or the service name if fanout is disabled.
+        """
+        if not self.fanout:
+            return [self.base_url]
+        try:
+            infos = socket.getaddrinfo('tasks.{}'.format(self.base_url), 8080, 0, socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            logger.warning('unable to resolve docker-flow-proxy replicas: {}'.format(e))
+            return [self.base_url]
+        return sorted(set(x[4][0] for x in infos)) or [self.base_url]
+
+    def urls(self, version, url):
+        """
+            url on every proxy replica.
+        """
+        hosts = self.hosts()
+        if len(hosts) > 1:
+            # each replica is called, they must not distribute the request again.
+            url = url.replace('distribute=true', 'distribute=false')
+        return [self.url(version, url, host) for host in hosts]
+
+    def map(self, func, items):
+        """
+            Call func on items concurrently (up to `concurrency` at once).
+        """
+        items = list(items)
+        # nested calls (e.g. put_certs retried through map) run inline, pool
+        # threads waiting for each other would deadlock.
+        if len(items) <= 1 or self.concurrency <= 1 or getattr(self._local, 'pooled', False):
+            return [func(x) for x in items]
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.concurrency)
+
+        def call(item):
+            self._local.pooled = True
+            try:
+                return func(item)
+            finally:
+                self._local.pooled = False
+        return self._pool.map(call, items)
+
+    def put_certs(self, version, paths):
+        """
+            PUT combined certificates on the proxy.
+
+            :return: paths accepted by every proxy replica
+        """
+        data = {}
+        calls = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                data[path] = f.read()
+            for url in self.urls(version, '/cert?certName={}&distribute=true'.format(os.path.basename(path))):
+                calls.append((url, path))
+
+        def put(call):
+            url, path = call
+            try:
+                return self.put(url, data=data[path], headers={'Content-Type': 'application/octet-stream'})
+            except Exception as e:
+                # a replica failing does not abort the PUT on the others.
+                logger.error('PUT {} failed: {}'.format(url, e))
+                return None
 
-    def url(self, version, url):
-        return 'http://{}:8080/v{}/docker-flow-proxy'.format(self.base_url, version) + url
+        sent = set(paths)
+        for (url, path), response in zip(calls, self.map(put, calls)):
+            if response is None:
+                sent.discard(path)
+            elif response.status_code != 200:
+                logger.error('PUT {} failed: {} {}'.format(url, response.status_code, response.text))
+                sent.discard(path)
+        return [x for x in paths if x in sent]
 
     def _request(self, method_name, url, **kwargs):
         logger.debug('[{}] {}'.format(method_name, url))
-        r = getattr(self.adaptor, method_name)(url, **kwargs)
+        kwargs.setdefault('timeout', self.timeout)
+        try:
+            with DFP_REQUEST_DURATION.labels(method_name).time():
+                r = getattr(self.adaptor, method_name)(url, **kwargs)
+        except Exception:
+            DFP_REQUEST_ERRORS.labels(method_name).inc()
+            raise
         logger.debug('     {}: {}'.format(r.status_code, r.text))
         return r
     def put(self, *args, **kwargs):
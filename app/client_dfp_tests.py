@@ -0,0 +1,147 @@
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from mock import patch
+from unittest import TestCase
+
+try:
+	from http.server import BaseHTTPRequestHandler, HTTPServer
+	from socketserver import ThreadingMixIn
+except ImportError:
+	from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+	from SocketServer import ThreadingMixIn
+
+from client_dfp import DockerFlowProxyAPIClient
+
+
+class FakeDFPServer(ThreadingMixIn, HTTPServer):
+	"""
+	Stands for docker-flow-proxy, requests are answered after `delay` seconds.
+	"""
+	daemon_threads = True
+
+	def __init__(self, delay=0):
+		HTTPServer.__init__(self, ('127.0.0.1', 0), FakeDFPHandler)
+		self.delay = delay
+		self.connections = 0
+		self.requests = []
+
+	def process_request(self, request, client_address):
+		self.connections += 1
+		return ThreadingMixIn.process_request(self, request, client_address)
+
+
+class FakeDFPHandler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def log_message(self, *args):
+		pass
+
+	def _reply(self):
+		length = int(self.headers.get('Content-Length') or 0)
+		body = self.rfile.read(length)
+		self.server.requests.append((self.command, self.path, body))
+		time.sleep(self.server.delay)
+		self.send_response(200)
+		self.send_header('Content-Length', '2')
+		self.end_headers()
+		self.wfile.write(b'OK')
+
+	do_GET = _reply
+	do_PUT = _reply
+
+
+class DockerFlowProxyAPIClientTestCase(TestCase):
+
+	def start_server(self, delay=0):
+		server = FakeDFPServer(delay)
+		thread = threading.Thread(target=server.serve_forever)
+		thread.daemon = True
+		thread.start()
+		self.addCleanup(server.server_close)
+		self.addCleanup(server.shutdown)
+		return server
+
+	def test_keep_alive(self):
+		server = self.start_server()
+		client = DockerFlowProxyAPIClient('proxy')
+		url = 'http://127.0.0.1:{}/v1/docker-flow-proxy/reconfigure'.format(server.server_address[1])
+		for i in range(5):
+			self.assertEqual(client.get(url).status_code, 200)
+		self.assertEqual(len(server.requests), 5)
+		# a single connection is used
+		self.assertEqual(server.connections, 1)
+
+	def test_timeout(self):
+		server = self.start_server(delay=1)
+		client = DockerFlowProxyAPIClient('proxy', timeout=0.1)
+		url = 'http://127.0.0.1:{}/v1/docker-flow-proxy/reconfigure'.format(server.server_address[1])
+		with self.assertRaises(Exception):
+			client.get(url)
+
+	def test_map(self):
+		server = self.start_server(delay=0.5)
+		client = DockerFlowProxyAPIClient('proxy', concurrency=5)
+		url = 'http://127.0.0.1:{}/v1/docker-flow-proxy/reconfigure'.format(server.server_address[1])
+		start = time.time()
+		responses = client.map(client.get, [url] * 5)
+		self.assertLess(time.time() - start, 2)
+		self.assertEqual([x.status_code for x in responses], [200] * 5)
+
+	def test_map_nested(self):
+		client = DockerFlowProxyAPIClient('proxy', concurrency=2)
+		result = client.map(lambda x: client.map(lambda y: x * y, [1, 2, 3]), [1, 2, 3, 4])
+		self.assertEqual(result, [[1, 2, 3], [2, 4, 6], [3, 6, 9], [4, 8, 12]])
+
+	def test_urls(self):
+		client = DockerFlowProxyAPIClient('proxy')
+		self.assertEqual(client.urls(1, '/cert?certName=a.pem&distribute=true'),
+			['http://proxy:8080/v1/docker-flow-proxy/cert?certName=a.pem&distribute=true'])
+
+	@patch('client_dfp.socket.getaddrinfo')
+	def test_urls_fanout(self, getaddrinfo):
+		getaddrinfo.return_value = [
+			(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('10.0.0.4', 8080)),
+			(socket.AF_INET, socket.SOCK_STREAM, 6, '', ('10.0.0.3', 8080)),
+		]
+		client = DockerFlowProxyAPIClient('proxy', fanout=True)
+		self.assertEqual(client.urls(1, '/cert?certName=a.pem&distribute=true'), [
+			'http://10.0.0.3:8080/v1/docker-flow-proxy/cert?certName=a.pem&distribute=false',
+			'http://10.0.0.4:8080/v1/docker-flow-proxy/cert?certName=a.pem&distribute=false',
+		])
+		getaddrinfo.assert_called_once_with('tasks.proxy', 8080, 0, socket.SOCK_STREAM)
+
+		getaddrinfo.side_effect = socket.gaierror('not found')
+		self.assertEqual(client.urls(1, '/reconfigure'), ['http://proxy:8080/v1/docker-flow-proxy/reconfigure'])
+
+	def test_put_certs(self):
+		server = self.start_server()
+		tmp = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, tmp)
+		paths = []
+		for domain in ('a.domain.com', 'b.domain.com'):
+			paths.append(os.path.join(tmp, '{}.pem'.format(domain)))
+			with open(paths[-1], 'wb') as f:
+				f.write(domain.encode())
+
+		client = DockerFlowProxyAPIClient('127.0.0.1')
+		with patch.object(client, 'url', lambda version, url, host=None:
+				'http://127.0.0.1:{}/v{}/docker-flow-proxy{}'.format(server.server_address[1], version, url)):
+			self.assertEqual(client.put_certs(1, paths), paths)
+
+			# a replica not answering does not abort the others
+			put = client.put
+			def refused(url, **kwargs):
+				if 'a.domain.com' in url:
+					raise socket.error('connection refused')
+				return put(url, **kwargs)
+			with patch.object(client, 'put', refused):
+				self.assertEqual(client.put_certs(1, paths), paths[1:])
+		self.assertEqual(sorted(server.requests), [
+			('PUT', '/v1/docker-flow-proxy/cert?certName=a.domain.com.pem&distribute=true', b'a.domain.com'),
+			('PUT', '/v1/docker-flow-proxy/cert?certName=b.domain.com.pem&distribute=true', b'b.domain.com'),
+			('PUT', '/v1/docker-flow-proxy/cert?certName=b.domain.com.pem&distribute=true', b'b.domain.com'),
+		])
@@ -1,19 +1,64 @@
+import collections
+import copy
 import datetime
+import docker
 import json
 import os
+import threading
+from attachments import SecretAttachmentReconciler, ServiceUpdateError, secret_file_name
+from cert_index import CertIndex
 from client_certbot import CertbotClient
 from client_dfp import DockerFlowProxyAPIClient
+from docker_cache import DockerCache
+from metrics import DOCKER_API_DURATION
+from multiprocessing.pool import ThreadPool
+from pemfiles import digest, replace_symlink, write_concat
+from ratelimit import RateLimiter, RateLimitExceeded
+from secrets_gc import SecretGarbageCollector
+from state_store import DeployStateStore
 
 import logging
 logger = logging.getLogger('letsencrypt')
 
 
+# label of certificate secrets holding the combined certificate fingerprint.
+FINGERPRINT_LABEL = 'com.df.letsencrypt.fingerprint'
+# prefix of the service labels requesting certificates.
+LABEL_PREFIX = 'com.df.letsencrypt.'
+
 combined_cert_type = ('combined', 'pem')
 cert_types = [
     combined_cert_type,
     ('fullchain', 'crt'),
     ('privkey', 'key')]
 
+def request_key(domains, email, testing=None):
+    """
+        Normalized identifier of a certificate request, two requests having
+        the same key produce the same certificate.
+
+        testing None (server chosen by CERTBOT_OPTIONS, possibly --staging)
+        is kept apart from False (production server).
+    """
+    domains = sorted(set(d.strip().lower() for d in domains if d.strip()))
+    return (tuple(domains), email.strip().lower(), None if testing is None else bool(testing))
+
+def service_request(service):
+    """
+        Certificate request of a service, from its `com.df.letsencrypt.*` labels.
+
+        :return: (domains, email, testing), None if the service does not use letsencrypt
+    """
+    labels = service.attrs.get('Spec', {}).get('Labels') or {}
+    host = labels.get(LABEL_PREFIX + 'host')
+    email = labels.get(LABEL_PREFIX + 'email')
+    if not host or not email:
+        return None
+    testing = labels.get(LABEL_PREFIX + 'testing')
+    if testing is not None:
+        testing = testing.lower() == 'true'
+    return [x.strip() for x in host.split(',') if x.strip()], email, testing
+
 class DFPLEClient():
 
     def __init__(self, **kwargs):
@@ -21,31 +66,80 @@ class DFPLEClient():
 
         self.docker_client = kwargs.get('docker_client')
         self.docker_socket_path = kwargs.get('docker_socket_path')
+        # secrets and services lookups are answered from memory.
+        self.docker_cache = None
+        if self.docker_client is not None and kwargs.get('docker_cache', True):
+            self.docker_cache = DockerCache(self.docker_client)
         # XXX-YYYYMMDD-HHMMSS
         self.size_secret = 64 - 16
 
+        self.certbot_folder = kwargs.get('certbot_path')
         self.certbot = CertbotClient(
+            bin=kwargs.get('certbot_bin', 'certbot'),
+            path=self.certbot_folder,
+            engine=kwargs.get('certbot_engine', 'certbot'),
             challenge=kwargs.get('certbot_challenge'),
             webroot_path=kwargs.get('certbot_webroot_path'),
             options=kwargs.get('certbot_options', ''),
             manual_auth_hook=kwargs.get('certbot_manual_auth_hook'),
-            manual_cleanup_hook=kwargs.get('certbot_manual_cleanup_hook')
+            manual_cleanup_hook=kwargs.get('certbot_manual_cleanup_hook'),
+            renew_before=kwargs.get('certbot_renew_before', 30),
+            acme_directory_url=kwargs.get('acme_directory_url'),
+            acme_staging_directory_url=kwargs.get('acme_staging_directory_url'),
+            dns_provider=kwargs.get('dns_provider'),
+            dns_challenge_state=kwargs.get('dns_challenge_state'),
+            dns_propagation_timeout=kwargs.get('dns_propagation_timeout', 300),
+            dns_propagation_nameservers=kwargs.get('dns_propagation_nameservers'),
             )
-        self.certbot_folder = kwargs.get('certbot_path')
+        self.cert_index = CertIndex(
+            self.certbot_folder,
+            renew_before=kwargs.get('certbot_renew_before', 30))
+
+        # certificate deployed for each domain, compared to docker on start.
+        self.deploy_state = DeployStateStore(self.certbot_folder, kwargs.get('deploy_state_file'))
+        # failed requests are submitted again on renewal, for up to failed_requests_max_age seconds.
+        self.failed_requests_max_age = kwargs.get('failed_requests_max_age', 7 * 86400)
+
+        # certificates of different domains are issued concurrently, up to issue_concurrency at once.
+        self.issue_concurrency = kwargs.get('issue_concurrency', 1)
+        self._issue_slots = threading.BoundedSemaphore(self.issue_concurrency)
+        self._lineage_locks = collections.defaultdict(threading.Lock)
+        self._distribute_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self.rate_limiter = kwargs.get('rate_limiter') or RateLimiter()
+        self.certbot.listeners.append(self.certbot_result)
 
         self.dfp_service_name = kwargs.get('dfp_service_name', None)
 
-        self.dfp_client = DockerFlowProxyAPIClient()
-
-        # self.domains = kwargs.get('domains', [])
-        # self.email = kwargs.get('email')
-        # self.certs = {}
-        # self.certs_created = False
-        # self.secrets = {}
-        # self.secrets_created = False
-
-        # self.initial_checks()
-
+        self.dfp_client = kwargs.get('dfp_client') or DockerFlowProxyAPIClient()
+        # RetryScheduler of the PUT requests that failed, not retried if None.
+        self.retries = kwargs.get('retries')
+
+        # secrets attached to the dfp service are updated in batch.
+        self.attachments = SecretAttachmentReconciler(
+            self,
+            debounce=kwargs.get('dfp_update_debounce', 0),
+            retries=kwargs.get('dfp_update_retries', 5))
+        self.attachments.listeners.append(self.attachments_updated)
+
+        # superseded secrets are removed after each dfp service update, and
+        # every secrets_gc_interval seconds.
+        self.secrets_gc = None
+        self.secrets_gc_interval = kwargs.get('secrets_gc_interval', 0)
+        if self.docker_client is not None and kwargs.get('secrets_gc', False):
+            self.secrets_gc = SecretGarbageCollector(
+                self,
+                keep=kwargs.get('secrets_gc_keep', 2),
+                dry_run=kwargs.get('secrets_gc_dry_run', False),
+                batch_size=kwargs.get('secrets_gc_batch_size', 50))
+            self.attachments.listeners.append(self.secrets_gc.run)
+
+    def lineage_lock(self, name):
+        with self._lock:
+            return self._lineage_locks[name]
+
+    def rate_limit_account(self, testing=None):
+        return 'staging' if self.certbot.is_staging(testing) else 'production'
 
     def certs(self, domains):
         certs = {}
@@ -57,20 +151,141 @@ class DFPLEClient():
                     certs[domain].append(dest_file)
         return certs
 
+    def start(self):
+        """
+            Start background tasks.
+        """
+        if self.docker_cache is not None:
+            self.docker_cache.start()
+        try:
+            self.reconcile_state()
+        except Exception as e:
+            logger.error('unable to compare deploy state to docker: {}'.format(e))
+        if self.secrets_gc is not None and self.secrets_gc_interval > 0:
+            self.secrets_gc.start(self.secrets_gc_interval)
+
+    def reconcile_state(self):
+        """
+            Compare the deploy state to the secrets and the dfp service, with
+            a single listing of each: deployments whose secret has been
+            removed (e.g. swarm re-initialized) are deployed again on next
+            request, the attached status is refreshed.
+
+            :return: number of deployments updated
+        """
+        if self.docker_client is None:
+            return 0
+        deployments = self.deploy_state.all()
+        existing = set(x.id for x in self.secrets())
+        missing = [domain for domain, entry in deployments.items()
+                   if entry['secret_id'] is not None and entry['secret_id'] not in existing]
+        if missing:
+            self.deploy_state.forget_secrets(missing)
+
+        services = self.services(self.dfp_service_name) if self.dfp_service_name else []
+        changed = 0
+        if services:
+            changed = self.deploy_state.set_attached(x.get('SecretID') for x in self.service_get_secrets(services[0]))
+        logger.info('deploy state loaded: {} domains, {} secrets missing, {} attachments changed.'.format(
+            len(deployments), len(missing), changed))
+        return len(missing) + changed
+
+    def certbot_result(self, domains, result, testing=None):
+        """
+            Account for the validations and orders refused by the ACME server.
+        """
+        account = self.rate_limit_account(testing)
+        if result.validation_failed():
+            self.rate_limiter.failed(account, domains)
+        if result.rate_limited():
+            self.rate_limiter.postpone(account, domains, result.retry_after)
+
+    def attachments_updated(self):
+        self.deploy_state.set_attached(x.get('SecretID') for x in self.attachments.applied or [])
+
+    def deployed(self, domains, testing=None):
+        """
+            Check if the certificate of domains is up to date and deployed
+            (attached to the DFP service when using secrets) for each domain.
+        """
+        if self.cert_index.needs_update(domains, self.certbot.is_staging(testing)) is not None:
+            return False
+        for domain, certs in self.certs(domains).items():
+            entry = self.deploy_state.get(domain)
+            combined = [x for x in certs if '.pem' in x]
+            if entry is None or not combined or (self.docker_client is not None and not entry['attached']):
+                return False
+            if digest(combined[:1]) != entry['fingerprint']:
+                return False
+        return True
+
+    def record_deployment(self, domain, combined, fingerprint, secret=None, attached=False):
+        # combined certificates link to <certbot_path>/live/<lineage>/combined.pem
+        lineage = os.path.basename(os.path.dirname(os.path.realpath(combined)))
+        entry = self.cert_index.entries.get(lineage) or {}
+        self.deploy_state.record(domain, fingerprint, lineage=lineage, not_after=entry.get('not_after'),
+            secret=secret, attached=attached)
+
     def secrets(self, domain=None):
-        secrets = []
-        attrs = {}
+        """
+            Combined certificate secrets of the given domain, oldest first.
+        """
+        name = None
         if domain is not None:
-            attrs['filters'] = {"name": self.get_secret_name_short('{}.pem'.format(domain))}
-        return self.docker_client.secrets.list(**attrs)
+            name = self.get_secret_name_short('{}.pem'.format(domain))
+        if self.docker_cache is not None:
+            return self.docker_cache.secrets(name)
+        attrs = {}
+        if name is not None:
+            attrs['filters'] = {"name": name}
+        with DOCKER_API_DURATION.labels('secrets.list').time():
+            return self.docker_client.secrets.list(**attrs)
 
     def services(self, name, exact_match=True):
-        services = self.docker_client.services.list(
-            filters={'name': name})
+        if self.docker_cache is not None and exact_match:
+            service = self.docker_cache.service(name)
+            return [service] if service is not None else []
+        with DOCKER_API_DURATION.labels('services.list').time():
+            services = self.docker_client.services.list(
+                filters={'name': name})
         if exact_match:
             services = [x for x in services if x.name == name]
         return services
 
+    def put_certs(self, version, puts):
+        """
+            PUT combined certificates on DFP, and record the deployment of
+            the accepted ones.
+
+            :param puts: list of (domain, combined path, fingerprint), the
+                accepted certificates are removed from it
+            :return: True if every certificate has been accepted
+        """
+        sent = self.dfp_client.put_certs(version, [x[1] for x in puts])
+        for put in list(puts):
+            domain, combined, fingerprint = put
+            if combined in sent:
+                self.record_deployment(domain, combined, fingerprint, attached=True)
+                puts.remove(put)
+            else:
+                logger.error('Request PUT /cert for {} failed.'.format(domain))
+        if sent:
+            logger.info('Request PUT /cert sucessfully send to DFP: {}.'.format(
+                ', '.join(os.path.basename(x) for x in sent)))
+        return not puts
+
+    def requested_lineages(self):
+        """
+            Lineages of the certificates requested by service labels, None if
+            unknown (no docker client).
+        """
+        if self.docker_client is None:
+            return None
+        with DOCKER_API_DURATION.labels('services.list').time():
+            services = self.docker_client.services.list()
+        requests = [service_request(x) for x in services]
+        return set(x[0][0] for x in requests if x is not None and x[0])
+
     def service_get_secrets(self, service):
         return service.attrs['Spec']['TaskTemplate']['ContainerSpec'].get('Secrets', [])
 
@@ -84,29 +299,128 @@ class DFPLEClient():
         return secret_name
 
     def service_update_secrets(self, service, secrets):
-        spec = service.attrs['Spec']
-        container_spec = spec['TaskTemplate']['ContainerSpec']
-        container_spec['Secrets'] = secrets
+        """
+            Replace the secrets of the given service.
 
-        cmd = """curl -X POST -H "Content-Type: application/json" --unix-socket {socket} http:/1.25/services/{service_id}/update?version={version} -d '{data}'""".format(
-            data=json.dumps(spec), socket=self.docker_socket_path, service_id=service.id, version=service.attrs['Version']['Index'])
-        logger.debug('EXEC {}'.format(cmd))
-        code = os.system(cmd)
+            :raises ServiceUpdateError: if the docker engine refused the update,
+                with conflict set if the service has been updated in between.
+        """
+        spec = copy.deepcopy(service.attrs['Spec'])
+        spec['TaskTemplate']['ContainerSpec']['Secrets'] = secrets
+        version = service.attrs['Version']['Index']
+
+        # the whole spec is posted: service.update and APIClient.update_service rebuild it
+        # from a subset of fields, and refuse fields newer than the API version in use
+        # (UpdateConfig.Order, RollbackConfig), see https://github.com/docker/docker-py/issues/1503
+        api = self.docker_client.api
+        url = '{}/v{}/services/{}/update'.format(api.base_url, api.api_version, service.id)
+        logger.debug('updating service {} version {}'.format(service.id, version))
+        try:
+            with DOCKER_API_DURATION.labels('services.update').time():
+                response = api.post(url, data=json.dumps(spec), params={'version': version},
+                    headers={'Content-Type': 'application/json'})
+            if response.status_code >= 400:
+                raise docker.errors.APIError(
+                    '{} {}'.format(response.status_code, response.reason), response=response,
+                    explanation=self.docker_error_message(response))
+        except docker.errors.DockerException as e:
+            response = getattr(e, 'response', None)
+            explanation = getattr(e, 'explanation', None)
+            raise ServiceUpdateError(
+                'service {} update failed: {}'.format(service.id, explanation or e),
+                status_code=response.status_code if response is not None else None,
+                explanation=explanation)
+        finally:
+            # updated or out of date, the service has to be fetched again.
+            if self.docker_cache is not None:
+                self.docker_cache.invalidate_service(spec['Name'])
+
+        warnings = (response.json() or {}).get('Warnings') if response.content else None
+        for warning in warnings or []:
+            logger.warning('service {} update: {}'.format(service.id, warning))
+
+    @staticmethod
+    def docker_error_message(response):
+        try:
+            return (response.json() or {}).get('message') or response.text
+        except ValueError:
+            return response.text
+
+    def secret_fingerprint(self, domain, secret):
+        """
+            Fingerprint of the combined certificate held by secret, None if unknown.
+        """
+        labels = secret.attrs.get('Spec', {}).get('Labels') or {}
+        return labels.get(FINGERPRINT_LABEL) or self.deploy_state.fingerprint(domain, secret=secret.name)
 
-    def secret_create(self, secret_name, secret_data):
+    def secret_create(self, secret_name, secret_data, labels=None):
 
         secret_name = self.get_secret_name(secret_name)
 
         # create secret.
         logger.debug('creating secret {}'.format(secret_name))
-        secret = self.docker_client.secrets.create(
-            name=secret_name,
-            data=secret_data)
+        with DOCKER_API_DURATION.labels('secrets.create').time():
+            secret = self.docker_client.secrets.create(
+                name=secret_name,
+                data=secret_data,
+                labels=labels)
         logger.debug('secret created {}'.format(secret.id))
 
         secret = self.docker_client.secrets.get(secret.id)
+        if self.docker_cache is not None:
+            self.docker_cache.add_secret(secret)
         return secret
 
+    def generate_combined(self, domains):
+        """
+            Generate the combined certificate needed by haproxy for the lineage
+            of the given domains, and link it for each domain.
+        """
+        certs = {}
+
+        # if multiple domains comma separated, take only the first one
+        base_domain = domains[0]
+
+        # generate combined certificate needed for haproxy, replaced atomically
+        # so that readers never see a partially written file.
+        lineage_path = os.path.join(self.certbot_folder, 'live', base_domain)
+        combined_path = os.path.join(lineage_path, "combined.pem")
+        if write_concat(combined_path, [
+                os.path.join(lineage_path, "fullchain.pem"),
+                os.path.join(lineage_path, "privkey.pem")]):
+            logger.info('combined certificate generated into "{}".'.format(combined_path))
+        else:
+            logger.debug('combined certificate "{}" unchanged.'.format(combined_path))
+
+        # for each domain, link the main combined cert.
+        for domain in domains:
+            certs[domain] = []
+            cert_type, cert_extension = combined_cert_type
+            dest_file = os.path.join(self.certbot_folder, "{}.{}".format(domain, cert_extension))
+
+            replace_symlink(
+                os.path.join('./live', base_domain, "{}.pem".format(cert_type)),
+                dest_file)
+
+            certs[domain].append(dest_file)
+
+        return certs
+
+    def current_certs(self, domains, testing=None):
+        """
+            Certificates of domains if the local certificate is valid for long
+            enough, None if certbot has to be called.
+        """
+        reason = self.cert_index.needs_update(domains, self.certbot.is_staging(testing))
+        if reason is None:
+            certs = self.certs(domains)
+            if all(any(x.endswith('.pem') for x in certs[domain]) for domain in domains):
+                logger.debug('certificate up to date, skipping certbot.')
+                return certs
+            reason = 'combined certificate missing'
+        logger.debug('certbot required: {}'.format(reason))
+        return None
+
     def generate_certificates(self, domains, email, testing=None):
         """
             Generate or renew certificates for given domains
@@ -124,84 +438,195 @@ class DFPLEClient():
             certs[domain] = []
 
         logger.debug('Generating certificates domains:{} email:{} testing:{}'.format(domains, email, testing))
-        error, created = self.certbot.update_cert(domains, email, testing)
 
-        if error and not created:
-            logger.error('Error while generating certs for {}'.format(domains))
+        with self.lineage_lock(domains[0]):
+            current = self.current_certs(domains, testing)
+        if current is not None:
+            return current, False
 
-        elif not error and not created:
-            logger.debug('nothing to do')
-            certs = self.certs(domains)
+        # waiting for the rate limit holds neither the lineage lock nor an
+        # issue slot, other issuances go on meanwhile.
+        self.rate_limiter.acquire(self.rate_limit_account(testing), domains)
 
-        elif created:
-            logger.info('certificates successfully created using certbot.')
+        with self.lineage_lock(domains[0]):
+            # issued by a concurrent request in between.
+            current = self.current_certs(domains, testing)
+            if current is not None:
+                return current, False
 
-            # if multiple domains comma separated, take only the first one
-            base_domain = domains[0]
+            with self._issue_slots:
+                result = self.certbot.issue(domains, email, testing)
+            error, created = result.error, result.created
 
-            # generate combined certificate needed for haproxy
-            combined_path = os.path.join(self.certbot_folder, 'live', base_domain, "combined.pem")
-            with open(combined_path, "w") as combined, \
-                 open(os.path.join(self.certbot_folder, 'live', base_domain, "privkey.pem"), "r") as priv, \
-                 open(os.path.join(self.certbot_folder, 'live', base_domain, "fullchain.pem"), "r") as fullchain:
+            if error and not created:
+                logger.error('Error while generating certs for {}'.format(domains))
 
-                combined.write(fullchain.read())
-                combined.write(priv.read())
-                logger.info('combined certificate generated into "{}".'.format(combined_path))
+            elif not error and not created:
+                logger.debug('nothing to do')
+                certs = self.certs(domains)
 
-            # for each domain, create a symlink for main combined cert.
-            for domain in domains:
-                cert_type, cert_extension = combined_cert_type
-                dest_file = os.path.join(self.certbot_folder, "{}.{}".format(domain, cert_extension))
+            elif created:
+                logger.info('certificates successfully created using certbot.')
 
-                if os.path.exists(dest_file):
-                    os.remove(dest_file)
+                certs = self.generate_combined(domains)
 
-                # generate symlinks
-                os.symlink(
-                    os.path.join('./live', base_domain, "{}.pem".format(cert_type)),
-                    dest_file)
+            return certs, created
 
-                certs[domain].append(dest_file)
+    def renew(self, version='1', names=None):
+        """
+            Renew every lineage due for renewal using a single certbot run,
+            then distribute renewed certificates to DFP at once.
 
-        return certs, created
+            Requests that failed before their certificate was ever issued are
+            retried too, unless names is given.
+
+            :param names: lineages to renew, whether due or not (see RenewalScheduler)
+            :return: List of renewed lineages
+            :rtype: list of string
+        """
+        if names is None:
+            self.retry_failed(version)
+
+        self.cert_index.refresh()
+        # job threads refresh the index meanwhile, entries are read from a copy.
+        entries = self.cert_index.snapshot()
+        if names is not None:
+            due = [name for name in names if 'error' not in entries.get(name, {'error': None})]
+        else:
+            due = [name for name, entry in entries.items()
+                   if 'error' not in entry and self.cert_index.needs_update([name] + entry['domains'])]
+        if not due:
+            logger.info('no certificate due for renewal.')
+            return []
+
+        postponed = False
+        for name in list(due):
+            entry = entries[name]
+            try:
+                self.rate_limiter.acquire(self.rate_limit_account(entry.get('staging')), entry['domains'])
+            except RateLimitExceeded as e:
+                logger.error('{}, renewal postponed.'.format(e))
+                due.remove(name)
+                postponed = True
+        if not due:
+            return []
+
+        logger.info('renewing certificates: {}'.format(', '.join(due)))
+        fingerprints = dict((name, entry.get('fingerprint')) for name, entry in entries.items())
+
+        # once a lineage is postponed, certbot must not renew every lineage it considers due.
+        if self.certbot.renew(dict((name, entries[name]['domains']) for name in due),
+                              force=names is not None, restrict=postponed):
+            logger.error('Error while renewing certificates, distributing the renewed ones.')
+
+        self.cert_index.refresh()
+        entries = self.cert_index.snapshot()
+        renewed = [name for name, entry in entries.items()
+                   if 'fingerprint' in entry and entry['fingerprint'] != fingerprints.get(name)]
+
+        certs = {}
+        for name in renewed:
+            domains = [name] + [x for x in entries[name]['domains'] if x != name]
+            # a request for the same lineage may be issuing it meanwhile.
+            with self.lineage_lock(name):
+                certs.update(self.generate_combined(domains))
+
+        if certs:
+            self.distribute(certs, True, version)
+        logger.info('{} certificates renewed.'.format(len(renewed)))
+        return renewed
 
     def process(self, domains, email, version='1', testing=None):
         logger.info('Letsencrypt support enabled, processing request: domains={} email={} testing={}'.format(','.join(domains), email, testing))
 
-        certs, created = self.generate_certificates(domains, email, testing)
+        key = request_key(domains, email, testing)
+        try:
+            certs, created = self.generate_certificates(domains, email, testing)
+            self.distribute(certs, created, version)
+        except Exception as e:
+            self.deploy_state.record_request(key, domains, email, testing, error=e)
+            raise
+        self.deploy_state.record_request(key, domains, email, testing)
+
+    def retry_failed(self, version='1'):
+        """
+            Submit again the requests whose last attempt failed.
+
+            :return: requests still failing
+        """
+        requests = self.deploy_state.failed_requests(self.failed_requests_max_age)
+        if not requests:
+            return []
+        logger.info('retrying failed requests: {}'.format(' '.join(','.join(x[0]) for x in requests)))
+        errors = self.process_many(requests, version)
+        return [request for request, error in zip(requests, errors) if error is not None]
+
+    def process_many(self, requests, version='1'):
+        """
+            Process several requests concurrently, up to issue_concurrency at once.
+
+            :param requests: list of (domains, email, testing)
+            :return: exception raised by each request, None if processed successfully
+            :rtype: list
+        """
+        def process(request):
+            domains, email, testing = request
+            try:
+                self.process(domains, email, version=version, testing=testing)
+            except Exception as e:
+                logger.error('Error while processing {}: {}'.format(','.join(domains), e))
+                return e
+
+        pool = ThreadPool(self.issue_concurrency)
+        try:
+            return pool.map(process, requests)
+        finally:
+            pool.close()
+            pool.join()
+
+    def distribute(self, certs, created, version='1'):
+        """
+            Send certificates to DFP, either using PUT requests or docker secrets.
+
+            :param certs: certificates path by domain
+            :param created: certificates have just been generated
+        """
+        # dfp service and secrets state is shared, distribute one request at a time.
+        with self._distribute_lock:
+            self._distribute(certs, created, version)
 
-        secrets_changed = False
+    def _distribute(self, certs, created, version='1'):
         if self.docker_client != None:
             self.dfp = self.services(self.dfp_service_name)[0]
-            self.dfp_secrets = self.service_get_secrets(self.dfp)
+            # take into account changes not applied yet to the dfp service.
+            self.dfp_secrets = self.attachments.apply(self.service_get_secrets(self.dfp))
 
+        # combined certificates to PUT on dfp, sent concurrently once all are known.
+        puts = []
         for domain, certs in certs.items():
 
             combined = [x for x in certs if '.pem' in x]
             if len(combined) == 0:
                 logger.error('Combined certificate not found. Check logs for errors.')
-                # raise Exception to make a 500 response to dpf, and make it retry the request later.
+                # raise Exception to mark the job as failed, the request is retried on next renewal (see retry_failed).
                 raise Exception('Combined cert not found')
             combined = combined[0]
+            fingerprint = digest([combined])
 
             if self.docker_client == None:
                 if created:
                     # no docker client provided, use docker-flow-proxy PUT request to update certificate
-                    self.dfp_client.put(
-                        self.dfp_client.url(
-                            version,
-                            '/cert?certName={}&distribute=true'.format(os.path.basename(combined))),
-                        data=open(combined, 'rb').read(),
-                        headers={'Content-Type': 'application/octet-stream'})
-                    logger.info('Request PUT /cert sucessfully send to DFP.')
+                    if self.deploy_state.fingerprint(domain) == fingerprint:
+                        logger.info('certificate of {} already sent to DFP, not sent again.'.format(domain))
+                    else:
+                        puts.append((domain, combined, fingerprint))
 
             else:
                 # docker engine is provided, manage certificates as docker secrets
 
                 # check that there is an existing secret for the combined cert
                 # secret_combined_found = any([x.name.startswith('{}.pem'.format(domain)[-self.size_secret:]) for x in self.secrets])
-                self._secrets = self.secrets('{}.pem'.format(domain))
+                self._secrets = self.secrets(domain)
                 secret_combined_found = False
                 if len(self._secrets):
                     secret = self._secrets[-1]
@@ -210,41 +635,39 @@ class DFPLEClient():
 
                 # check that an already existing secret for the combined cert is attached to dfp service.
                 # secret_combined_attached = any([x['File']['Name'] == 'cert-{}'.format(domain) for x in self.secrets_dfp])
-                secret_combined_attached = any([x['File']['Name'] == 'cert-{}'.format(domain) for x in self.dfp_secrets])
+                attached = [x['SecretName'] for x in self.dfp_secrets if x['File']['Name'] == secret_file_name(domain)]
+                secret_combined_attached = len(attached) > 0
 
-                logger.debug('cert_created={} secret_found={} secret_attached={}'.format(created, secret_combined_found, secret_combined_attached))
+                # the latest secret already holds this certificate.
+                secret_combined_deployed = secret_combined_found and \
+                    self.secret_fingerprint(domain, secret) == fingerprint
 
-                if created or not secret_combined_found:
+                logger.debug('cert_created={} secret_found={} secret_attached={} secret_deployed={}'.format(
+                    created, secret_combined_found, secret_combined_attached, secret_combined_deployed))
+
+                if (created and not secret_combined_deployed) or not secret_combined_found:
                     # create secret
                     secret_cert = '{}.pem'.format(domain)
                     logger.info('creating secret for cert {}'.format(secret_cert))
-                    secret = self.secret_create(
-                            secret_cert,
-                            open(combined, 'rb').read())
+                    with open(combined, 'rb') as f:
+                        secret = self.secret_create(secret_cert, f.read(), labels={FINGERPRINT_LABEL: fingerprint})
                     self._secrets.append(secret)
+                    self.record_deployment(domain, combined, fingerprint, secret=secret, attached=False)
+                elif secret_combined_deployed and self.deploy_state.fingerprint(domain, secret=secret.name) is None:
+                    # fingerprint only known from the secret label
+                    self.record_deployment(domain, combined, fingerprint, secret=secret, attached=secret.name in attached)
 
-                if created or not secret_combined_attached:
+                if secret.name not in attached:
                     # attach secret
                     logger.info('attaching secret {}'.format(secret.name))
 
-                    # remove secrets already attached to the dfp service that are for the same domain.
-                    self.dfp_secrets = [x for x in self.dfp_secrets if not x['SecretName'].startswith(domain)]
-
-                    # append the secret
-                    secrets_changed = True
-                    self.dfp_secrets.append({
-                        'SecretID': secret.id,
-                        'SecretName': secret.name,
-                        'File': {
-                            'Name': 'cert-{}'.format(domain),
-                            'UID': '0',
-                            'GID': '0',
-                            'Mode': 0}
-                        })
-
-        if secrets_changed:
-            logger.debug('secrets changed, updating dfp service...')
-            # I cannot understand how to use the service.update method, use a POST request against docker socket instead
-            # see https://github.com/docker/docker-py/issues/1503
-            # self.dfp.update(name=self.dfp.attrs['Spec']['Name'], networks=self.dfp.attrs['Spec']['Networks'], secrets=self.secrets_dfp)
-            self.service_update_secrets(self.dfp, self.dfp_secrets)
+                    # replace the secret already attached to the dfp service for the same domain.
+                    self.attachments.attach(domain, secret)
+                    self.dfp_secrets = self.attachments.apply(self.dfp_secrets)
+
+        if puts and not self.put_certs(version, puts) and self.retries is not None:
+            self.retries.schedule(self.put_certs, args=(version, puts),
+                description='PUT /cert for {}'.format(', '.join(x[0] for x in puts)))
+
+        if self.docker_client != None:
+            self.attachments.commit()
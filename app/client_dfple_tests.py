@@ -1,10 +1,19 @@
 import docker
+import json
 import os
+import requests
 import shutil
-from mock import patch
+import tempfile
+import threading
+import time
+from mock import MagicMock, patch
 from unittest import TestCase
 
-from client_dfple import DFPLEClient
+from cert_index_tests import generate_cert
+from client_certbot import CertResult, Engine
+from attachments import ServiceUpdateError
+from client_dfple import DFPLEClient, request_key
+from ratelimit import RateLimiter
 
 import logging
 logging.basicConfig(level=logging.ERROR, format="%(levelname)s;%(asctime)s;%(message)s")
@@ -36,13 +45,19 @@ CERTBOT_OUTPUT = {
 }
 
 
+def response(status_code, content):
+	response = requests.Response()
+	response.status_code = status_code
+	response._content = content
+	return response
+
+
 class DFPLEClientTestCase(TestCase):
 
 	def setUp(self):
-		self.certbot_path = '/tmp'
-		tmp_path = os.path.join(self.certbot_path, 'live')
-		if os.path.exists(tmp_path):
-			shutil.rmtree(tmp_path)
+		# the client keeps its state (dfple-state.db, dfple-index.json) in certbot_path
+		self.certbot_path = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, self.certbot_path)
 
 	def letsencrypt_mock(self, domains, output, error, code, tmp_files=None):
 
@@ -91,7 +106,7 @@ class VolumeTestCase(DFPLEClientTestCase):
 			self.assertFalse(any(['{}.pem'.format(d) in x for x in certs[d]]))
 
 		with patch.object(self.client.certbot, 'run', lambda cmd: self.letsencrypt_mock(self.domains, CERTBOT_OUTPUT['ok'], '', 0)), \
-			patch.object(self.client.dfp_client, 'put', lambda url, data=None, headers=None: None):
+			patch.object(self.client.dfp_client, 'put', lambda url, data=None, headers=None: response(200, b'')):
 			self.client.process(self.domains, self.email)
 
 		# check certs exist
@@ -115,7 +130,7 @@ class VolumeTestCase(DFPLEClientTestCase):
 
 		error_occured = False
 		with patch.object(self.client.certbot, 'run', lambda cmd: self.letsencrypt_mock(self.domains, '', '', 1)), \
-			patch.object(self.client.dfp_client, 'put', lambda url, data=None, headers=None: None):
+			patch.object(self.client.dfp_client, 'put', lambda url, data=None, headers=None: response(200, b'')):
 
 			try:
 				self.client.process()
@@ -124,6 +139,29 @@ class VolumeTestCase(DFPLEClientTestCase):
 
 		self.assertTrue(error_occured)
 
+	def test_certbot_skipped(self):
+		"""
+		initial context:
+		  * certs are already present in certbot volume and far from expiry
+		"""
+		base_path = os.path.join(self.certbot_path, 'live', self.domains[0])
+		generate_cert(base_path, self.domains)
+		open(os.path.join(base_path, 'combined.pem'), 'a').close()
+		combined = os.path.join(self.certbot_path, '{}.pem'.format(self.domains[0]))
+		if not os.path.lexists(combined):
+			os.symlink(os.path.join('./live', self.domains[0], 'combined.pem'), combined)
+
+		self.client = DFPLEClient(**self.client_attrs)
+
+		def certbot_run(cmd):
+			raise Exception('certbot should not be called')
+
+		with patch.object(self.client.certbot, 'run', certbot_run):
+			certs, created = self.client.generate_certificates(self.domains, self.email)
+
+		self.assertFalse(created)
+		self.assertIn(combined, certs[self.domains[0]])
+
 
 
 class SecretsTestCase(DFPLEClientTestCase):
@@ -293,4 +331,350 @@ class SecretsTestCase(DFPLEClientTestCase):
 			for d in self.domains:
 				self.assertTrue(any([d in x.name for x in self.client._secrets]))
 				print('ee', self.client.dfp_secrets)
-				self.assertTrue(any(['{}.pem'.format(d) == x['SecretName'] for x in self.client.dfp_secrets]))
\ No newline at end of file
+				self.assertTrue(any(['{}.pem'.format(d) == x['SecretName'] for x in self.client.dfp_secrets]))
+
+class RequestKeyTestCase(TestCase):
+
+	def test_request_key(self):
+		self.assertEqual(
+			request_key(['b.domain.com', 'A.domain.com '], 'Email@domail.com', False),
+			request_key(['a.domain.com', 'b.domain.com', 'b.domain.com'], 'email@domail.com', 0))
+		self.assertNotEqual(
+			request_key(['a.domain.com'], 'email@domail.com'),
+			request_key(['a.domain.com'], 'email@domail.com', True))
+
+	def test_request_key_testing_default(self):
+		# without testing, the server is chosen by CERTBOT_OPTIONS and may be the staging one
+		self.assertEqual(request_key(['a.domain.com'], 'email@domail.com')[2], None)
+		self.assertNotEqual(
+			request_key(['a.domain.com'], 'email@domail.com'),
+			request_key(['a.domain.com'], 'email@domail.com', False))
+
+
+class ConcurrencyEngine(Engine):
+	"""
+	Engine recording the number of certificates issued at the same time.
+	"""
+
+	def __init__(self, certbot):
+		Engine.__init__(self, certbot)
+		self.running = 0
+		self.max_running = 0
+		self.lock = threading.Lock()
+
+	def issue(self, domains, email, testing=None):
+		with self.lock:
+			self.running += 1
+			self.max_running = max(self.max_running, self.running)
+		time.sleep(0.1)
+		generate_cert(os.path.join(self.certbot.path, 'live', domains[0]), domains)
+		with self.lock:
+			self.running -= 1
+		return CertResult(CertResult.ISSUED)
+
+
+class ConcurrencyTestCase(TestCase):
+
+	def setUp(self):
+		self.certbot_path = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.certbot_path)
+
+	def test_process_many(self):
+		self.client = DFPLEClient(
+			certbot_path=self.certbot_path,
+			certbot_challenge='http',
+			certbot_webroot_path='/tmp',
+			issue_concurrency=3)
+		self.client.certbot.engine = ConcurrencyEngine(self.client.certbot)
+
+		requests = [(['site{}.domain.com'.format(i)], 'email@domail.com', None) for i in range(6)]
+		with patch.object(self.client.dfp_client, 'put', lambda url, data=None, headers=None: response(200, b'')):
+			errors = self.client.process_many(requests)
+
+		self.assertEqual(errors, [None] * 6)
+		self.assertEqual(self.client.certbot.engine.max_running, 3)
+		for domains, email, testing in requests:
+			self.assertTrue(os.path.exists(os.path.join(self.certbot_path, '{}.pem'.format(domains[0]))))
+
+
+	def test_rate_limit_wait(self):
+		# a request waiting for the rate limit does not hold the only issue slot
+		waiting = threading.Event()
+		release = threading.Event()
+		now = [1000.0]
+		def sleep(seconds):
+			waiting.set()
+			release.wait(5)
+			now[0] += seconds
+		limiter = RateLimiter(certs_per_domain=1, max_wait=7 * 86400, clock=lambda: now[0], sleep=sleep)
+		limiter.acquire('production', ['other.limited.com'])
+		self.client = DFPLEClient(
+			certbot_path=self.certbot_path,
+			certbot_challenge='http',
+			certbot_webroot_path='/tmp',
+			issue_concurrency=1,
+			rate_limiter=limiter)
+		self.client.certbot.engine = ConcurrencyEngine(self.client.certbot)
+
+		thread = threading.Thread(target=self.client.generate_certificates, args=(['site.limited.com'], 'email@domail.com'))
+		thread.daemon = True
+		thread.start()
+		self.assertTrue(waiting.wait(5))
+		start = time.time()
+		certs, created = self.client.generate_certificates(['site.domain.com'], 'email@domail.com')
+		self.assertTrue(created)
+		self.assertLess(time.time() - start, 2)
+		release.set()
+		thread.join(5)
+		self.assertFalse(thread.is_alive())
+
+
+class ServiceUpdateTestCase(TestCase):
+
+	def setUp(self):
+		self.client = DFPLEClient(
+			certbot_path=tempfile.mkdtemp(),
+			certbot_challenge='http',
+			certbot_webroot_path='/tmp',
+			docker_client=docker.DockerClient(version='1.25'))
+		self.service = docker.models.services.Service(attrs={
+			'ID': 'dfp',
+			'Version': {'Index': 12},
+			'Spec': {'Name': 'proxy', 'TaskTemplate': {'ContainerSpec': {'Image': '', 'Secrets': []}}, 'Networks': []}})
+		self.secrets = [{'SecretID': '1', 'SecretName': 'site.domain.com.pem', 'File': {'Name': 'cert-site.domain.com', 'UID': '0', 'GID': '0', 'Mode': 0}}]
+
+	def tearDown(self):
+		shutil.rmtree(self.client.certbot_folder)
+
+	def test_update(self):
+		calls = []
+		def post(url, data=None, params=None, **kwargs):
+			calls.append((url, json.loads(data), params))
+			return response(200, b'{"Warnings": null}')
+
+		with patch.object(self.client.docker_client.api, 'post', post):
+			self.client.service_update_secrets(self.service, self.secrets)
+
+		url, data, params = calls[0]
+		self.assertTrue(url.endswith('/services/dfp/update'))
+		self.assertEqual(params, {'version': 12})
+		self.assertEqual(data['Name'], 'proxy')
+		self.assertEqual(data['TaskTemplate']['ContainerSpec']['Secrets'], self.secrets)
+		# the service spec is left untouched
+		self.assertEqual(self.service.attrs['Spec']['TaskTemplate']['ContainerSpec']['Secrets'], [])
+
+	def test_update_full_spec(self):
+		# spec of a service created by a recent engine
+		spec = {
+			'Name': 'proxy',
+			'Labels': {'com.df.notify': 'true'},
+			'TaskTemplate': {
+				'ContainerSpec': {'Image': 'dockerflow/docker-flow-proxy:latest', 'Secrets': []},
+				'Placement': {'Constraints': ['node.role == manager']},
+				'ForceUpdate': 0,
+				'Runtime': 'container'},
+			'Mode': {'Replicated': {'Replicas': 2}},
+			'UpdateConfig': {'Parallelism': 1, 'FailureAction': 'pause', 'Order': 'start-first'},
+			'RollbackConfig': {'Parallelism': 1, 'FailureAction': 'pause', 'Order': 'stop-first'},
+			'Networks': [{'Target': 'proxy-network-id'}],
+			'EndpointSpec': {'Mode': 'vip', 'Ports': [{'Protocol': 'tcp', 'TargetPort': 80, 'PublishedPort': 80}]}}
+		service = docker.models.services.Service(attrs={'ID': 'dfp', 'Version': {'Index': 12}, 'Spec': spec})
+		calls = []
+		def post(url, data=None, params=None, **kwargs):
+			calls.append(json.loads(data))
+			return response(200, b'{"Warnings": null}')
+
+		with patch.object(self.client.docker_client.api, 'post', post):
+			self.client.service_update_secrets(service, self.secrets)
+
+		expected = json.loads(json.dumps(spec))
+		expected['TaskTemplate']['ContainerSpec']['Secrets'] = self.secrets
+		self.assertEqual(calls, [expected])
+
+	def test_docker_error(self):
+		def post(url, data=None, params=None, **kwargs):
+			raise docker.errors.InvalidVersion('update_config is not supported')
+
+		with patch.object(self.client.docker_client.api, 'post', post):
+			with self.assertRaises(ServiceUpdateError) as cm:
+				self.client.service_update_secrets(self.service, self.secrets)
+		self.assertFalse(cm.exception.conflict)
+
+	def test_conflict(self):
+		def post(url, data=None, params=None, **kwargs):
+			return response(500, b'{"message": "rpc error: code = Unknown desc = update out of sequence"}')
+
+		with patch.object(self.client.docker_client.api, 'post', post):
+			with self.assertRaises(ServiceUpdateError) as cm:
+				self.client.service_update_secrets(self.service, self.secrets)
+		self.assertTrue(cm.exception.conflict)
+		self.assertEqual(cm.exception.status_code, 500)
+
+
+class DeployStateTestCase(TestCase):
+
+	def setUp(self):
+		self.certbot_path = tempfile.mkdtemp()
+		self.domains = ['site.domain.com', 'www.domain.com']
+		generate_cert(os.path.join(self.certbot_path, 'live', self.domains[0]), self.domains)
+
+	def tearDown(self):
+		shutil.rmtree(self.certbot_path)
+
+	def test_put(self):
+		client = DFPLEClient(certbot_path=self.certbot_path, certbot_challenge='http', certbot_webroot_path='/tmp')
+		certs = client.generate_combined(self.domains)
+		puts = []
+		with patch.object(client.dfp_client, 'put', lambda url, data=None, headers=None: puts.append(url) or response(200, b'')):
+			client.distribute(certs, True)
+			self.assertEqual(len(puts), 2)
+
+			# same certificate, after a restart
+			client = DFPLEClient(certbot_path=self.certbot_path, certbot_challenge='http', certbot_webroot_path='/tmp',
+				dfp_client=client.dfp_client)
+			client.distribute(certs, True)
+			self.assertEqual(len(puts), 2)
+
+			# renewed certificate
+			generate_cert(os.path.join(self.certbot_path, 'live', self.domains[0]), self.domains)
+			client.distribute(client.generate_combined(self.domains), True)
+			self.assertEqual(len(puts), 4)
+
+	def test_requested_lineages(self):
+		client = DFPLEClient(certbot_path=self.certbot_path, certbot_challenge='http', certbot_webroot_path='/tmp')
+		self.assertIsNone(client.requested_lineages())
+
+		labels = [
+			{'com.df.letsencrypt.host': 'site.domain.com,www.domain.com', 'com.df.letsencrypt.email': 'a@domain.com'},
+			{'com.df.servicePath': '/'}]
+		docker_client = MagicMock()
+		docker_client.services.list.return_value = [MagicMock(attrs={'Spec': {'Labels': x}}) for x in labels]
+		client = DFPLEClient(certbot_path=self.certbot_path, certbot_challenge='http', certbot_webroot_path='/tmp',
+			docker_client=docker_client)
+		self.assertEqual(client.requested_lineages(), set(['site.domain.com']))
+
+	def test_retry_failed(self):
+		client = DFPLEClient(certbot_path=self.certbot_path, certbot_challenge='http', certbot_webroot_path='/tmp')
+		domains = ['new.domain.com']
+		with patch.object(client.certbot, 'run', return_value=('', 'urn:ietf:params:acme:error:dns :: NXDOMAIN', 1)):
+			with self.assertRaises(Exception):
+				client.process(domains, 'email@domain.com')
+		self.assertEqual(client.deploy_state.failed_requests(), [(domains, 'email@domain.com', None)])
+
+		# the DNS now points to the proxy, the request is retried on renewal
+		def certbot_run(cmd):
+			generate_cert(os.path.join(self.certbot_path, 'live', domains[0]), domains)
+			return '', '', 0
+		with patch.object(client.certbot, 'run', certbot_run), \
+			patch.object(client.dfp_client, 'put', lambda url, data=None, headers=None: response(200, b'')):
+			client.renew()
+		self.assertEqual(client.deploy_state.failed_requests(), [])
+		self.assertTrue(client.deployed(domains))
+
+	def test_renew_postponed(self):
+		generate_cert(os.path.join(self.certbot_path, 'live', 'site.domain.com'), self.domains, days=20)
+		generate_cert(os.path.join(self.certbot_path, 'live', 'api.limited.com'), ['api.limited.com'], days=20)
+		limiter = RateLimiter(certs_per_domain=1, max_wait=0)
+		limiter.acquire('production', ['other.limited.com'])
+		client = DFPLEClient(certbot_path=self.certbot_path, certbot_challenge='http', certbot_webroot_path='/tmp',
+			rate_limiter=limiter)
+		with patch.object(client.certbot, 'renew', return_value=False) as renew:
+			client.renew(names=None)
+		# certbot must not renew the postponed lineage
+		lineages, = renew.call_args[0]
+		self.assertEqual(list(lineages), ['site.domain.com'])
+		self.assertTrue(renew.call_args[1]['restrict'])
+
+	def test_deployed(self):
+		client = DFPLEClient(certbot_path=self.certbot_path, certbot_challenge='http', certbot_webroot_path='/tmp')
+		self.assertFalse(client.deployed(self.domains))
+		certs = client.generate_combined(self.domains)
+		self.assertFalse(client.deployed(self.domains))
+		with patch.object(client.dfp_client, 'put', lambda url, data=None, headers=None: response(200, b'')):
+			client.distribute(certs, True)
+		self.assertTrue(client.deployed(self.domains))
+		self.assertFalse(client.deployed(self.domains + ['new.domain.com']))
+
+		generate_cert(os.path.join(self.certbot_path, 'live', self.domains[0]), self.domains)
+		client.generate_combined(self.domains)
+		self.assertFalse(client.deployed(self.domains))
+
+	def test_put_failed(self):
+		client = DFPLEClient(certbot_path=self.certbot_path, certbot_challenge='http', certbot_webroot_path='/tmp')
+		certs = client.generate_combined(self.domains[:1])
+		with patch.object(client.dfp_client, 'put', lambda url, data=None, headers=None: response(503, b'')):
+			client.distribute(certs, True)
+		self.assertEqual(client.deploy_state.get(self.domains[0]), None)
+
+	def test_put_retried(self):
+		retries = MagicMock()
+		client = DFPLEClient(certbot_path=self.certbot_path, certbot_challenge='http', certbot_webroot_path='/tmp',
+			retries=retries)
+		certs = client.generate_combined(self.domains)
+		with patch.object(client.dfp_client, 'put', lambda url, data=None, headers=None:
+				response(503 if 'www.domain.com' in url else 200, b'')):
+			client.distribute(certs, True)
+		self.assertIsNotNone(client.deploy_state.get('site.domain.com'))
+		self.assertIsNone(client.deploy_state.get('www.domain.com'))
+		# only the failed certificate is retried
+		args = retries.schedule.call_args[1]['args']
+		self.assertEqual([x[0] for x in args[1]], ['www.domain.com'])
+
+		with patch.object(client.dfp_client, 'put', lambda url, data=None, headers=None: response(200, b'')):
+			self.assertTrue(retries.schedule.call_args[0][0](*args))
+		self.assertIsNotNone(client.deploy_state.get('www.domain.com'))
+
+	def test_secret(self):
+		client = DFPLEClient(certbot_path=self.certbot_path, certbot_challenge='http', certbot_webroot_path='/tmp',
+			docker_client=docker.DockerClient(version='1.25'))
+		certs = client.generate_combined(self.domains[:1])
+		service = docker.models.services.Service(attrs={
+			'Spec': {'Name': 'proxy', 'TaskTemplate': {'ContainerSpec': {'Image': '', 'Secrets': []}}, 'Networks': []}})
+		secrets = []
+
+		def secret_create(name, data, labels=None):
+			secrets.append(docker.models.secrets.Secret(attrs={'ID': str(len(secrets)), 'Spec': {
+				'Name': '{}-{}'.format(name, len(secrets)), 'Labels': labels}}))
+			return secrets[-1]
+
+		with patch.object(client, 'secrets', lambda domain=None: list(secrets)), \
+			patch.object(client, 'secret_create', side_effect=secret_create) as create, \
+			patch.object(client, 'services', return_value=[service]), \
+			patch.object(client.attachments, 'attach', wraps=client.attachments.attach) as attach, \
+			patch.object(client.attachments, 'commit'):
+
+			client.distribute(certs, True)
+			self.assertEqual(create.call_count, 1)
+			self.assertEqual(attach.call_count, 1)
+			self.assertEqual(client.secret_fingerprint(self.domains[0], secrets[0]), client.deploy_state.fingerprint(self.domains[0]))
+
+			# identical certificate: no new secret, the pending attachment is kept.
+			client.distribute(certs, True)
+			self.assertEqual(create.call_count, 1)
+			self.assertEqual(attach.call_count, 1)
+
+			# renewed certificate
+			generate_cert(os.path.join(self.certbot_path, 'live', self.domains[0]), self.domains)
+			client.distribute(client.generate_combined(self.domains[:1]), True)
+			self.assertEqual(create.call_count, 2)
+			self.assertEqual(attach.call_count, 2)
+
+	def test_reconcile_state(self):
+		client = DFPLEClient(certbot_path=self.certbot_path, certbot_challenge='http', certbot_webroot_path='/tmp',
+			docker_client=docker.DockerClient(version='1.25'), dfp_service_name='proxy')
+		secrets = [docker.models.secrets.Secret(attrs={'ID': x, 'Spec': {'Name': '{}.pem'.format(x)}}) for x in ('a', 'b')]
+		for secret in secrets:
+			client.deploy_state.record(secret.name[:-4], secret.name, secret=secret, attached=True)
+		client.deploy_state.record('c', 'c.pem', secret=docker.models.secrets.Secret(attrs={'ID': 'c', 'Spec': {'Name': 'c.pem'}}))
+		service = docker.models.services.Service(attrs={
+			'Spec': {'Name': 'proxy', 'TaskTemplate': {'ContainerSpec': {'Image': '', 'Secrets': [
+				{'SecretID': 'a', 'SecretName': 'a.pem', 'File': {'Name': 'cert-a'}}]}}, 'Networks': []}})
+
+		# secret c removed, b detached
+		with patch.object(client, 'secrets', return_value=secrets), \
+			patch.object(client, 'services', return_value=[service]):
+			self.assertEqual(client.reconcile_state(), 2)
+		self.assertEqual([client.deploy_state.get(x)['attached'] for x in ('a', 'b', 'c')], [1, 0, 0])
+		self.assertEqual(client.deploy_state.get('c')['secret_id'], None)
@@ -0,0 +1,280 @@
+import collections
+import fcntl
+import importlib
+import json
+import os
+import tempfile
+import time
+
+import dns.name
+import dns.query
+import dns.rcode
+import dns.resolver
+import dns.tsigkeyring
+import dns.update
+
+from dns_propagation import parse_nameservers, wait_for_txt
+
+import logging
+logger = logging.getLogger('letsencrypt')
+
+
+def challenge_name(domain):
+    # wildcard certificates are validated on the base domain.
+    return '_acme-challenge.{}'.format(domain.lstrip('*.').rstrip('.'))
+
+
+class DNSProvider():
+    """
+        Create and delete the TXT records of a challenge batch.
+    """
+
+    def create_records(self, records):
+        """
+            :param records: list of (name, value)
+            :return: list of (name, value, record id)
+        """
+        raise NotImplementedError()
+
+    def delete_records(self, records):
+        """
+            :param records: list of (name, value, record id), as returned by create_records
+        """
+        raise NotImplementedError()
+
+
+class OVHProvider(DNSProvider):
+    """
+        DNS zones hosted by OVH. Records of a batch are created one by one,
+        then each zone is refreshed once.
+    """
+
+    def __init__(self, client, zones):
+        self.client = client
+        self.zones = zones
+
+    def zone(self, name):
+        zones = [x for x in self.zones if name == x or name.endswith('.' + x)]
+        if not zones:
+            raise Exception('no OVH zone matching {} ({})'.format(name, ', '.join(self.zones)))
+        return max(zones, key=len)
+
+    def refresh(self, zones):
+        for zone in sorted(set(zones)):
+            self.client.post('/domain/zone/{}/refresh'.format(zone))
+            logger.info('zone {} refreshed'.format(zone))
+
+    def create_records(self, records):
+        created = []
+        try:
+            for name, value in records:
+                zone = self.zone(name)
+                record = self.client.post('/domain/zone/{}/record'.format(zone),
+                    fieldType='TXT', subDomain=name[:-len(zone) - 1], target=value, ttl=60)
+                created.append((name, value, record['id']))
+        except Exception:
+            # do not leave the records already created behind.
+            if created:
+                self.delete_records(created)
+            raise
+        self.refresh(self.zone(x[0]) for x in created)
+        return created
+
+    def delete_records(self, records):
+        for name, value, record_id in records:
+            try:
+                self.client.delete('/domain/zone/{}/record/{}'.format(self.zone(name), record_id))
+            except Exception as e:
+                logger.error('unable to delete record {} of {}: {}'.format(record_id, name, e))
+        self.refresh(self.zone(x[0]) for x in records)
+
+    @classmethod
+    def from_env(cls, env=os.environ):
+        import ovh
+        client = ovh.Client(
+            endpoint=env.get('OVH_ENDPOINT', 'ovh-eu'),
+            application_key=env.get('OVH_APPLICATION_KEY'),
+            application_secret=env.get('OVH_APPLICATION_SECRET'),
+            consumer_key=env.get('OVH_CONSUMER_KEY'))
+        return cls(client, [x.strip() for x in env.get('OVH_DNS_ZONE', '').split(',') if x.strip()])
+
+
+class RFC2136Provider(DNSProvider):
+    """
+        Dynamic updates (RFC 2136) sent to a nameserver (BIND, knot, ...),
+        optionally signed with a TSIG key. Records of a batch are sent with a
+        single update per zone.
+    """
+
+    def __init__(self, server, port=53, zones=None, keyring=None, keyalgorithm='hmac-sha256', timeout=10):
+        self.server = server
+        self.port = port
+        self.zones = zones or []
+        self.keyring = keyring
+        self.keyalgorithm = keyalgorithm
+        self.timeout = timeout
+
+    def zone(self, name):
+        zones = [x for x in self.zones if name == x or name.endswith('.' + x)]
+        if zones:
+            return max(zones, key=len)
+        # ask the server for the zone
+        resolver = dns.resolver.Resolver(configure=False)
+        resolver.nameservers = [self.server]
+        resolver.port = self.port
+        return dns.resolver.zone_for_name(name, resolver=resolver).to_text().rstrip('.')
+
+    def _update(self, records, action):
+        by_zone = collections.OrderedDict()
+        for record in records:
+            by_zone.setdefault(self.zone(record[0]), []).append(record)
+
+        for zone, zone_records in by_zone.items():
+            update = dns.update.Update(zone, keyring=self.keyring,
+                keyalgorithm=dns.name.from_text(self.keyalgorithm) if self.keyring else None)
+            for record in zone_records:
+                if action == 'add':
+                    update.add(record[0] + '.', 60, 'TXT', record[1])
+                else:
+                    update.delete(record[0] + '.', 'TXT', record[1])
+            response = dns.query.tcp(update, self.server, port=self.port, timeout=self.timeout)
+            if response.rcode() != dns.rcode.NOERROR:
+                raise Exception('dns update of {} refused: {}'.format(zone, dns.rcode.to_text(response.rcode())))
+
+    def create_records(self, records):
+        self._update(records, 'add')
+        return [(name, value, None) for name, value in records]
+
+    def delete_records(self, records):
+        self._update(records, 'delete')
+
+    @classmethod
+    def from_env(cls, env=os.environ):
+        keyring = None
+        if env.get('DNS_RFC2136_TSIG_KEY'):
+            keyring = dns.tsigkeyring.from_text({env['DNS_RFC2136_TSIG_KEY']: env.get('DNS_RFC2136_TSIG_SECRET')})
+        server, port = parse_nameservers(env.get('DNS_RFC2136_SERVER', '127.0.0.1'))[0]
+        return cls(server, port,
+            zones=[x.strip() for x in env.get('DNS_RFC2136_ZONE', '').split(',') if x.strip()],
+            keyring=keyring,
+            keyalgorithm=env.get('DNS_RFC2136_TSIG_ALGORITHM', 'hmac-sha256'))
+
+
+# provider classes by name, see provider_from_env.
+PROVIDERS = {
+    'ovh': OVHProvider,
+    'rfc2136': RFC2136Provider,
+}
+
+def provider_from_env(name, env=os.environ):
+    """
+        Build the DNS provider `name`: a registered provider, or the
+        `module:Class` path of a DNSProvider subclass.
+    """
+    if name in PROVIDERS:
+        cls = PROVIDERS[name]
+    elif ':' in name:
+        module, _, cls = name.partition(':')
+        cls = getattr(importlib.import_module(module), cls)
+    else:
+        raise Exception('unknown dns provider "{}". Use {} or module:Class'.format(name, ', '.join(sorted(PROVIDERS))))
+    return cls.from_env(env)
+
+def wait_for_records(records, timeout, nameservers=None, wait=wait_for_txt, clock=time.time):
+    """
+        Wait for the propagation of records, list of (name, value).
+
+        Records are checked one after the other, the first one takes most of
+        the propagation delay.
+    """
+    deadline = clock() + timeout
+    visible = True
+    for name, value in records:
+        visible = wait(name, value, nameservers=nameservers,
+            timeout=max(0, deadline - clock())) and visible
+    return visible
+
+
+class ChallengeBatch():
+    """
+        Provision the TXT records of an order at once.
+
+        Auth hooks are called once per name, CERTBOT_REMAINING_CHALLENGES
+        counting down to 0: records are only collected until the last call,
+        which creates them all, then waits for their propagation. The first
+        cleanup hook call deletes them all.
+
+        Batches are kept in `state_file` between hook runs, by order
+        (CERTBOT_ALL_DOMAINS).
+    """
+
+    def __init__(self, provider, state_file=None, propagation_timeout=300, nameservers=None, wait=wait_for_txt, clock=time.time):
+        self.provider = provider
+        self.state_file = state_file or os.path.join(tempfile.gettempdir(), 'dfple-dns-challenges.json')
+        self.propagation_timeout = propagation_timeout
+        self.nameservers = nameservers
+        self.wait = wait
+        self.clock = clock
+
+    def _update(self, func):
+        """
+            Call func(batches) with the state file locked, and save batches.
+        """
+        with open(self.state_file, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                content = f.read()
+                batches = json.loads(content) if content else {}
+                result = func(batches)
+                f.seek(0)
+                f.truncate()
+                json.dump(batches, f)
+                return result
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def auth(self, domain, validation, remaining=0, all_domains=None):
+        """
+            :return: True when the records are created and visible, None while collecting them
+        """
+        key = all_domains or domain
+
+        def collect(batches):
+            batch = batches.get(key)
+            if batch is None or batch['created']:
+                batch = batches[key] = {'pending': [], 'created': []}
+            batch['pending'].append([challenge_name(domain), validation])
+            if remaining > 0:
+                return None
+            records, batch['pending'] = batch['pending'], []
+            return records
+
+        records = self._update(collect)
+        if records is None:
+            logger.debug('{} challenge collected, {} remaining'.format(domain, remaining))
+            return None
+
+        created = self.provider.create_records([tuple(x) for x in records])
+        logger.info('{} TXT records created for {}'.format(len(created), key))
+
+        def save(batches):
+            batches.setdefault(key, {'pending': []})['created'] = [list(x) for x in created]
+        self._update(save)
+
+        return self.wait_records(records)
+
+    def wait_records(self, records):
+        return wait_for_records([tuple(x[:2]) for x in records], self.propagation_timeout,
+            nameservers=self.nameservers, wait=self.wait, clock=self.clock)
+
+    def cleanup(self, domain, validation, all_domains=None):
+        """
+            :return: number of records deleted
+        """
+        key = all_domains or domain
+        records = self._update(lambda batches: (batches.pop(key, None) or {}).get('created', []))
+        if records:
+            self.provider.delete_records([tuple(x) for x in records])
+            logger.info('{} TXT records deleted for {}'.format(len(records), key))
+        return len(records)
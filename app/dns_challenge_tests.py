@@ -0,0 +1,214 @@
+import os
+import shutil
+import sys
+import tempfile
+from mock import MagicMock, call
+from unittest import TestCase
+
+import dns.tsigkeyring
+
+from dns_challenge import ChallengeBatch, DNSProvider, OVHProvider, RFC2136Provider, challenge_name, provider_from_env
+from dns_propagation import txt_values
+
+# test nameserver, shipped with the benchmarks and not in the image.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+from dns_fake import FakeDNSServer
+
+
+class FakeProvider(DNSProvider):
+
+	def __init__(self):
+		self.records = {}
+		self.creates = 0
+		self.deletes = 0
+
+	def create_records(self, records):
+		self.creates += 1
+		created = []
+		for name, value in records:
+			record_id = len(self.records) + 1
+			self.records[record_id] = (name, value)
+			created.append((name, value, record_id))
+		return created
+
+	def delete_records(self, records):
+		self.deletes += 1
+		for name, value, record_id in records:
+			del self.records[record_id]
+
+
+class ChallengeBatchTestCase(TestCase):
+
+	def setUp(self):
+		self.tmp = tempfile.mkdtemp()
+		self.provider = FakeProvider()
+		self.waits = []
+		def wait(name, value, nameservers=None, timeout=None):
+			self.waits.append((name, value))
+			return True
+		self.batch = ChallengeBatch(self.provider, os.path.join(self.tmp, 'state.json'), wait=wait)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmp)
+
+	def test_challenge_name(self):
+		self.assertEqual(challenge_name('site.domain.com'), '_acme-challenge.site.domain.com')
+		self.assertEqual(challenge_name('*.domain.com'), '_acme-challenge.domain.com')
+
+	def test_batch(self):
+		domains = 'domain.com,*.domain.com,www.domain.com'
+		self.assertIsNone(self.batch.auth('domain.com', 'v1', 2, domains))
+		self.assertIsNone(self.batch.auth('domain.com', 'v2', 1, domains))
+		self.assertEqual(self.provider.records, {})
+		self.assertTrue(self.batch.auth('www.domain.com', 'v3', 0, domains))
+
+		# a single batch creation, one wait for each record
+		self.assertEqual(self.provider.creates, 1)
+		self.assertEqual(sorted(self.provider.records.values()), [
+			('_acme-challenge.domain.com', 'v1'),
+			('_acme-challenge.domain.com', 'v2'),
+			('_acme-challenge.www.domain.com', 'v3')])
+		self.assertEqual(len(self.waits), 3)
+
+		self.assertEqual(self.batch.cleanup('domain.com', 'v1', domains), 3)
+		self.assertEqual(self.batch.cleanup('domain.com', 'v2', domains), 0)
+		self.assertEqual(self.batch.cleanup('www.domain.com', 'v3', domains), 0)
+		self.assertEqual(self.provider.records, {})
+		self.assertEqual(self.provider.deletes, 1)
+
+	def test_concurrent_orders(self):
+		self.batch.auth('a.domain.com', 'a1', 1, 'a.domain.com,www.a.domain.com')
+		self.batch.auth('b.domain.com', 'b1', 0, 'b.domain.com')
+		self.assertEqual(list(self.provider.records.values()), [('_acme-challenge.b.domain.com', 'b1')])
+		self.batch.auth('www.a.domain.com', 'a2', 0, 'a.domain.com,www.a.domain.com')
+		self.assertEqual(len(self.provider.records), 3)
+		self.batch.cleanup('b.domain.com', 'b1', 'b.domain.com')
+		self.assertEqual(len(self.provider.records), 2)
+
+	def test_without_remaining(self):
+		# hooks called without CERTBOT_REMAINING_CHALLENGES provision each name
+		self.assertTrue(self.batch.auth('site.domain.com', 'v1'))
+		self.assertEqual(len(self.provider.records), 1)
+		self.assertEqual(self.batch.cleanup('site.domain.com', 'v1'), 1)
+
+	def test_previous_batch_replaced(self):
+		self.batch.auth('site.domain.com', 'v1', 0)
+		# cleanup never called, a new order for the same domains starts a new batch
+		self.batch.auth('site.domain.com', 'v2', 0)
+		self.assertEqual(self.batch.cleanup('site.domain.com', 'v2'), 1)
+		self.assertEqual(list(self.provider.records.values()), [('_acme-challenge.site.domain.com', 'v1')])
+
+
+class OVHProviderTestCase(TestCase):
+
+	def setUp(self):
+		self.client = MagicMock()
+		self.client.post.side_effect = lambda url, **kwargs: {'id': len(self.client.post.mock_calls)}
+		self.provider = OVHProvider(self.client, ['domain.com', 'sub.domain.com', 'other.com'])
+
+	def test_zone(self):
+		self.assertEqual(self.provider.zone('_acme-challenge.domain.com'), 'domain.com')
+		self.assertEqual(self.provider.zone('_acme-challenge.www.sub.domain.com'), 'sub.domain.com')
+		with self.assertRaises(Exception):
+			self.provider.zone('_acme-challenge.unknown.com')
+
+	def test_create_records(self):
+		created = self.provider.create_records([
+			('_acme-challenge.domain.com', 'v1'),
+			('_acme-challenge.www.domain.com', 'v2'),
+			('_acme-challenge.other.com', 'v3')])
+		self.assertEqual([x[2] for x in created], [1, 2, 3])
+		self.assertEqual(self.client.post.mock_calls, [
+			call('/domain/zone/domain.com/record', fieldType='TXT', subDomain='_acme-challenge', target='v1', ttl=60),
+			call('/domain/zone/domain.com/record', fieldType='TXT', subDomain='_acme-challenge.www', target='v2', ttl=60),
+			call('/domain/zone/other.com/record', fieldType='TXT', subDomain='_acme-challenge', target='v3', ttl=60),
+			# each zone refreshed once
+			call('/domain/zone/domain.com/refresh'),
+			call('/domain/zone/other.com/refresh'),
+		])
+
+		self.client.post.reset_mock()
+		self.provider.delete_records(created)
+		self.assertEqual(self.client.delete.mock_calls, [
+			call('/domain/zone/domain.com/record/1'),
+			call('/domain/zone/domain.com/record/2'),
+			call('/domain/zone/other.com/record/3')])
+		self.assertEqual(self.client.post.call_count, 2)
+
+	def test_create_records_error(self):
+		self.client.post.side_effect = [{'id': 1}, Exception('quota exceeded'), None]
+		with self.assertRaises(Exception):
+			self.provider.create_records([
+				('_acme-challenge.domain.com', 'v1'),
+				('_acme-challenge.www.domain.com', 'v2')])
+		self.client.delete.assert_called_once_with('/domain/zone/domain.com/record/1')
+
+
+class RFC2136ProviderTestCase(TestCase):
+
+	def setUp(self):
+		self.server = FakeDNSServer(zones=['domain.com', 'other.com']).start()
+		self.addCleanup(self.server.close)
+		self.provider = RFC2136Provider('127.0.0.1', self.server.port, zones=['domain.com', 'other.com'])
+
+	def txt(self, name):
+		return txt_values(name, '127.0.0.1', port=self.server.port)
+
+	def test_records(self):
+		created = self.provider.create_records([
+			('_acme-challenge.domain.com', 'v1'),
+			('_acme-challenge.domain.com', 'v2'),
+			('_acme-challenge.www.other.com', 'v3')])
+		# one update per zone
+		self.assertEqual(self.server.updates, 2)
+		self.assertEqual(self.txt('_acme-challenge.domain.com'), set(['v1', 'v2']))
+		self.assertEqual(self.txt('_acme-challenge.www.other.com'), set(['v3']))
+
+		self.provider.delete_records(created[:1])
+		self.assertEqual(self.txt('_acme-challenge.domain.com'), set(['v2']))
+		self.provider.delete_records(created[1:])
+		self.assertEqual(self.txt('_acme-challenge.domain.com'), set())
+
+	def test_zone_from_server(self):
+		provider = RFC2136Provider('127.0.0.1', self.server.port)
+		self.assertEqual(provider.zone('_acme-challenge.www.domain.com'), 'domain.com')
+
+	def test_tsig(self):
+		keyring = dns.tsigkeyring.from_text({'dfple.': 'c2VjcmV0c2VjcmV0c2VjcmV0'})
+		server = FakeDNSServer(zones=['domain.com'], keyring=keyring).start()
+		self.addCleanup(server.close)
+		provider = provider_from_env('rfc2136', {
+			'DNS_RFC2136_SERVER': '127.0.0.1:{}'.format(server.port),
+			'DNS_RFC2136_ZONE': 'domain.com',
+			'DNS_RFC2136_TSIG_KEY': 'dfple.',
+			'DNS_RFC2136_TSIG_SECRET': 'c2VjcmV0c2VjcmV0c2VjcmV0'})
+		provider.create_records([('_acme-challenge.domain.com', 'v1')])
+		self.assertEqual(txt_values('_acme-challenge.domain.com', '127.0.0.1', port=server.port), set(['v1']))
+
+		# unsigned updates are ignored
+		provider.keyring = None
+		provider.timeout = 0.5
+		with self.assertRaises(Exception):
+			provider.create_records([('_acme-challenge.domain.com', 'v2')])
+
+
+class ProviderRegistryTestCase(TestCase):
+
+	def test_registered(self):
+		provider = provider_from_env('rfc2136', {'DNS_RFC2136_SERVER': '10.0.0.1:5353', 'DNS_RFC2136_ZONE': 'domain.com'})
+		self.assertIsInstance(provider, RFC2136Provider)
+		self.assertEqual((provider.server, provider.port, provider.zones), ('10.0.0.1', 5353, ['domain.com']))
+
+	def test_module_path(self):
+		self.assertIsInstance(provider_from_env('dns_challenge_tests:EnvProvider', {}), EnvProvider)
+
+	def test_unknown(self):
+		with self.assertRaises(Exception):
+			provider_from_env('unknown')
+
+
+class EnvProvider(FakeProvider):
+
+	@classmethod
+	def from_env(cls, env):
+		return cls()
@@ -0,0 +1,89 @@
+import time
+
+import dns.exception
+import dns.flags
+import dns.message
+import dns.query
+import dns.rdatatype
+import dns.resolver
+
+import logging
+logger = logging.getLogger('letsencrypt')
+
+
+def _resolve(resolver, name, rdtype):
+    # dnspython >= 2 renamed query() to resolve()
+    return getattr(resolver, 'resolve', resolver.query)(name, rdtype)
+
+def parse_nameservers(value):
+    """
+        Parse a comma separated list of nameservers (ip or ip:port).
+    """
+    nameservers = []
+    for ns in (value or '').split(','):
+        ns = ns.strip()
+        if not ns:
+            continue
+        host, _, port = ns.partition(':')
+        nameservers.append((host, int(port or 53)))
+    return nameservers
+
+def authoritative_nameservers(name, resolver=None):
+    """
+        Addresses of the nameservers of the zone containing name.
+    """
+    resolver = resolver or dns.resolver.Resolver()
+    zone = dns.resolver.zone_for_name(name, resolver=resolver)
+    addresses = set()
+    for ns in _resolve(resolver, zone, 'NS'):
+        for address in _resolve(resolver, ns.target, 'A'):
+            addresses.add(address.address)
+    return [(x, 53) for x in sorted(addresses)]
+
+def txt_values(name, nameserver, port=53, timeout=2):
+    """
+        TXT values of name, asked directly to nameserver.
+    """
+    query = dns.message.make_query(name, dns.rdatatype.TXT)
+    response = dns.query.udp(query, nameserver, timeout=timeout, port=port)
+    if response.flags & dns.flags.TC:
+        response = dns.query.tcp(query, nameserver, timeout=timeout, port=port)
+    values = set()
+    for rrset in response.answer:
+        if rrset.rdtype == dns.rdatatype.TXT:
+            for rdata in rrset:
+                values.add(b''.join(rdata.strings).decode('ascii'))
+    return values
+
+def wait_for_txt(name, value, nameservers=None, timeout=300, interval=2, max_interval=10, query_timeout=2, resolver=None, clock=time.time, sleep=time.sleep):
+    """
+        Wait until every nameserver answers value in the TXT records of name.
+
+        Nameservers are polled every `interval` seconds, the interval grows
+        by half after each attempt, up to `max_interval`.
+
+        :param nameservers: list of (address, port), the authoritative nameservers of the zone by default.
+        :return: True if the record is visible, False after timeout seconds.
+    """
+    deadline = clock() + timeout
+    if not nameservers:
+        nameservers = authoritative_nameservers(name, resolver)
+    pending = list(nameservers)
+    logger.debug('waiting for {} TXT record on {}'.format(name, ', '.join('{}:{}'.format(*x) for x in pending)))
+
+    while True:
+        for ns in list(pending):
+            try:
+                if value in txt_values(name, ns[0], port=ns[1], timeout=query_timeout):
+                    pending.remove(ns)
+            except (dns.exception.DNSException, EnvironmentError) as e:
+                logger.debug('TXT query to {} failed: {}'.format(ns[0], e))
+        if not pending:
+            logger.info('{} TXT record propagated.'.format(name))
+            return True
+        if clock() + interval > deadline:
+            logger.error('{} TXT record not visible on {} after {}s.'.format(
+                name, ', '.join(x[0] for x in pending), timeout))
+            return False
+        sleep(interval)
+        interval = min(max_interval, interval * 1.5)
@@ -0,0 +1,78 @@
+import os
+import socket
+import sys
+from unittest import TestCase
+
+import dns.resolver
+
+from dns_propagation import authoritative_nameservers, parse_nameservers, txt_values, wait_for_txt
+
+# test nameserver, shipped with the benchmarks and not in the image.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+from dns_fake import FakeDNSServer
+
+
+class Clock():
+
+	def __init__(self):
+		self.now = 1000.0
+
+	def __call__(self):
+		return self.now
+
+	def sleep(self, delay):
+		self.now += delay
+
+
+class DNSPropagationTestCase(TestCase):
+
+	def setUp(self):
+		self.server = FakeDNSServer(zones=['domain.com']).start()
+		self.addCleanup(self.server.close)
+		self.nameservers = [('127.0.0.1', self.server.port)]
+		self.clock = Clock()
+
+	def test_parse_nameservers(self):
+		self.assertEqual(parse_nameservers('10.0.0.1, 10.0.0.2:5353'), [('10.0.0.1', 53), ('10.0.0.2', 5353)])
+		self.assertEqual(parse_nameservers(''), [])
+		self.assertEqual(parse_nameservers(None), [])
+
+	def test_authoritative_nameservers(self):
+		resolver = dns.resolver.Resolver(configure=False)
+		resolver.nameservers = ['127.0.0.1']
+		resolver.port = self.server.port
+		self.assertEqual(authoritative_nameservers('_acme-challenge.site.domain.com', resolver), [('127.0.0.1', 53)])
+
+	def test_txt_values(self):
+		self.server.records[('_acme-challenge.site.domain.com.', 'TXT')] = ['"validation1"', '"validation2"']
+		self.assertEqual(txt_values('_acme-challenge.site.domain.com', '127.0.0.1', port=self.server.port),
+			set(['validation1', 'validation2']))
+		self.assertEqual(txt_values('_acme-challenge.other.domain.com', '127.0.0.1', port=self.server.port), set())
+
+	def test_wait(self):
+		name = '_acme-challenge.site.domain.com'
+		def sleep(delay):
+			self.clock.sleep(delay)
+			# the record appears after a few polls
+			if self.clock.now > 1005:
+				self.server.records[(name + '.', 'TXT')] = ['"validation"']
+
+		self.assertTrue(wait_for_txt(name, 'validation', self.nameservers,
+			timeout=60, interval=2, clock=self.clock, sleep=sleep))
+		self.assertLess(self.clock.now - 1000, 10)
+
+	def test_wait_timeout(self):
+		self.server.records[('_acme-challenge.site.domain.com.', 'TXT')] = ['"previous"']
+		self.assertFalse(wait_for_txt('_acme-challenge.site.domain.com', 'validation', self.nameservers,
+			timeout=30, interval=2, max_interval=5, clock=self.clock, sleep=self.clock.sleep))
+		self.assertLessEqual(self.clock.now - 1000, 30)
+
+	def test_wait_unreachable(self):
+		sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		sock.bind(('127.0.0.1', 0))
+		self.addCleanup(sock.close)
+		self.server.records[('_acme-challenge.site.domain.com.', 'TXT')] = ['"validation"']
+		# a nameserver not answering prevents completion
+		self.assertFalse(wait_for_txt('_acme-challenge.site.domain.com', 'validation',
+			self.nameservers + [('127.0.0.1', sock.getsockname()[1])],
+			timeout=5, interval=2, query_timeout=0.2, clock=self.clock, sleep=self.clock.sleep))
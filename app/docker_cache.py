@@ -0,0 +1,154 @@
+import collections
+import re
+import threading
+import time
+
+from metrics import DOCKER_API_DURATION
+
+import logging
+logger = logging.getLogger('letsencrypt')
+
+
+# secrets created by DFPLEClient are suffixed by their creation date: XXX-YYYYMMDD-HHMMSS
+SECRET_NAME_RE = re.compile(r'^(?P<base>.*)-\d{8}-\d{6}$')
+
+def secret_base_name(name):
+    match = SECRET_NAME_RE.match(name)
+    return match.group('base') if match else name
+
+
+class DockerCache():
+    """
+        In-memory view of docker secrets (indexed by base name) and services.
+
+        Filled with a single list call, then kept up to date by the docker
+        events stream and by the changes made through this process. The whole
+        cache is reloaded after `ttl` seconds, or when the events stream is
+        interrupted.
+    """
+
+    def __init__(self, docker_client, ttl=300):
+        self.docker_client = docker_client
+        self.ttl = ttl
+
+        self._secrets = {}
+        self._secrets_by_name = collections.defaultdict(list)
+        self._services = {}
+        self._loaded_at = None
+        self._lock = threading.RLock()
+        self._thread = None
+        # functions called with each docker event once the cache is updated,
+        # and with None when the events stream (re)starts: events may have
+        # been missed.
+        self.listeners = []
+
+    def load(self):
+        logger.debug('loading docker secrets')
+        with DOCKER_API_DURATION.labels('secrets.list').time():
+            secrets = self.docker_client.secrets.list()
+        with self._lock:
+            self._secrets = dict((x.id, x) for x in secrets)
+            self._services = {}
+            self._reindex()
+            self._loaded_at = time.time()
+
+    def _reindex(self):
+        self._secrets_by_name = collections.defaultdict(list)
+        for secret in self._secrets.values():
+            self._secrets_by_name[secret_base_name(secret.name)].append(secret)
+        # the creation date suffix sorts secrets from the oldest to the newest.
+        for secrets in self._secrets_by_name.values():
+            secrets.sort(key=lambda x: x.name)
+
+    def _check(self):
+        if self._loaded_at is None or time.time() - self._loaded_at > self.ttl:
+            self.load()
+
+    def secrets(self, name=None):
+        """
+            Secrets named `name` (creation date suffix excluded), oldest first.
+        """
+        with self._lock:
+            self._check()
+            if name is None:
+                return list(self._secrets.values())
+            return list(self._secrets_by_name.get(name, []))
+
+    def add_secret(self, secret):
+        with self._lock:
+            self._secrets[secret.id] = secret
+            self._reindex()
+
+    def remove_secret(self, secret_id):
+        with self._lock:
+            if self._secrets.pop(secret_id, None) is not None:
+                self._reindex()
+
+    def service(self, name):
+        """
+            Service named `name`, None if it does not exist.
+        """
+        with self._lock:
+            self._check()
+            if name not in self._services:
+                with DOCKER_API_DURATION.labels('services.list').time():
+                    services = [x for x in self.docker_client.services.list(filters={'name': name}) if x.name == name]
+                self._services[name] = services[0] if services else None
+            return self._services[name]
+
+    def invalidate_service(self, name):
+        with self._lock:
+            self._services.pop(name, None)
+
+    def handle(self, event):
+        """
+            Update the cache from a docker event.
+        """
+        event_type = event.get('Type')
+        action = event.get('Action')
+        actor = event.get('Actor', {})
+
+        if event_type == 'secret':
+            if action == 'create':
+                self.add_secret(self.docker_client.secrets.get(actor['ID']))
+            elif action == 'remove':
+                self.remove_secret(actor['ID'])
+
+        elif event_type == 'service':
+            name = actor.get('Attributes', {}).get('name')
+            if name is None:
+                # unknown service, drop every cached one
+                with self._lock:
+                    self._services = {}
+            else:
+                self.invalidate_service(name)
+
+    def notify(self, event):
+        for listener in self.listeners:
+            try:
+                listener(event)
+            except Exception as e:
+                logger.error('docker event listener failed: {}'.format(e))
+
+    def start(self):
+        self._thread = threading.Thread(target=self.watch, name='docker-events')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def watch(self):
+        while True:
+            try:
+                events = self.docker_client.events(
+                    decode=True, filters={'type': ['secret', 'service']})
+                self.load()
+                self.notify(None)
+                for event in events:
+                    logger.debug('docker event {} {}'.format(event.get('Type'), event.get('Action')))
+                    self.handle(event)
+                    self.notify(event)
+            except Exception as e:
+                logger.error('docker events stream interrupted: {}'.format(e))
+            # force a reload, events may have been missed.
+            with self._lock:
+                self._loaded_at = None
+            time.sleep(5)
@@ -0,0 +1,81 @@
+from mock import MagicMock, patch
+from unittest import TestCase
+
+from docker_cache import DockerCache, secret_base_name
+
+
+class Secret():
+
+	def __init__(self, id, name):
+		self.id = id
+		self.name = name
+
+
+class Service():
+
+	def __init__(self, name):
+		self.name = name
+
+
+class DockerCacheTestCase(TestCase):
+
+	def setUp(self):
+		self.secrets = [
+			Secret('2', 'site.domain.com.pem-20170201-000000'),
+			Secret('1', 'site.domain.com.pem-20170101-000000'),
+			Secret('3', 'other.domain.com.pem-20170101-000000'),
+			Secret('4', 'site.domain.com.pem'),
+		]
+		self.docker_client = MagicMock()
+		self.docker_client.secrets.list.return_value = self.secrets
+		self.docker_client.services.list.return_value = [Service('proxy_2'), Service('proxy')]
+		self.cache = DockerCache(self.docker_client)
+
+	def test_secret_base_name(self):
+		self.assertEqual(secret_base_name('site.domain.com.pem-20170201-000000'), 'site.domain.com.pem')
+		self.assertEqual(secret_base_name('site.domain.com.pem'), 'site.domain.com.pem')
+
+	def test_secrets(self):
+		self.assertEqual([x.id for x in self.cache.secrets('site.domain.com.pem')], ['4', '1', '2'])
+		self.assertEqual([x.id for x in self.cache.secrets('other.domain.com.pem')], ['3'])
+		self.assertEqual(self.cache.secrets('unknown.domain.com.pem'), [])
+		self.assertEqual(len(self.cache.secrets()), 4)
+		# a single list call
+		self.assertEqual(self.docker_client.secrets.list.call_count, 1)
+
+	def test_service(self):
+		self.assertEqual(self.cache.service('proxy').name, 'proxy')
+		self.assertEqual(self.cache.service('proxy').name, 'proxy')
+		self.assertEqual(self.docker_client.services.list.call_count, 1)
+		self.cache.invalidate_service('proxy')
+		self.cache.service('proxy')
+		self.assertEqual(self.docker_client.services.list.call_count, 2)
+
+	def test_events(self):
+		self.cache.service('proxy')
+		self.docker_client.secrets.get.return_value = Secret('5', 'site.domain.com.pem-20170301-000000')
+		self.cache.handle({'Type': 'secret', 'Action': 'create', 'Actor': {'ID': '5'}})
+		self.cache.handle({'Type': 'secret', 'Action': 'remove', 'Actor': {'ID': '1'}})
+		self.assertEqual([x.id for x in self.cache.secrets('site.domain.com.pem')], ['4', '2', '5'])
+
+		self.cache.handle({'Type': 'service', 'Action': 'update', 'Actor': {'ID': 'x', 'Attributes': {'name': 'proxy'}}})
+		self.cache.service('proxy')
+		self.assertEqual(self.docker_client.services.list.call_count, 2)
+
+	def test_watch(self):
+		events = [{'Type': 'service', 'Action': 'create', 'Actor': {'ID': 'x', 'Attributes': {'name': 'web'}}}]
+		received = []
+		self.cache.listeners.append(received.append)
+		# a failing listener does not stop the others
+		self.cache.listeners.insert(0, MagicMock(side_effect=Exception('boom')))
+
+		def stream(**kwargs):
+			if received:
+				raise SystemExit()
+			return iter(events)
+		self.docker_client.events.side_effect = stream
+		with self.assertRaises(SystemExit):
+			with patch('docker_cache.time.sleep'):
+				self.cache.watch()
+		# None once the cache is (re)loaded, then each event
+		self.assertEqual(received, [None] + events)
@@ -0,0 +1,30 @@
+# gunicorn configuration, used by the docker image:
+#   gunicorn --config /app/gunicorn_conf.py --chdir /app app:app
+import os
+import sys
+
+bind = '0.0.0.0:{}'.format(os.environ.get('PORT', 8080))
+
+# certificates jobs, docker cache and pending secrets updates live in the
+# worker process: additional workers do not share them.
+workers = int(os.environ.get('WEB_WORKERS', 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 8))
+
+timeout = int(os.environ.get('WEB_TIMEOUT', 60))
+# delay given to running certificates jobs to complete on shutdown.
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', 60))
+# part of graceful_timeout kept to flush pending secrets updates once the jobs
+# are done: the worker is killed when graceful_timeout expires.
+flush_margin = min(10, graceful_timeout // 4)
+keepalive = 5
+
+accesslog = '-' if os.environ.get('LOG', 'info').lower() == 'debug' else None
+errorlog = '-'
+
+
+def worker_exit(server, worker):
+    # runs in the worker process, where app.py has been loaded.
+    app = sys.modules.get('app')
+    if app is not None and hasattr(app, 'shutdown'):
+        app.shutdown(graceful_timeout - flush_margin)
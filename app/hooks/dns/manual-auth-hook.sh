@@ -0,0 +1,7 @@
+#!/bin/sh
+# certbot manual auth hook: TXT records are created by the DNS_PROVIDER of the API.
+curl -sSf --max-time 900 "http://127.0.0.1:${PORT:-8080}/v1/docker-flow-proxy-letsencrypt/dns/auth" \
+	--data-urlencode "domain=${CERTBOT_DOMAIN}" \
+	--data-urlencode "validation=${CERTBOT_VALIDATION}" \
+	--data-urlencode "remaining=${CERTBOT_REMAINING_CHALLENGES:-0}" \
+	--data-urlencode "all_domains=${CERTBOT_ALL_DOMAINS}"
@@ -0,0 +1,6 @@
+#!/bin/sh
+# certbot manual cleanup hook: TXT records are deleted by the DNS_PROVIDER of the API.
+curl -sSf --max-time 60 "http://127.0.0.1:${PORT:-8080}/v1/docker-flow-proxy-letsencrypt/dns/cleanup" \
+	--data-urlencode "domain=${CERTBOT_DOMAIN}" \
+	--data-urlencode "validation=${CERTBOT_VALIDATION}" \
+	--data-urlencode "all_domains=${CERTBOT_ALL_DOMAINS}"
@@ -1,32 +1,28 @@
 #!/usr/bin/python
+import logging
 import os
-import ovh
-import time
+import sys
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from dns_challenge import ChallengeBatch, OVHProvider
+from dns_propagation import parse_nameservers
+
+logging.basicConfig(level=logging.INFO, format="%(message)s")
 
 CERTBOT_DOMAIN = os.environ.get('CERTBOT_DOMAIN')
 CERTBOT_VALIDATION = os.environ.get('CERTBOT_VALIDATION')
-CERTBOT_TOKEN = os.environ.get('CERTBOT_TOKEN')
-
-OVH_DNS_ZONE = os.environ.get('OVH_DNS_ZONE')
-OVH_APPLICATION_KEY = os.environ.get('OVH_APPLICATION_KEY')
-OVH_APPLICATION_SECRET = os.environ.get('OVH_APPLICATION_SECRET')
-OVH_CONSUMER_KEY = os.environ.get('OVH_CONSUMER_KEY')
-
-client = ovh.Client(
-    endpoint='ovh-eu',
-    application_key=OVH_APPLICATION_KEY,
-    application_secret=OVH_APPLICATION_SECRET,
-    consumer_key=OVH_CONSUMER_KEY,
-)
+CERTBOT_REMAINING_CHALLENGES = int(os.environ.get('CERTBOT_REMAINING_CHALLENGES', 0))
+CERTBOT_ALL_DOMAINS = os.environ.get('CERTBOT_ALL_DOMAINS')
 
-# update the _acme-challenge. subdomain with a TXT record
-subdomain = '_acme-challenge.{}'.format(CERTBOT_DOMAIN.replace(OVH_DNS_ZONE, ''))[:-1]
-zone = client.post('/domain/zone/{}/record'.format(OVH_DNS_ZONE), fieldType='TXT', subDomain=subdomain, target=CERTBOT_VALIDATION)
-print "Record updated : {}".format(zone)
+DNS_PROPAGATION_TIMEOUT = int(os.environ.get('DNS_PROPAGATION_TIMEOUT', 300))
+DNS_PROPAGATION_NAMESERVERS = parse_nameservers(os.environ.get('DNS_PROPAGATION_NAMESERVERS'))
 
-response = client.post('/domain/zone/{}/refresh'.format(OVH_DNS_ZONE))
-print "Zone refreshed : {}".format(response)
+batch = ChallengeBatch(
+    OVHProvider.from_env(),
+    state_file=os.environ.get('DNS_CHALLENGE_STATE'),
+    propagation_timeout=DNS_PROPAGATION_TIMEOUT,
+    nameservers=DNS_PROPAGATION_NAMESERVERS)
 
-# sleep to make sure the change has time to propagate over to DNS
-time.sleep(60)
\ No newline at end of file
+# TXT records of every name of the certificate are created by the last call,
+# then the hook waits for them to be served by the zone nameservers.
+batch.auth(CERTBOT_DOMAIN, CERTBOT_VALIDATION, CERTBOT_REMAINING_CHALLENGES, CERTBOT_ALL_DOMAINS)
@@ -0,0 +1,182 @@
+import collections
+import threading
+import time
+import traceback
+import uuid
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import logging
+logger = logging.getLogger('letsencrypt')
+
+
+class Job():
+    """
+        A unit of work executed by a JobQueue worker.
+    """
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    def __init__(self, func, args=(), kwargs=None, description=None, key=None):
+        self.id = uuid.uuid4().hex
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.description = description
+        self.key = key
+        # number of submissions coalesced into this job
+        self.followers = 0
+
+        self.status = self.PENDING
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+        self._done = threading.Event()
+
+    def run(self):
+        self.status = self.RUNNING
+        self.started_at = time.time()
+        try:
+            self.result = self.func(*self.args, **self.kwargs)
+            self.status = self.DONE
+        except Exception as e:
+            logger.error('job {} failed: {}'.format(self.id, e))
+            logger.debug(traceback.format_exc())
+            self.error = str(e)
+            self.status = self.FAILED
+        finally:
+            self.finished_at = time.time()
+            self._done.set()
+
+    def finished(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """
+            Block until the job is finished.
+
+            :return: True if the job is finished, False on timeout
+        """
+        self._done.wait(timeout)
+        return self._done.is_set()
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'description': self.description,
+            'status': self.status,
+            'error': self.error,
+            'followers': self.followers,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+
+class JobQueue():
+    """
+        FIFO queue of jobs drained by a pool of worker threads.
+
+        Finished jobs are kept (up to `history` entries) so their status
+        can be queried after completion.
+
+        Jobs submitted with a `key` are coalesced: as long as a job with the
+        same key is queued or running, or has succeeded less than
+        `coalesce_ttl` seconds ago, submitting returns that job instead of
+        queuing a new one.
+    """
+
+    def __init__(self, workers=1, history=1000, coalesce_ttl=0):
+        self.workers = max(1, int(workers))
+        self.history = history
+        self.coalesce_ttl = coalesce_ttl
+
+        self._queue = queue.Queue()
+        self._jobs = collections.OrderedDict()
+        self._keys = {}
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        for i in range(self.workers):
+            t = threading.Thread(target=self._worker, name='job-worker-{}'.format(i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+        logger.debug('job queue started with {} workers'.format(self.workers))
+
+    def stop(self, timeout=None):
+        """
+            Stop workers once every queued job has been run.
+
+            :return: True if all jobs completed within timeout seconds
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        for t in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join(None if deadline is None else max(0, deadline - time.time()))
+        self._threads = [t for t in self._threads if t.is_alive()]
+        return not self._threads
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                logger.debug('running job {} ({})'.format(job.id, job.description))
+                job.run()
+            finally:
+                self._queue.task_done()
+
+    def _shareable(self, job):
+        if not job.finished():
+            return True
+        return job.status == Job.DONE and \
+            time.time() - job.finished_at < self.coalesce_ttl
+
+    def submit(self, func, args=(), kwargs=None, description=None, key=None):
+        """
+            Enqueue func(*args, **kwargs) and return the associated job.
+
+            :param key: Jobs sharing the same key are coalesced.
+        """
+        with self._lock:
+            if key is not None:
+                job = self._keys.get(key)
+                if job is not None and self._shareable(job):
+                    job.followers += 1
+                    logger.debug('job {} coalesced ({} followers)'.format(job.id, job.followers))
+                    return job
+
+            job = Job(func, args, kwargs, description, key)
+            self._jobs[job.id] = job
+            if key is not None:
+                self._keys[key] = job
+            while len(self._jobs) > self.history:
+                oldest = next(iter(self._jobs))
+                if not self._jobs[oldest].finished():
+                    break
+                oldest = self._jobs.pop(oldest)
+                if self._keys.get(oldest.key) is oldest:
+                    del self._keys[oldest.key]
+        self._queue.put(job)
+        logger.debug('job {} queued'.format(job.id))
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def size(self):
+        return self._queue.qsize()
@@ -0,0 +1,103 @@
+import threading
+import time
+from unittest import TestCase
+
+from jobs import Job, JobQueue
+
+
+class JobQueueTestCase(TestCase):
+
+	def setUp(self):
+		self.jobs = JobQueue(workers=2)
+		self.jobs.start()
+
+	def test_job_done(self):
+		job = self.jobs.submit(lambda a, b=0: a + b, args=(1,), kwargs={'b': 2})
+		self.assertTrue(job.wait(5))
+		self.assertEqual(job.status, Job.DONE)
+		self.assertEqual(job.result, 3)
+		self.assertEqual(self.jobs.get(job.id), job)
+
+	def test_job_failed(self):
+		def fail():
+			raise Exception('Combined cert not found')
+		job = self.jobs.submit(fail)
+		self.assertTrue(job.wait(5))
+		self.assertEqual(job.status, Job.FAILED)
+		self.assertEqual(job.error, 'Combined cert not found')
+
+	def test_submit_does_not_block(self):
+		release = threading.Event()
+		job = self.jobs.submit(release.wait, args=(5,))
+		self.assertFalse(job.finished())
+		release.set()
+		self.assertTrue(job.wait(5))
+
+	def test_history(self):
+		jobs = JobQueue(workers=1, history=2)
+		jobs.start()
+		submitted = [jobs.submit(lambda: None) for i in range(5)]
+		for job in submitted:
+			job.wait(5)
+		jobs.submit(lambda: None).wait(5)
+		self.assertIsNone(jobs.get(submitted[0].id))
+
+
+	def test_stop_drains(self):
+		jobs = JobQueue(workers=2)
+		jobs.start()
+		submitted = [jobs.submit(time.sleep, args=(0.05,)) for i in range(6)]
+		self.assertTrue(jobs.stop(5))
+		self.assertTrue(all(x.status == Job.DONE for x in submitted))
+
+	def test_stop_timeout(self):
+		jobs = JobQueue(workers=1)
+		jobs.start()
+		release = threading.Event()
+		jobs.submit(release.wait, args=(5,))
+		self.assertFalse(jobs.stop(0.1))
+		release.set()
+		self.assertTrue(jobs.stop(5))
+
+class JobQueueCoalesceTestCase(TestCase):
+
+	def setUp(self):
+		self.jobs = JobQueue(workers=1, coalesce_ttl=60)
+		self.jobs.start()
+		self.calls = []
+
+	def process(self, release):
+		self.calls.append(1)
+		release.wait(5)
+
+	def test_inflight(self):
+		release = threading.Event()
+		leader = self.jobs.submit(self.process, args=(release,), key='a')
+		follower = self.jobs.submit(self.process, args=(release,), key='a')
+		other = self.jobs.submit(self.process, args=(release,), key='b')
+		self.assertIs(leader, follower)
+		self.assertIsNot(leader, other)
+		self.assertEqual(leader.followers, 1)
+		release.set()
+		self.assertTrue(other.wait(5))
+		self.assertEqual(len(self.calls), 2)
+
+	def test_recently_finished(self):
+		release = threading.Event()
+		release.set()
+		leader = self.jobs.submit(self.process, args=(release,), key='a')
+		leader.wait(5)
+		self.assertIs(self.jobs.submit(self.process, args=(release,), key='a'), leader)
+
+		self.jobs.coalesce_ttl = 0
+		job = self.jobs.submit(self.process, args=(release,), key='a')
+		self.assertIsNot(job, leader)
+		job.wait(5)
+		self.assertEqual(len(self.calls), 2)
+
+	def test_failed_not_shared(self):
+		def fail():
+			raise Exception('certbot error')
+		leader = self.jobs.submit(fail, key='a')
+		leader.wait(5)
+		self.assertIsNot(self.jobs.submit(fail, key='a'), leader)
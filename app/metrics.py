@@ -0,0 +1,69 @@
+import time
+
+from prometheus_client import Counter, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+
+
+CERTBOT_DURATION = Histogram(
+    'dfple_certbot_duration_seconds', 'Duration of certbot runs, by command.',
+    ['command'], buckets=(1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600))
+
+DOCKER_API_DURATION = Histogram(
+    'dfple_docker_api_duration_seconds', 'Duration of docker API calls, by call.',
+    ['call'], buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+
+DFP_REQUEST_DURATION = Histogram(
+    'dfple_dfp_request_duration_seconds', 'Duration of docker-flow-proxy requests, by method.',
+    ['method'], buckets=(.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+
+DFP_REQUEST_ERRORS = Counter(
+    'dfple_dfp_request_errors_total', 'docker-flow-proxy requests that could not be sent, by method.',
+    ['method'])
+
+CHALLENGE_REQUESTS = Counter(
+    'dfple_acme_challenge_requests_total', 'ACME http-01 challenge requests, by result (hit or miss).',
+    ['result'])
+
+
+class StateCollector():
+    """
+        Metrics computed on scrape from the state of the service: job queue
+        depth, forward retries, dfp service updates, certificates expiry and
+        secrets count.
+    """
+
+    def __init__(self, client, jobs=None, retries=None, clock=time.time):
+        # DFPLEClient
+        self.client = client
+        self.jobs = jobs
+        self.retries = retries
+        self.clock = clock
+
+    def collect(self):
+        if self.jobs is not None:
+            yield GaugeMetricFamily('dfple_jobs_queued', 'Certificate jobs waiting for a worker.', value=self.jobs.size())
+
+        if self.retries is not None:
+            stats = self.retries.stats()
+            yield GaugeMetricFamily('dfple_dfp_retries_pending', 'docker-flow-proxy forwards waiting for a retry.', value=stats['pending'])
+            retries = CounterMetricFamily('dfple_dfp_retries', 'docker-flow-proxy forward retries, by result.', labels=['result'])
+            for result in ('retried', 'succeeded', 'failed'):
+                retries.add_metric([result], stats[result])
+            yield retries
+
+        stats = self.client.attachments.stats()
+        yield GaugeMetricFamily('dfple_dfp_secrets_pending', 'Secrets changes waiting for a dfp service update.', value=stats['pending'])
+        updates = CounterMetricFamily('dfple_dfp_service_updates', 'dfp service secrets updates, by result.', labels=['result'])
+        for result in ('updated', 'failed', 'given_up'):
+            updates.add_metric([result], stats[result])
+        yield updates
+
+        expiry = GaugeMetricFamily('dfple_certificate_expiry_days', 'Days before the certificate of a lineage expires.', labels=['lineage'])
+        now = self.clock()
+        for name, entry in sorted(self.client.cert_index.snapshot().items()):
+            if 'not_after' in entry:
+                expiry.add_metric([name], (entry['not_after'] - now) / 86400.0)
+        yield expiry
+
+        if self.client.docker_cache is not None:
+            yield GaugeMetricFamily('dfple_secrets', 'Docker secrets.', value=len(self.client.docker_cache.secrets()))
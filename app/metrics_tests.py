@@ -0,0 +1,61 @@
+import sys
+from mock import MagicMock
+from prometheus_client import REGISTRY, CollectorRegistry
+from unittest import TestCase
+
+from client_certbot import CertbotClient
+from client_dfp import DockerFlowProxyAPIClient
+from metrics import StateCollector
+
+
+class MetricsTestCase(TestCase):
+
+	def sample(self, name, labels=None, registry=REGISTRY):
+		return registry.get_sample_value(name, labels or {}) or 0
+
+	def test_certbot_duration(self):
+		count = self.sample('dfple_certbot_duration_seconds_count', {'command': '-c'})
+		certbot = CertbotClient(challenge='http', webroot_path='/tmp')
+		self.assertEqual(certbot.run([sys.executable, '-c', 'pass'])[2], 0)
+		self.assertEqual(self.sample('dfple_certbot_duration_seconds_count', {'command': '-c'}), count + 1)
+
+	def test_dfp_request(self):
+		adaptor = MagicMock()
+		adaptor.get.side_effect = [MagicMock(status_code=200), IOError('connection refused')]
+		client = DockerFlowProxyAPIClient('proxy', adaptor=adaptor)
+		count = self.sample('dfple_dfp_request_duration_seconds_count', {'method': 'get'})
+		errors = self.sample('dfple_dfp_request_errors_total', {'method': 'get'})
+
+		client.get('http://proxy:8080/v1/docker-flow-proxy/reconfigure')
+		self.assertRaises(IOError, client.get, 'http://proxy:8080/v1/docker-flow-proxy/reconfigure')
+		# failed requests are timed as well
+		self.assertEqual(self.sample('dfple_dfp_request_duration_seconds_count', {'method': 'get'}), count + 2)
+		self.assertEqual(self.sample('dfple_dfp_request_errors_total', {'method': 'get'}), errors + 1)
+
+	def test_state(self):
+		client = MagicMock()
+		client.cert_index.snapshot.return_value = {
+			'a.domain.com': {'not_after': 1000 + 86400 * 30},
+			'b.domain.com': {'error': 'unreadable'},
+		}
+		client.docker_cache.secrets.return_value = [1, 2, 3]
+		client.attachments.stats.return_value = {'pending': 2, 'failures': 1, 'updated': 7, 'failed': 3, 'given_up': 1}
+		jobs = MagicMock()
+		jobs.size.return_value = 4
+		retries = MagicMock()
+		retries.stats.return_value = {'pending': 1, 'retried': 5, 'succeeded': 3, 'failed': 1}
+
+		registry = CollectorRegistry()
+		registry.register(StateCollector(client, jobs, retries, clock=lambda: 1000))
+		self.assertEqual(self.sample('dfple_jobs_queued', registry=registry), 4)
+		self.assertEqual(self.sample('dfple_dfp_retries_pending', registry=registry), 1)
+		self.assertEqual(self.sample('dfple_dfp_retries_total', {'result': 'succeeded'}, registry=registry), 3)
+		self.assertEqual(self.sample('dfple_dfp_secrets_pending', registry=registry), 2)
+		self.assertEqual(self.sample('dfple_dfp_service_updates_total', {'result': 'given_up'}, registry=registry), 1)
+		self.assertEqual(self.sample('dfple_certificate_expiry_days', {'lineage': 'a.domain.com'}, registry=registry), 30)
+		self.assertEqual(registry.get_sample_value('dfple_certificate_expiry_days', {'lineage': 'b.domain.com'}), None)
+		self.assertEqual(self.sample('dfple_secrets', registry=registry), 3)
+
+		# without docker
+		client.docker_cache = None
+		self.assertEqual(registry.get_sample_value('dfple_secrets'), None)
@@ -0,0 +1,112 @@
+import errno
+import hashlib
+import os
+import shutil
+import tempfile
+
+import logging
+logger = logging.getLogger('letsencrypt')
+
+
+CHUNK_SIZE = 64 * 1024
+
+# os.replace is python 3 only, os.rename overwrites the destination on posix.
+_replace = getattr(os, 'replace', os.rename)
+
+def digest(paths):
+    """
+        sha256 of the concatenation of the given files, read by chunks.
+    """
+    h = hashlib.sha256()
+    for path in paths:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                h.update(chunk)
+    return h.hexdigest()
+
+def _copy(src, dst):
+    """
+        Append src to dst, in kernel with sendfile when available.
+    """
+    if hasattr(os, 'sendfile'):
+        offset = 0
+        size = os.fstat(src.fileno()).st_size
+        try:
+            while offset < size:
+                sent = os.sendfile(dst.fileno(), src.fileno(), offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+            return
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.ENOSYS) or offset:
+                raise
+    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+def _fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def write_concat(path, sources, mode=0o644):
+    """
+        Atomically replace path by the concatenation of sources.
+
+        Sources are streamed into a temporary file of the same folder, synced,
+        then renamed over path: readers see either the previous or the new
+        content. Nothing is written when path already has that content.
+
+        :return: True if path was written, False if unchanged
+    """
+    if os.path.exists(path) and digest([path]) == digest(sources):
+        return False
+
+    folder = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.{}.'.format(os.path.basename(path)))
+    try:
+        with os.fdopen(fd, 'wb') as dst:
+            for source in sources:
+                with open(source, 'rb') as src:
+                    _copy(src, dst)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.chmod(tmp_path, mode)
+        _replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    _fsync_dir(folder)
+    return True
+
+def replace_symlink(target, path):
+    """
+        Atomically point the symlink path to target.
+
+        :return: True if the link changed
+    """
+    try:
+        if os.readlink(path) == target:
+            return False
+    except OSError:
+        pass
+    # mktemp only picks an unused name, os.symlink fails rather than reuse a
+    # name another thread or worker took in the meantime: pick a new one.
+    folder = os.path.dirname(path)
+    prefix = '.{}.'.format(os.path.basename(path))
+    while True:
+        tmp_path = tempfile.mktemp(dir=folder, prefix=prefix)
+        try:
+            os.symlink(target, tmp_path)
+            break
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+    try:
+        _replace(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+    return True
@@ -0,0 +1,145 @@
+import threading
+import time
+
+import logging
+logger = logging.getLogger('letsencrypt')
+
+
+class RateLimitExceeded(Exception):
+    def __init__(self, message, retry_after):
+        Exception.__init__(self, message)
+        self.retry_after = retry_after
+
+
+class TokenBucket():
+    """
+        Bucket of `capacity` tokens, refilled continuously over `period` seconds.
+    """
+
+    def __init__(self, capacity, period, clock=time.time):
+        self.capacity = float(capacity)
+        self.rate = self.capacity / period
+        self.clock = clock
+        self.tokens = self.capacity
+        self.updated = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, tokens=1):
+        """
+            Seconds to wait before `tokens` tokens are available.
+        """
+        self._refill()
+        if self.tokens >= tokens:
+            return 0
+        return (tokens - self.tokens) / self.rate
+
+    def consume(self, tokens=1):
+        self._refill()
+        self.tokens -= tokens
+
+
+class RateLimiter():
+    """
+        Client side enforcement of letsencrypt rate limits
+        (https://letsencrypt.org/docs/rate-limits/):
+
+          * new orders per account per 3 hours
+          * certificates per registered domain per week
+          * failed validations per account per hostname per hour
+
+        Orders for a registered domain are also postponed once the ACME
+        server reported a rate limit, until the time it indicated.
+
+        The registered domain is approximated by the last two labels of the
+        domain name, the public suffix list is not used.
+    """
+
+    def __init__(self, orders=300, certs_per_domain=50, failed_validations=5, max_wait=60, clock=time.time, sleep=time.sleep):
+        self.orders = orders
+        self.certs_per_domain = certs_per_domain
+        self.failed_validations = failed_validations
+        # longest delay acquire() waits for tokens before giving up.
+        self.max_wait = max_wait
+        self.clock = clock
+        self.sleep = sleep
+
+        self._buckets = {}
+        # time before which no order is placed, by (account, registered domain).
+        self._postponed = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def registered_domain(domain):
+        return '.'.join(domain.lower().lstrip('*.').split('.')[-2:])
+
+    def _bucket(self, key, capacity, period):
+        if key not in self._buckets:
+            self._buckets[key] = TokenBucket(capacity, period, clock=self.clock)
+        return self._buckets[key]
+
+    def _orders_bucket(self, account):
+        return self._bucket(('orders', account), self.orders, 3 * 3600)
+
+    def _certs_buckets(self, account, domains):
+        # staging and production servers have separate limits.
+        return [self._bucket(('certs', account, x), self.certs_per_domain, 7 * 86400)
+                for x in set(self.registered_domain(d) for d in domains)]
+
+    def _failures_buckets(self, account, domains):
+        return [self._bucket(('failures', account, d.lower()), self.failed_validations, 3600)
+                for d in set(domains)]
+
+    def acquire(self, account, domains):
+        """
+            Wait until a new order for domains is allowed, and account for it.
+
+            :raises RateLimitExceeded: if the order would have to wait more than max_wait seconds.
+        """
+        while True:
+            with self._lock:
+                orders = self._orders_bucket(account)
+                certs = self._certs_buckets(account, domains)
+                failures = self._failures_buckets(account, domains)
+                wait = max([orders.wait_time()] +
+                           [x.wait_time() for x in certs] +
+                           [x.wait_time() for x in failures] +
+                           [self._postponed_wait(account, domains)])
+                if wait == 0:
+                    orders.consume()
+                    for bucket in certs:
+                        bucket.consume()
+                    return
+
+            if wait > self.max_wait:
+                raise RateLimitExceeded(
+                    'rate limit reached for {}, retry in {}s'.format(','.join(domains), int(wait)), wait)
+            logger.info('rate limit reached for {}, waiting {:.1f}s'.format(','.join(domains), wait))
+            self.sleep(wait)
+
+    def failed(self, account, domains):
+        """
+            Account for a failed validation of domains.
+        """
+        with self._lock:
+            for bucket in self._failures_buckets(account, domains):
+                bucket.consume()
+
+    def _postponed_wait(self, account, domains):
+        now = self.clock()
+        return max([0] + [self._postponed.get((account, x), now) - now
+                          for x in set(self.registered_domain(d) for d in domains)])
+
+    def postpone(self, account, domains, until=None, default=3600):
+        """
+            The ACME server refused an order for domains because of a rate
+            limit: postpone orders until `until`, or `default` seconds.
+        """
+        until = until or self.clock() + default
+        with self._lock:
+            for domain in set(self.registered_domain(d) for d in domains):
+                self._postponed[(account, domain)] = max(until, self._postponed.get((account, domain), 0))
+        logger.warning('orders for {} postponed for {}s.'.format(','.join(domains), int(until - self.clock())))
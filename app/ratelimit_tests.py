@@ -0,0 +1,98 @@
+from unittest import TestCase
+
+from ratelimit import RateLimiter, RateLimitExceeded, TokenBucket
+
+
+class Clock():
+
+	def __init__(self):
+		self.now = 0
+
+	def __call__(self):
+		return self.now
+
+	def sleep(self, seconds):
+		self.now += seconds
+
+
+class TokenBucketTestCase(TestCase):
+
+	def test_refill(self):
+		clock = Clock()
+		bucket = TokenBucket(3, 30, clock=clock)
+		for i in range(3):
+			self.assertEqual(bucket.wait_time(), 0)
+			bucket.consume()
+		self.assertAlmostEqual(bucket.wait_time(), 10)
+		clock.sleep(10)
+		self.assertEqual(bucket.wait_time(), 0)
+
+	def test_capacity(self):
+		clock = Clock()
+		bucket = TokenBucket(3, 30, clock=clock)
+		clock.sleep(1000)
+		bucket.consume(3)
+		self.assertAlmostEqual(bucket.wait_time(), 10)
+
+
+class RateLimiterTestCase(TestCase):
+
+	def setUp(self):
+		self.clock = Clock()
+
+	def limiter(self, **kwargs):
+		return RateLimiter(clock=self.clock, sleep=self.clock.sleep, **kwargs)
+
+	def test_registered_domain(self):
+		self.assertEqual(RateLimiter.registered_domain('a.b.Domain.com'), 'domain.com')
+		self.assertEqual(RateLimiter.registered_domain('*.domain.com'), 'domain.com')
+
+	def test_orders(self):
+		limiter = self.limiter(orders=2, max_wait=3 * 3600)
+		limiter.acquire('production', ['a.domain.com'])
+		limiter.acquire('production', ['b.other.com'])
+		self.assertEqual(self.clock.now, 0)
+		# the third order waits for a token
+		limiter.acquire('production', ['c.another.com'])
+		self.assertAlmostEqual(self.clock.now, 3 * 3600 / 2.)
+		# accounts are independent
+		limiter.acquire('staging', ['c.another.com'])
+		self.assertAlmostEqual(self.clock.now, 3 * 3600 / 2.)
+
+	def test_certs_per_domain(self):
+		limiter = self.limiter(certs_per_domain=2, max_wait=60)
+		limiter.acquire('production', ['a.domain.com'])
+		limiter.acquire('production', ['b.domain.com', 'www.other.com'])
+		limiter.acquire('production', ['a.another.com'])
+		with self.assertRaises(RateLimitExceeded) as cm:
+			limiter.acquire('production', ['c.domain.com'])
+		self.assertAlmostEqual(cm.exception.retry_after, 7 * 86400 / 2.)
+		# the staging server has its own budget
+		limiter.acquire('staging', ['c.domain.com'])
+
+	def test_failed_validations(self):
+		limiter = self.limiter(failed_validations=2, max_wait=60)
+		limiter.acquire('production', ['a.domain.com'])
+		limiter.failed('production', ['a.domain.com'])
+		limiter.failed('production', ['a.domain.com'])
+		with self.assertRaises(RateLimitExceeded):
+			limiter.acquire('production', ['a.domain.com'])
+		limiter.acquire('production', ['b.domain.com'])
+
+	def test_postpone(self):
+		limiter = self.limiter(max_wait=60)
+		limiter.postpone('production', ['a.domain.com'], until=7200)
+		with self.assertRaises(RateLimitExceeded) as e:
+			limiter.acquire('production', ['b.domain.com'])
+		self.assertEqual(e.exception.retry_after, 7200)
+		# other domains and accounts are not postponed
+		limiter.acquire('production', ['a.other.com'])
+		limiter.acquire('staging', ['a.domain.com'])
+		self.clock.sleep(7200)
+		limiter.acquire('production', ['a.domain.com'])
+
+	def test_postpone_default(self):
+		limiter = self.limiter(max_wait=3600)
+		limiter.postpone('production', ['a.domain.com'])
+		limiter.acquire('production', ['a.domain.com'])
+		self.assertEqual(self.clock.now, 3600)
@@ -0,0 +1,105 @@
+import collections
+import threading
+
+import docker
+
+from client_dfple import request_key, service_request
+
+import logging
+logger = logging.getLogger('letsencrypt')
+
+
+class ServiceReconciler():
+    """
+        Issue and deploy the certificates requested by service labels, from
+        docker service events instead of swarm-listener notifications.
+
+        Created and updated services are collected for `debounce` seconds,
+        then their requests not deployed yet (see DFPLEClient.deployed) are
+        passed at once to `submit`, a function taking a list of
+        (domains, email, testing). Every service is checked when the events
+        stream (re)starts.
+    """
+
+    def __init__(self, client, submit, debounce=5):
+        # DFPLEClient providing access to docker and to the deploy state.
+        self.client = client
+        self.submit = submit
+        self.debounce = debounce
+
+        # ids of the services to check, None standing for every service.
+        self.pending = set()
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def handle(self, event):
+        """
+            DockerCache listener.
+        """
+        if event is None:
+            service_id = None
+        elif event.get('Type') == 'service' and event.get('Action') in ('create', 'update'):
+            service_id = event.get('Actor', {}).get('ID')
+        else:
+            return
+        with self._lock:
+            self.pending.add(service_id)
+            if self.debounce <= 0:
+                return self._schedule(0)
+            if self._timer is None:
+                self._schedule(self.debounce)
+
+    def _schedule(self, delay):
+        self._timer = threading.Timer(delay, self.flush)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def services(self, ids):
+        if None in ids:
+            return self.client.docker_client.services.list()
+        services = []
+        for service_id in ids:
+            try:
+                services.append(self.client.docker_client.services.get(service_id))
+            except docker.errors.NotFound:
+                logger.debug('service {} removed in between'.format(service_id))
+        return services
+
+    def desired(self, services):
+        """
+            Certificate requests of services, duplicates removed.
+        """
+        requests = collections.OrderedDict()
+        for service in services:
+            request = service_request(service)
+            if request is not None:
+                requests.setdefault(request_key(*request), request)
+        return list(requests.values())
+
+    def flush(self):
+        """
+            Submit the requests of the pending services that are not deployed.
+
+            :return: submitted requests
+        """
+        with self._lock:
+            self._timer = None
+            ids, self.pending = self.pending, set()
+        if not ids:
+            return []
+
+        try:
+            requests = [x for x in self.desired(self.services(ids)) if not self.client.deployed(x[0], x[2])]
+        except Exception as e:
+            logger.error('services reconcile failed, retrying: {}'.format(e))
+            with self._lock:
+                self.pending.update(ids)
+                if self._timer is None:
+                    self._schedule(max(self.debounce, 5))
+            return []
+        if requests:
+            logger.info('services reconcile: {}'.format(', '.join(','.join(x[0]) for x in requests)))
+            self.submit(requests)
+        else:
+            logger.debug('services reconcile: certificates up to date.')
+        return requests
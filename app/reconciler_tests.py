@@ -0,0 +1,72 @@
+import docker
+from mock import MagicMock
+from unittest import TestCase
+
+from reconciler import ServiceReconciler, service_request
+
+
+def service(id, labels):
+	return docker.models.services.Service(attrs={'ID': id, 'Spec': {'Name': id, 'Labels': labels}})
+
+
+class ServiceReconcilerTestCase(TestCase):
+
+	def setUp(self):
+		self.services = {
+			'web': service('web', {'com.df.letsencrypt.host': 'site.domain.com,www.domain.com', 'com.df.letsencrypt.email': 'a@domain.com'}),
+			'web2': service('web2', {'com.df.letsencrypt.host': 'www.domain.com, site.domain.com', 'com.df.letsencrypt.email': 'a@domain.com'}),
+			'api': service('api', {'com.df.letsencrypt.host': 'api.domain.com', 'com.df.letsencrypt.email': 'a@domain.com', 'com.df.letsencrypt.testing': 'true'}),
+			'db': service('db', {'com.df.notify': 'true'}),
+		}
+		self.client = MagicMock()
+		self.client.docker_client.services.list.side_effect = lambda: list(self.services.values())
+		self.client.docker_client.services.get.side_effect = self.get
+		self.client.deployed.return_value = False
+		self.submitted = []
+		self.reconciler = ServiceReconciler(self.client, self.submitted.append, debounce=60)
+
+	def get(self, id):
+		if id not in self.services:
+			raise docker.errors.NotFound('service {} not found'.format(id))
+		return self.services[id]
+
+	def test_service_request(self):
+		self.assertEqual(service_request(self.services['web']), (['site.domain.com', 'www.domain.com'], 'a@domain.com', None))
+		self.assertEqual(service_request(self.services['api']), (['api.domain.com'], 'a@domain.com', True))
+		self.assertEqual(service_request(self.services['db']), None)
+		self.assertEqual(service_request(service('x', None)), None)
+
+	def test_events(self):
+		self.reconciler.handle({'Type': 'service', 'Action': 'update', 'Actor': {'ID': 'web'}})
+		self.reconciler.handle({'Type': 'service', 'Action': 'create', 'Actor': {'ID': 'db'}})
+		self.reconciler.handle({'Type': 'service', 'Action': 'create', 'Actor': {'ID': 'removed'}})
+		self.reconciler.handle({'Type': 'service', 'Action': 'remove', 'Actor': {'ID': 'api'}})
+		self.reconciler.handle({'Type': 'secret', 'Action': 'create', 'Actor': {'ID': 'x'}})
+		self.assertEqual(self.reconciler.pending, set(['web', 'db', 'removed']))
+		# a single debounce timer
+		timer = self.reconciler._timer
+		self.assertTrue(timer is not None)
+		timer.cancel()
+
+		self.assertEqual(self.reconciler.flush(), [(['site.domain.com', 'www.domain.com'], 'a@domain.com', None)])
+		self.assertEqual(self.submitted, [[(['site.domain.com', 'www.domain.com'], 'a@domain.com', None)]])
+		self.assertEqual(self.client.docker_client.services.list.call_count, 0)
+		self.assertEqual(self.reconciler.flush(), [])
+
+	def test_full_sync(self):
+		self.reconciler.handle(None)
+		self.reconciler._timer.cancel()
+		# deployed certificates are left alone, duplicated requests merged
+		self.client.deployed.side_effect = lambda domains, testing: domains == ['api.domain.com']
+		self.assertEqual(self.reconciler.flush(), [(['site.domain.com', 'www.domain.com'], 'a@domain.com', None)])
+		self.assertEqual(len(self.submitted), 1)
+
+	def test_error(self):
+		self.client.docker_client.services.list.side_effect = Exception('connection refused')
+		self.reconciler.handle(None)
+		self.reconciler._timer.cancel()
+		self.reconciler._timer = None
+		self.assertEqual(self.reconciler.flush(), [])
+		# retried later
+		self.assertEqual(self.reconciler.pending, set([None]))
+		self.reconciler._timer.cancel()
@@ -0,0 +1,131 @@
+import heapq
+import itertools
+import random
+import threading
+import time
+
+import logging
+logger = logging.getLogger('letsencrypt')
+
+
+class RetryScheduler():
+    """
+        Delay queue of failed calls, retried by a background thread.
+
+        A call is retried until it returns a true value, at most `retries`
+        times. The n-th retry happens interval * 2 ** (n - 1) seconds (capped
+        to max_interval) after the previous attempt, randomized by +/- jitter
+        to avoid retrying every call at once.
+
+        Calls due at the same time are run through `executor`, a map like
+        function (builtin map by default).
+    """
+
+    def __init__(self, retries=10, interval=5, max_interval=300, jitter=0.2, executor=None, clock=time.time):
+        self.retries = retries
+        self.interval = interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.executor = executor or (lambda func, items: list(map(func, items)))
+        self.clock = clock
+
+        self._queue = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+        self.retried = 0
+        self.succeeded = 0
+        self.failed = 0
+
+    def delay(self, attempt):
+        delay = min(self.max_interval, self.interval * 2 ** (attempt - 1))
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def schedule(self, func, args=(), description=None, attempt=1):
+        """
+            Retry func(*args) later, attempt being the number of the retry.
+        """
+        description = description or getattr(func, '__name__', repr(func))
+        if attempt > self.retries:
+            logger.error('{} failed, giving up after {} retries.'.format(description, self.retries))
+            with self._condition:
+                self.failed += 1
+            return
+        due = self.clock() + self.delay(attempt)
+        with self._condition:
+            heapq.heappush(self._queue, (due, next(self._counter), func, args, description, attempt))
+            self._condition.notify()
+        logger.debug('{} retry {} scheduled in {:.1f}s'.format(description, attempt, due - self.clock()))
+
+    def due(self):
+        """
+            Pop the calls due for retry.
+        """
+        now = self.clock()
+        calls = []
+        with self._condition:
+            while self._queue and self._queue[0][0] <= now:
+                calls.append(heapq.heappop(self._queue)[2:])
+        return calls
+
+    def run_due(self):
+        calls = self.due()
+        if not calls:
+            return 0
+
+        def call(item):
+            func, args, description, attempt = item
+            try:
+                return func(*args)
+            except Exception as e:
+                logger.error('{} failed: {}'.format(description, e))
+                return False
+
+        results = self.executor(call, calls)
+        for item, ok in zip(calls, results):
+            func, args, description, attempt = item
+            with self._condition:
+                self.retried += 1
+                if ok:
+                    self.succeeded += 1
+            if not ok:
+                self.schedule(func, args, description, attempt + 1)
+        return len(calls)
+
+    def stats(self):
+        with self._condition:
+            return {
+                'pending': len(self._queue),
+                'retried': self.retried,
+                'succeeded': self.succeeded,
+                'failed': self.failed,
+            }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._worker, name='retry-scheduler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def _worker(self):
+        while True:
+            with self._condition:
+                if self._stopped:
+                    return
+                if not self._queue:
+                    self._condition.wait()
+                    continue
+                wait = self._queue[0][0] - self.clock()
+                if wait > 0:
+                    self._condition.wait(wait)
+                    continue
+            try:
+                self.run_due()
+            except Exception as e:
+                logger.error('retry scheduler error: {}'.format(e))
@@ -0,0 +1,110 @@
+import threading
+import time
+from mock import patch
+from unittest import TestCase
+
+from retry import RetryScheduler
+
+
+class Clock():
+
+	def __init__(self):
+		self.now = 1000.0
+
+	def __call__(self):
+		return self.now
+
+
+class Call():
+	"""
+	Fails `failures` times, then succeeds.
+	"""
+
+	def __init__(self, failures=0, error=False):
+		self.failures = failures
+		self.error = error
+		self.calls = 0
+
+	def __call__(self, *args):
+		self.calls += 1
+		if self.calls <= self.failures:
+			if self.error:
+				raise Exception('connection refused')
+			return False
+		return True
+
+
+class RetrySchedulerTestCase(TestCase):
+
+	def setUp(self):
+		self.clock = Clock()
+		self.scheduler = RetryScheduler(retries=3, interval=5, max_interval=300, jitter=0, clock=self.clock)
+
+	def test_delay(self):
+		self.assertEqual([self.scheduler.delay(x) for x in range(1, 5)], [5, 10, 20, 40])
+		self.assertEqual(self.scheduler.delay(20), 300)
+
+		scheduler = RetryScheduler(interval=10, jitter=0.2)
+		for i in range(100):
+			self.assertTrue(8 <= scheduler.delay(1) <= 12)
+
+	def test_backoff(self):
+		call = Call(failures=2)
+		self.scheduler.schedule(call)
+		self.assertEqual(self.scheduler.stats()['pending'], 1)
+
+		self.clock.now += 4
+		self.assertEqual(self.scheduler.run_due(), 0)
+		self.clock.now += 1
+		self.assertEqual(self.scheduler.run_due(), 1)
+		self.assertEqual(call.calls, 1)
+		# second retry 10s later
+		self.clock.now += 9
+		self.assertEqual(self.scheduler.run_due(), 0)
+		self.clock.now += 1
+		self.assertEqual(self.scheduler.run_due(), 1)
+		self.clock.now += 20
+		self.assertEqual(self.scheduler.run_due(), 1)
+		self.assertEqual(call.calls, 3)
+		self.assertEqual(self.scheduler.stats(), {'pending': 0, 'retried': 3, 'succeeded': 1, 'failed': 0})
+
+	def test_give_up(self):
+		call = Call(failures=10, error=True)
+		self.scheduler.schedule(call)
+		for i in range(10):
+			self.clock.now += 300
+			self.scheduler.run_due()
+		self.assertEqual(call.calls, 3)
+		self.assertEqual(self.scheduler.stats(), {'pending': 0, 'retried': 3, 'succeeded': 0, 'failed': 1})
+
+	def test_order(self):
+		called = []
+		self.scheduler.schedule(lambda x: called.append(x) or True, args=('b',))
+		self.clock.now -= 1
+		self.scheduler.schedule(lambda x: called.append(x) or True, args=('a',))
+		self.clock.now += 10
+		self.assertEqual(self.scheduler.run_due(), 2)
+		self.assertEqual(called, ['a', 'b'])
+
+	def test_executor(self):
+		batches = []
+		def executor(func, items):
+			batches.append(len(items))
+			return [func(x) for x in items]
+		scheduler = RetryScheduler(retries=3, interval=5, jitter=0, executor=executor, clock=self.clock)
+		for i in range(3):
+			scheduler.schedule(Call())
+		self.clock.now += 5
+		scheduler.run_due()
+		self.assertEqual(batches, [3])
+
+	def test_worker(self):
+		scheduler = RetryScheduler(retries=3, interval=0.05, jitter=0)
+		scheduler.start()
+		self.addCleanup(scheduler.stop)
+		done = threading.Event()
+		def call():
+			done.set()
+			return True
+		scheduler.schedule(call)
+		self.assertTrue(done.wait(2))
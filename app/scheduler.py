@@ -0,0 +1,183 @@
+import random
+import threading
+import time
+
+import logging
+logger = logging.getLogger('letsencrypt')
+
+
+class RenewalScheduler():
+    """
+        Renew each lineage of the certificates index at its own time, instead
+        of renewing every due certificate at a fixed time of the day.
+
+        A lineage is due once `ratio` of its lifetime has elapsed, shifted by
+        up to +/- `jitter` of its lifetime so that certificates issued
+        together are not renewed together. The shift is derived from the
+        certificate fingerprint: it is stable across restarts, and changes
+        with each renewal.
+
+        Due lineages are passed to `renew`, a function taking a list of
+        lineage names and returning the job renewing them, at most
+        `concurrency` jobs running at once. A lineage whose renewal failed
+        is tried again `retry_interval` seconds later.
+
+        `retry_failed`, a function submitting again the failed certificate
+        requests, is called every `retry_interval` seconds.
+
+        `lineages`, a function returning the names of the lineages still in
+        use (None if unknown), restricts renewals: the lineages of removed
+        services are not renewed, they are checked again every `interval`
+        seconds.
+    """
+
+    def __init__(self, cert_index, renew, ratio=2 / 3.0, jitter=0.05, concurrency=1, interval=3600, retry_interval=3600, clock=time.time, retry_failed=None, lineages=None):
+        self.cert_index = cert_index
+        self.renew = renew
+        self.ratio = ratio
+        self.jitter = jitter
+        self.concurrency = max(1, int(concurrency))
+        # the index is refreshed at least every interval seconds.
+        self.interval = interval
+        self.retry_interval = retry_interval
+        self.clock = clock
+        self.retry_failed = retry_failed
+        self._retry_failed_at = 0
+        self.lineages = lineages
+
+        # running job by lineage name.
+        self._running = {}
+        # time before which a lineage is not submitted again, by lineage name.
+        self._retry_at = {}
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def due_at(self, entry):
+        lifetime = entry['not_after'] - entry['not_before']
+        shift = random.Random(entry.get('fingerprint') or entry['name']).uniform(-self.jitter, self.jitter)
+        return entry['not_before'] + lifetime * (self.ratio + shift)
+
+    def schedule(self):
+        """
+            :return: list of (due time, lineage name), soonest first
+        """
+        self.cert_index.refresh()
+        return sorted((self.due_at(entry), name) for name, entry in self.cert_index.snapshot().items()
+                      if 'error' not in entry)
+
+    def _reap(self):
+        for name, job in list(self._running.items()):
+            if job.finished():
+                del self._running[name]
+
+    def run_pending(self):
+        """
+            Submit renewal of the due lineages, up to concurrency running jobs.
+
+            :return: lineages submitted
+        """
+        now = self.clock()
+        if self.retry_failed is not None and self._retry_failed_at <= now:
+            self._retry_failed_at = now + self.retry_interval
+            self.retry_failed()
+
+        submitted = []
+        skipped = []
+        requested = False
+        for due, name in self.schedule():
+            if due > now:
+                break
+            if requested is False:
+                # looked up once, only when a lineage is due.
+                requested = self.lineages() if self.lineages is not None else None
+            if requested is not None and name not in requested:
+                with self._condition:
+                    if self._retry_at.get(name, 0) <= now:
+                        self._retry_at[name] = now + self.interval
+                        skipped.append(name)
+                continue
+            with self._condition:
+                self._reap()
+                if len(self._running) >= self.concurrency:
+                    break
+                if name in self._running or self._retry_at.get(name, 0) > now:
+                    continue
+                self._retry_at[name] = now + self.retry_interval
+            job = self.renew([name])
+            with self._condition:
+                self._running[name] = job
+            submitted.append(name)
+
+        if submitted:
+            logger.info('renewal of {} submitted.'.format(', '.join(submitted)))
+        if skipped:
+            logger.info('renewal of {} skipped, not requested by any service.'.format(', '.join(skipped)))
+        with self._condition:
+            for name in [x for x in self._retry_at if self._retry_at[x] <= now]:
+                del self._retry_at[name]
+        return submitted
+
+    def next_run(self):
+        """
+            Time of the next lineage due, or of the next index refresh.
+        """
+        now = self.clock()
+        next_run = now + self.interval
+        with self._condition:
+            self._reap()
+            saturated = len(self._running) >= self.concurrency
+            pending = set(self._running)
+            retry_at = dict(self._retry_at)
+        for due, name in self.schedule():
+            if name in pending:
+                continue
+            due = max(due, retry_at.get(name, 0))
+            if due <= now and saturated:
+                # wait for a running job to finish.
+                continue
+            next_run = min(next_run, due)
+        return next_run
+
+    def stats(self):
+        schedule = self.schedule()
+        with self._condition:
+            self._reap()
+            running = sorted(self._running)
+        return {
+            'lineages': len(schedule),
+            'running': running,
+            'next': [{'name': name, 'due': due} for due, name in schedule[:10]],
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._worker, name='renewal-scheduler')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+    def _worker(self):
+        while True:
+            try:
+                self.run_pending()
+                wait = self.next_run() - self.clock()
+            except Exception as e:
+                logger.error('renewal scheduler error: {}'.format(e))
+                wait = self.interval
+            with self._condition:
+                running = list(self._running.values())
+            if wait > 0 and running and len(running) >= self.concurrency:
+                # a slot frees up when a running renewal finishes.
+                running[0].wait(wait)
+                wait = 0
+            with self._condition:
+                if self._stopped:
+                    return
+                if wait > 0:
+                    self._condition.wait(wait)
+                if self._stopped:
+                    return
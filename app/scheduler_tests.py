@@ -0,0 +1,164 @@
+import threading
+from unittest import TestCase
+
+from scheduler import RenewalScheduler
+
+DAY = 86400
+
+
+class Clock():
+
+	def __init__(self):
+		self.now = 1000 * DAY
+
+	def __call__(self):
+		return self.now
+
+
+class Index():
+
+	def __init__(self):
+		self.entries = {}
+		self.refreshed = 0
+
+	def add(self, name, not_before, days=90, fingerprint=None):
+		self.entries[name] = {'name': name, 'domains': [name], 'not_before': not_before,
+			'not_after': not_before + days * DAY, 'fingerprint': fingerprint or name}
+
+	def refresh(self, names=None):
+		self.refreshed += 1
+
+	def snapshot(self):
+		return dict(self.entries)
+
+
+class Job():
+
+	def __init__(self, names):
+		self.names = names
+		self.done = threading.Event()
+
+	def finished(self):
+		return self.done.is_set()
+
+	def wait(self, timeout=None):
+		self.done.wait(timeout)
+
+
+class RenewalSchedulerTestCase(TestCase):
+
+	def setUp(self):
+		self.clock = Clock()
+		self.index = Index()
+		self.jobs = []
+		self.scheduler = RenewalScheduler(self.index, self.renew, jitter=0, clock=self.clock)
+
+	def renew(self, names):
+		job = Job(names)
+		self.jobs.append(job)
+		return job
+
+	def test_due_at(self):
+		self.index.add('a.domain.com', self.clock.now)
+		self.assertEqual(self.scheduler.due_at(self.index.entries['a.domain.com']), self.clock.now + 60 * DAY)
+
+		# jitter is stable for a certificate, and spreads certificates issued together.
+		scheduler = RenewalScheduler(self.index, self.renew, jitter=0.05, clock=self.clock)
+		dues = set()
+		for i in range(20):
+			self.index.add('site{}.domain.com'.format(i), self.clock.now)
+			entry = self.index.entries['site{}.domain.com'.format(i)]
+			due = scheduler.due_at(entry)
+			self.assertEqual(due, scheduler.due_at(entry))
+			self.assertTrue(self.clock.now + 55.5 * DAY <= due <= self.clock.now + 64.5 * DAY)
+			dues.add(due)
+		self.assertEqual(len(dues), 20)
+
+	def test_run_pending(self):
+		self.index.add('a.domain.com', self.clock.now - 70 * DAY)
+		self.index.add('b.domain.com', self.clock.now - 10 * DAY)
+		self.index.entries['c.domain.com'] = {'name': 'c.domain.com', 'error': 'unreadable'}
+
+		self.assertEqual(self.scheduler.run_pending(), ['a.domain.com'])
+		self.assertEqual(self.jobs[0].names, ['a.domain.com'])
+		# already running
+		self.assertEqual(self.scheduler.run_pending(), [])
+		self.assertEqual(self.scheduler.stats()['running'], ['a.domain.com'])
+
+		# renewed: the new certificate is due in 60 days.
+		self.index.add('a.domain.com', self.clock.now, fingerprint='renewed')
+		self.jobs[0].done.set()
+		self.assertEqual(self.scheduler.run_pending(), [])
+		self.assertEqual(self.scheduler.next_run(), self.clock.now + 3600)
+
+		self.clock.now += 50 * DAY
+		self.assertEqual(self.scheduler.run_pending(), ['b.domain.com'])
+
+	def test_concurrency(self):
+		for i in range(5):
+			self.index.add('site{}.domain.com'.format(i), self.clock.now - (70 + i) * DAY)
+		self.scheduler.concurrency = 2
+
+		# oldest first
+		self.assertEqual(self.scheduler.run_pending(), ['site4.domain.com', 'site3.domain.com'])
+		self.assertEqual(self.scheduler.run_pending(), [])
+		self.jobs[0].done.set()
+		self.assertEqual(self.scheduler.run_pending(), ['site2.domain.com'])
+
+	def test_retry(self):
+		self.index.add('a.domain.com', self.clock.now - 70 * DAY)
+		self.scheduler.run_pending()
+		# renewal failed, the certificate is unchanged.
+		self.jobs[0].done.set()
+		self.assertEqual(self.scheduler.run_pending(), [])
+		self.assertEqual(self.scheduler.next_run(), self.clock.now + 3600)
+
+		self.clock.now += 3600
+		self.assertEqual(self.scheduler.run_pending(), ['a.domain.com'])
+
+	def test_retry_failed(self):
+		retried = []
+		scheduler = RenewalScheduler(self.index, self.renew, jitter=0, clock=self.clock, retry_failed=lambda: retried.append(self.clock.now))
+		scheduler.run_pending()
+		scheduler.run_pending()
+		self.assertEqual(len(retried), 1)
+		self.clock.now += 3600
+		scheduler.run_pending()
+		self.assertEqual(len(retried), 2)
+
+	def test_lineages(self):
+		requested = set(['a.domain.com'])
+		scheduler = RenewalScheduler(self.index, self.renew, jitter=0, clock=self.clock, lineages=lambda: requested)
+		self.index.add('a.domain.com', self.clock.now - 70 * DAY)
+		# service removed
+		self.index.add('b.domain.com', self.clock.now - 70 * DAY)
+		self.assertEqual(scheduler.run_pending(), ['a.domain.com'])
+		self.assertEqual(scheduler.run_pending(), [])
+		self.index.add('a.domain.com', self.clock.now, fingerprint='renewed')
+		self.jobs[0].done.set()
+		self.assertEqual(scheduler.next_run(), self.clock.now + 3600)
+
+		# checked again once the service is back
+		requested.add('b.domain.com')
+		self.assertEqual(scheduler.run_pending(), [])
+		self.clock.now += 3600
+		self.assertEqual(scheduler.run_pending(), ['b.domain.com'])
+
+	def test_next_run(self):
+		self.assertEqual(self.scheduler.next_run(), self.clock.now + 3600)
+		self.index.add('a.domain.com', self.clock.now - 60 * DAY + 600)
+		self.assertEqual(self.scheduler.next_run(), self.clock.now + 600)
+
+	def test_worker(self):
+		scheduler = RenewalScheduler(self.index, self.renew, jitter=0)
+		self.index.add('a.domain.com', scheduler.clock() - 70 * DAY)
+		scheduler.start()
+		try:
+			for i in range(100):
+				if self.jobs:
+					break
+				threading.Event().wait(0.01)
+			self.assertEqual(self.jobs[0].names, ['a.domain.com'])
+		finally:
+			scheduler.stop()
+			self.jobs[0].done.set()
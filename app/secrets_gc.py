@@ -0,0 +1,107 @@
+import collections
+import threading
+import time
+
+from docker_cache import SECRET_NAME_RE, secret_base_name
+from metrics import DOCKER_API_DURATION
+
+import logging
+logger = logging.getLogger('letsencrypt')
+
+
+class SecretGarbageCollector():
+    """
+        Remove certificate secrets superseded by newer ones.
+
+        For each certificate, the `keep` newest secrets are kept, as well as
+        any secret still referenced by a service. Secrets are removed by
+        batches of `batch_size`, pausing `batch_interval` seconds in between.
+    """
+
+    def __init__(self, client, keep=2, dry_run=False, batch_size=50, batch_interval=1):
+        # DFPLEClient providing access to docker.
+        self.client = client
+        self.keep = max(1, keep)
+        self.dry_run = dry_run
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self._lock = threading.Lock()
+
+    def referenced(self):
+        """
+            IDs of the secrets used by services, or waiting to be attached.
+        """
+        ids = set()
+        with DOCKER_API_DURATION.labels('services.list').time():
+            services = self.client.docker_client.services.list()
+        for service in services:
+            ids.update(x['SecretID'] for x in self.client.service_get_secrets(service))
+        ids.update(x['SecretID'] for x in self.client.attachments.apply([]))
+        return ids
+
+    def collect(self):
+        """
+            Secrets that can be removed.
+        """
+        groups = collections.defaultdict(list)
+        for secret in self.client.secrets():
+            # only consider secrets created by DFPLEClient
+            if SECRET_NAME_RE.match(secret.name) and secret_base_name(secret.name).endswith('.pem'):
+                groups[secret_base_name(secret.name)].append(secret)
+
+        referenced = self.referenced()
+        garbage = []
+        for name, secrets in groups.items():
+            secrets.sort(key=lambda x: x.name)
+            garbage.extend(x for x in secrets[:-self.keep] if x.id not in referenced)
+        return sorted(garbage, key=lambda x: x.name)
+
+    def run(self):
+        """
+            :return: removed secrets (secrets to remove in dry run mode)
+        """
+        if not self._lock.acquire(False):
+            logger.debug('secrets garbage collection already running.')
+            return []
+        try:
+            garbage = self.collect()
+            logger.info('{} superseded secrets to remove{}.'.format(len(garbage), ' (dry run)' if self.dry_run else ''))
+
+            removed = []
+            for i in range(0, len(garbage), self.batch_size):
+                if i:
+                    time.sleep(self.batch_interval)
+                for secret in garbage[i:i + self.batch_size]:
+                    if self.dry_run:
+                        logger.info('secret {} would be removed.'.format(secret.name))
+                        removed.append(secret)
+                        continue
+                    try:
+                        with DOCKER_API_DURATION.labels('secrets.remove').time():
+                            secret.remove()
+                    except Exception as e:
+                        logger.error('unable to remove secret {}: {}'.format(secret.name, e))
+                        continue
+                    logger.debug('secret {} removed.'.format(secret.name))
+                    if self.client.docker_cache is not None:
+                        self.client.docker_cache.remove_secret(secret.id)
+                    removed.append(secret)
+            return removed
+        finally:
+            self._lock.release()
+
+    def start(self, interval):
+        """
+            Run the garbage collection every `interval` seconds.
+        """
+        def loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.run()
+                except Exception as e:
+                    logger.error('secrets garbage collection failed: {}'.format(e))
+
+        thread = threading.Thread(target=loop, name='secrets-gc')
+        thread.daemon = True
+        thread.start()
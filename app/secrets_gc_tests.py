@@ -0,0 +1,106 @@
+from mock import MagicMock, patch
+from unittest import TestCase
+
+from attachments import SecretAttachmentReconciler
+from docker_cache import DockerCache
+from secrets_gc import SecretGarbageCollector
+
+
+class Secret():
+
+	def __init__(self, id, name):
+		self.id = id
+		self.name = name
+		self.removed = False
+
+	def remove(self):
+		self.removed = True
+
+
+class Service():
+
+	def __init__(self, name, secrets):
+		self.name = name
+		self.secrets = secrets
+
+
+class FakeClient():
+	"""
+	Stands for DFPLEClient, services secrets are kept by service name.
+	"""
+
+	def __init__(self, secrets, services):
+		self.docker_client = MagicMock()
+		self.docker_client.secrets.list.return_value = secrets
+		self.docker_client.services.list.return_value = [Service(k, v) for k, v in services.items()]
+		self.docker_cache = DockerCache(self.docker_client)
+		self.attachments = SecretAttachmentReconciler(self)
+
+	def secrets(self):
+		return self.docker_cache.secrets()
+
+	def service_get_secrets(self, service):
+		return [{'SecretID': x, 'File': {'Name': x}} for x in service.secrets]
+
+
+class SecretGarbageCollectorTestCase(TestCase):
+
+	def setUp(self):
+		self.secrets = [
+			Secret('1', 'site.domain.com.pem-20170101-000000'),
+			Secret('2', 'site.domain.com.pem-20170201-000000'),
+			Secret('3', 'site.domain.com.pem-20170301-000000'),
+			Secret('4', 'site.domain.com.pem-20170401-000000'),
+			Secret('5', 'other.domain.com.pem-20170101-000000'),
+			Secret('6', 'other.domain.com.pem-20170201-000000'),
+			Secret('7', 'other.domain.com.pem-20170301-000000'),
+			# not created by dfple
+			Secret('8', 'db_password-20170101-000000'),
+			Secret('9', 'db_password-20170201-000000'),
+			Secret('10', 'db_password-20170301-000000'),
+			Secret('11', 'site.domain.com.pem'),
+		]
+		# the proxy still uses an old certificate of site.domain.com
+		self.client = FakeClient(self.secrets, {'proxy': ['2', '7'], 'db': ['8']})
+
+	def test_collect(self):
+		gc = SecretGarbageCollector(self.client, keep=2)
+		self.assertEqual([x.id for x in gc.collect()], ['5', '1'])
+
+		gc = SecretGarbageCollector(self.client, keep=1)
+		self.assertEqual([x.id for x in gc.collect()], ['5', '6', '1', '3'])
+
+	def test_collect_pending(self):
+		# secrets waiting to be attached are kept
+		self.client.attachments.attach('site.domain.com', self.secrets[0])
+		gc = SecretGarbageCollector(self.client, keep=2)
+		self.assertEqual([x.id for x in gc.collect()], ['5'])
+
+	def test_run(self):
+		gc = SecretGarbageCollector(self.client, keep=1)
+		self.assertEqual([x.id for x in gc.run()], ['5', '6', '1', '3'])
+		self.assertEqual([x.id for x in self.secrets if x.removed], ['1', '3', '5', '6'])
+		self.assertEqual(
+			sorted(x.id for x in self.client.docker_cache.secrets()),
+			sorted(['2', '4', '7', '8', '9', '10', '11']))
+		self.assertEqual(gc.run(), [])
+
+	def test_run_dry_run(self):
+		gc = SecretGarbageCollector(self.client, keep=1, dry_run=True)
+		self.assertEqual([x.id for x in gc.run()], ['5', '6', '1', '3'])
+		self.assertEqual([x for x in self.secrets if x.removed], [])
+		self.assertEqual(len(self.client.docker_cache.secrets()), len(self.secrets))
+
+	@patch('secrets_gc.time.sleep')
+	def test_run_batches(self, sleep):
+		gc = SecretGarbageCollector(self.client, keep=1, batch_size=3, batch_interval=2)
+		self.assertEqual(len(gc.run()), 4)
+		sleep.assert_called_once_with(2)
+
+	def test_run_remove_error(self):
+		def remove():
+			raise Exception('secret in use')
+		self.secrets[4].remove = remove
+		gc = SecretGarbageCollector(self.client, keep=1)
+		self.assertEqual([x.id for x in gc.run()], ['6', '1', '3'])
+		self.assertIn(self.secrets[4], self.client.docker_cache.secrets())
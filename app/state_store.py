@@ -0,0 +1,197 @@
+import contextlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import logging
+logger = logging.getLogger('letsencrypt')
+
+
+COLUMNS = ('domain', 'lineage', 'fingerprint', 'not_after', 'secret_id', 'secret_name', 'attached', 'deployed_at')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS deployments (
+    domain TEXT PRIMARY KEY,
+    lineage TEXT,
+    fingerprint TEXT NOT NULL,
+    not_after INTEGER,
+    secret_id TEXT,
+    secret_name TEXT,
+    attached INTEGER NOT NULL DEFAULT 0,
+    deployed_at REAL NOT NULL
+)
+"""
+
+# last outcome of each certificate request (domains, email, testing).
+REQUESTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS requests (
+    key TEXT PRIMARY KEY,
+    domains TEXT NOT NULL,
+    email TEXT NOT NULL,
+    testing INTEGER,
+    error TEXT,
+    failed_at REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL
+)
+"""
+
+
+class DeployStateStore():
+    """
+        Certificate deployed for each domain, persisted in a SQLite database
+        (`<certbot_path>/dfple-state.db`): lineage, fingerprint (sha256 of
+        the combined certificate), expiry, secret holding it and whether that
+        secret is attached to the DFP service (or the certificate was sent to
+        DFP, without docker).
+
+        Requests that failed (DNS not pointing to the proxy yet, certbot
+        error, rate limit...) are kept to be submitted again on renewal.
+
+        Used to skip secret creation, DFP PUT requests and service updates
+        when the certificate already deployed is identical. On startup the
+        state is compared to docker once (see DFPLEClient.reconcile_state)
+        instead of being rebuilt request after request.
+
+        The JSON state of previous versions (`dfple-state.json`) is imported
+        on first use.
+    """
+
+    def __init__(self, certbot_path, db_file=None):
+        self.db_file = db_file or os.path.join(certbot_path, 'dfple-state.db')
+        self._lock = threading.Lock()
+        # a single connection shared by every thread, serialized by _lock.
+        self._db = sqlite3.connect(self.db_file, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self.transaction() as db:
+            db.execute(SCHEMA)
+            db.execute(REQUESTS_SCHEMA)
+        self.migrate(os.path.join(os.path.dirname(self.db_file), 'dfple-state.json'))
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+            Changes made in the block are committed at once, or not at all.
+        """
+        with self._lock:
+            try:
+                yield self._db
+                self._db.commit()
+            except Exception:
+                self._db.rollback()
+                raise
+
+    def migrate(self, json_file):
+        if not os.path.exists(json_file):
+            return
+        try:
+            with open(json_file) as f:
+                entries = json.load(f)
+        except ValueError:
+            logger.warning('invalid deploy state {}, ignoring it.'.format(json_file))
+            entries = {}
+        with self.transaction() as db:
+            for domain, entry in entries.items():
+                db.execute('INSERT OR IGNORE INTO deployments (domain, fingerprint, secret_name, deployed_at) VALUES (?, ?, ?, ?)',
+                    (domain, entry['fingerprint'], entry.get('secret'), entry.get('deployed_at') or time.time()))
+        os.rename(json_file, '{}.migrated'.format(json_file))
+        logger.info('{} deployments imported from {}'.format(len(entries), json_file))
+
+    def all(self):
+        with self._lock:
+            rows = self._db.execute('SELECT * FROM deployments').fetchall()
+        return dict((row['domain'], dict(zip(COLUMNS, row))) for row in rows)
+
+    def get(self, domain):
+        with self._lock:
+            row = self._db.execute('SELECT * FROM deployments WHERE domain = ?', (domain,)).fetchone()
+        return dict(zip(COLUMNS, row)) if row is not None else None
+
+    def fingerprint(self, domain, secret=None):
+        """
+            Fingerprint of the certificate deployed for domain, None if unknown.
+
+            :param secret: only consider the certificate held by that secret name
+        """
+        entry = self.get(domain)
+        if entry is None or (secret is not None and entry['secret_name'] != secret):
+            return None
+        return entry['fingerprint']
+
+    def record(self, domain, fingerprint, lineage=None, not_after=None, secret=None, attached=False):
+        """
+            :param secret: docker secret holding the certificate
+            :param attached: the certificate is in use by DFP
+        """
+        with self.transaction() as db:
+            db.execute('INSERT OR REPLACE INTO deployments VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (
+                domain, lineage, fingerprint, not_after,
+                secret.id if secret is not None else None,
+                secret.name if secret is not None else None,
+                int(bool(attached)), time.time()))
+
+    def set_attached(self, secret_ids):
+        """
+            Flag the deployments whose secret is in secret_ids as attached, the others as detached.
+
+            :return: number of deployments whose status changed
+        """
+        secret_ids = set(x for x in secret_ids if x)
+        changed = 0
+        with self.transaction() as db:
+            for domain, secret_id, attached in db.execute(
+                    'SELECT domain, secret_id, attached FROM deployments WHERE secret_id IS NOT NULL').fetchall():
+                if bool(attached) != (secret_id in secret_ids):
+                    db.execute('UPDATE deployments SET attached = ? WHERE domain = ?', (int(not attached), domain))
+                    changed += 1
+        return changed
+
+    def forget_secrets(self, domains):
+        """
+            The secrets of domains no longer exist.
+        """
+        with self.transaction() as db:
+            db.executemany('UPDATE deployments SET secret_id = NULL, secret_name = NULL, attached = 0 WHERE domain = ?',
+                [(x,) for x in domains])
+
+    def record_request(self, key, domains, email, testing=None, error=None):
+        """
+            :param key: request identifier (see client_dfple.request_key)
+            :param error: error of the failed request, None if it succeeded
+        """
+        now = time.time()
+        key = json.dumps(list(key))
+        testing = None if testing is None else int(bool(testing))
+        with self.transaction() as db:
+            if error is None:
+                db.execute('INSERT OR REPLACE INTO requests VALUES (?, ?, ?, ?, NULL, NULL, 0, ?)',
+                    (key, ','.join(domains), email, testing, now))
+                return
+            row = db.execute('SELECT failed_at, attempts FROM requests WHERE key = ?', (key,)).fetchone()
+            failed_at, attempts = (row['failed_at'], row['attempts']) if row is not None else (None, 0)
+            db.execute('INSERT OR REPLACE INTO requests VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                (key, ','.join(domains), email, testing, str(error), failed_at or now, attempts + 1, now))
+
+    def failed_requests(self, max_age=None):
+        """
+            Requests whose last attempt failed, oldest failure first. Requests
+            failing for more than max_age seconds are given up.
+
+            :return: list of (domains, email, testing)
+        """
+        with self.transaction() as db:
+            if max_age is not None:
+                for row in db.execute('SELECT domains, error FROM requests WHERE failed_at < ?',
+                        (time.time() - max_age,)).fetchall():
+                    logger.warning('giving up request for {}, failing since more than {}s: {}'.format(
+                        row['domains'], int(max_age), row['error']))
+                db.execute('DELETE FROM requests WHERE failed_at < ?', (time.time() - max_age,))
+            rows = db.execute('SELECT domains, email, testing FROM requests WHERE failed_at IS NOT NULL ORDER BY failed_at').fetchall()
+        return [(row['domains'].split(','), row['email'], None if row['testing'] is None else bool(row['testing']))
+                for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
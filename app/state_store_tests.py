@@ -0,0 +1,94 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+from mock import patch
+from unittest import TestCase
+
+from state_store import DeployStateStore
+
+
+class Secret():
+
+	def __init__(self, id, name):
+		self.id = id
+		self.name = name
+
+
+class DeployStateStoreTestCase(TestCase):
+
+	def setUp(self):
+		self.certbot_path = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.certbot_path)
+
+	def test_record(self):
+		store = DeployStateStore(self.certbot_path)
+		self.assertEqual(store.fingerprint('site.domain.com'), None)
+
+		secret = Secret('1', 'site.domain.com.pem-20180101-000000')
+		store.record('site.domain.com', 'abc', lineage='site.domain.com', not_after=1500000000, secret=secret)
+		self.assertEqual(store.fingerprint('site.domain.com'), 'abc')
+		self.assertEqual(store.fingerprint('site.domain.com', secret='site.domain.com.pem-20180101-000000'), 'abc')
+		self.assertEqual(store.fingerprint('site.domain.com', secret='site.domain.com.pem-20180102-000000'), None)
+
+		# persisted
+		store.close()
+		store = DeployStateStore(self.certbot_path)
+		entry = store.get('site.domain.com')
+		self.assertEqual((entry['lineage'], entry['not_after'], entry['secret_id'], entry['attached']), ('site.domain.com', 1500000000, '1', 0))
+		self.assertEqual(list(store.all().keys()), ['site.domain.com'])
+
+	def test_requests(self):
+		store = DeployStateStore(self.certbot_path)
+		key = (('site.domain.com',), 'email@domain.com', False)
+		store.record_request(key, ['site.domain.com'], 'email@domain.com', error=Exception('unauthorized'))
+		store.record_request(('a',), ['a.domain.com'], 'email@domain.com', testing=True, error=Exception('dns'))
+		store.record_request(('b',), ['b.domain.com'], 'email@domain.com')
+		self.assertEqual(store.failed_requests(), [
+			(['site.domain.com'], 'email@domain.com', None),
+			(['a.domain.com'], 'email@domain.com', True)])
+
+		# succeeded on retry
+		store.record_request(key, ['site.domain.com'], 'email@domain.com')
+		self.assertEqual(store.failed_requests(), [(['a.domain.com'], 'email@domain.com', True)])
+
+		# failing for too long
+		store.close()
+		store = DeployStateStore(self.certbot_path)
+		with patch('state_store.time.time', return_value=time.time() + 3600):
+			self.assertEqual(store.failed_requests(max_age=60), [])
+		self.assertEqual(store.failed_requests(), [])
+
+	def test_attached(self):
+		store = DeployStateStore(self.certbot_path)
+		store.record('a.domain.com', 'a', secret=Secret('1', 'a.domain.com.pem'))
+		store.record('b.domain.com', 'b', secret=Secret('2', 'b.domain.com.pem'))
+		store.record('c.domain.com', 'c', attached=True)
+
+		self.assertEqual(store.set_attached(['1', '3']), 1)
+		self.assertEqual(store.set_attached(['1', '3']), 0)
+		self.assertEqual([store.get(x)['attached'] for x in ('a.domain.com', 'b.domain.com', 'c.domain.com')], [1, 0, 1])
+
+		store.forget_secrets(['a.domain.com'])
+		entry = store.get('a.domain.com')
+		self.assertEqual((entry['fingerprint'], entry['secret_id'], entry['attached']), ('a', None, 0))
+
+	def test_transaction(self):
+		store = DeployStateStore(self.certbot_path)
+		with self.assertRaises(ValueError):
+			with store.transaction() as db:
+				db.execute("INSERT INTO deployments (domain, fingerprint, deployed_at) VALUES ('a.domain.com', 'a', 0)")
+				raise ValueError()
+		self.assertEqual(store.get('a.domain.com'), None)
+
+	def test_migrate(self):
+		json_file = os.path.join(self.certbot_path, 'dfple-state.json')
+		with open(json_file, 'w') as f:
+			json.dump({'site.domain.com': {'fingerprint': 'abc', 'secret': 'site.domain.com.pem-20180101-000000', 'deployed_at': 1}}, f)
+
+		store = DeployStateStore(self.certbot_path)
+		self.assertEqual(store.fingerprint('site.domain.com', secret='site.domain.com.pem-20180101-000000'), 'abc')
+		self.assertFalse(os.path.exists(json_file))
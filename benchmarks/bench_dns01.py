@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+Compare DNS-01 provisioning of a certificate one name at a time (an update
+and a propagation wait per name, like standalone hook scripts) and in batch
+(a single update, then the propagation waits), against a local nameserver
+applying updates after a propagation delay.
+
+usage: python benchmarks/bench_dns01.py [--names 1,10,50] [--delay 2]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'app'))
+from dns_challenge import RFC2136Provider, challenge_name, wait_for_records
+from dns_fake import FakeDNSServer
+from dns_propagation import wait_for_txt
+
+
+def wait(name, value, nameservers=None, timeout=None):
+    return wait_for_txt(name, value, nameservers=nameservers, timeout=timeout, interval=0.2, max_interval=1)
+
+def one_by_one(provider, records, nameservers):
+    for record in records:
+        provider.create_records([record])
+        wait_for_records([record], 300, nameservers=nameservers, wait=wait)
+    provider.delete_records([x + (None,) for x in records])
+
+def batch(provider, records, nameservers):
+    created = provider.create_records(records)
+    wait_for_records(records, 300, nameservers=nameservers, wait=wait)
+    provider.delete_records(created)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--names', default='1,10,50')
+    parser.add_argument('--delay', type=float, default=2, help='propagation delay (seconds) of the nameserver')
+    options = parser.parse_args()
+
+    server = FakeDNSServer(zones=['domain.com'], delay=options.delay).start()
+    nameservers = [server.address]
+    provider = RFC2136Provider(server.address[0], server.port, zones=['domain.com'])
+
+    print('{:>6} {:>14} {:>10} {:>9}'.format('names', 'one by one (s)', 'batch (s)', 'speedup'))
+    for count in [int(x) for x in options.names.split(',')]:
+        records = [(challenge_name('site{}.domain.com'.format(i)), 'validation-{}'.format(i)) for i in range(count)]
+        durations = []
+        for func in (one_by_one, batch):
+            start = time.time()
+            func(provider, records, nameservers)
+            durations.append(time.time() - start)
+            # deletions are delayed as well.
+            time.sleep(options.delay)
+        print('{:>6} {:>14.2f} {:>10.2f} {:>8.1f}x'.format(count, durations[0], durations[1], durations[0] / durations[1]))
+    server.close()
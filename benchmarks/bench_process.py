@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+"""
+Drive certificate requests at scale against local stand-ins: the fake certbot
+executable, an in-process docker engine listening on a unix socket
+(`fake_docker.py`) and a docker-flow-proxy stand-in (`fake_dfp.py`).
+
+For each size, `cycles` bursts of notifications are sent for the same
+services, as swarm-listener does on each reconfiguration: the first burst
+issues and deploys every certificate, the next ones must neither run certbot
+nor write to docker. Throughput, latency percentiles, certbot runs and docker
+and docker-flow-proxy calls are reported for each burst.
+
+  * client : requests processed by DFPLEClient.process_many in this process,
+             latency of each DFPLEClient.process call.
+  * app    : reconfigure notifications sent to the HTTP server (app.py, run
+             as a subprocess), latency of the notification, until every job
+             finished and every secret is attached.
+
+The docker-flow-proxy stand-in listens on 127.0.0.1:8080, the port used by
+DockerFlowProxyAPIClient.
+
+usage: python benchmarks/bench_process.py [--targets client,app] [--sizes 1,10,100,1000] [--cycles 3] [--mode secrets]
+"""
+import argparse
+import collections
+import logging
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+APP_PATH = os.path.join(BENCHMARKS_PATH, '..', 'app')
+sys.path.insert(0, APP_PATH)
+
+from client_dfp import DockerFlowProxyAPIClient
+from client_dfple import DFPLEClient
+from fake_dfp import FakeDFP
+from fake_docker import FakeDockerEngine
+from load_test import percentile
+from prometheus_client import REGISTRY
+from prometheus_client.parser import text_string_to_metric_families
+from ratelimit import RateLimiter
+
+EMAIL = 'email@domain.com'
+DFP_HOST = '127.0.0.1'
+
+
+def domains(size):
+    return ['site{}.domain.com'.format(i) for i in range(size)]
+
+def docker_writes(calls):
+    return sum(count for call, count in calls.items() if not call.startswith('GET '))
+
+def report(size, cycle, duration, latencies, errors, certbot_runs, docker_calls, dfp_calls, verbose):
+    print('{:>6} {:>6} {:>9.2f} {:>9.1f} {:>9.1f} {:>9.1f} {:>7} {:>8} {:>7} {:>7} {:>6}'.format(
+        size, cycle, duration, len(latencies) / duration,
+        percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000,
+        errors, certbot_runs, sum(docker_calls.values()), docker_writes(docker_calls), sum(dfp_calls.values())))
+    if verbose:
+        for call, count in sorted((docker_calls + dfp_calls).items()):
+            print('{:>16} {:<50} {:>6}'.format('', call, count))
+
+
+class Stubs():
+    """
+        Fake docker engine (secrets mode only) and certbot folder of a run.
+    """
+
+    def __init__(self, options, proxy_service):
+        self.path = tempfile.mkdtemp(prefix='dfple-bench-')
+        self.certbot_path = os.path.join(self.path, 'certbot')
+        os.makedirs(self.certbot_path)
+        self.engine = None
+        if options.mode == 'secrets':
+            self.engine = FakeDockerEngine(os.path.join(self.path, 'docker.sock'), latency=options.docker_latency)
+            self.engine.add_service(proxy_service)
+            self.engine.start()
+
+    def docker_calls(self):
+        return collections.Counter(self.engine.calls) if self.engine is not None else collections.Counter()
+
+    def attached(self, proxy_service):
+        """
+            Number of certificate secrets attached to the proxy service.
+        """
+        if self.engine is None:
+            return None
+        service = self.engine.service(proxy_service)
+        return len(service['Spec']['TaskTemplate']['ContainerSpec'].get('Secrets') or [])
+
+    def cleanup(self):
+        # the docker events stream of the client stays open until the process exits.
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+def bench_client(options, size, dfp):
+    stubs = Stubs(options, 'proxy')
+    os.environ['FAKE_CERTBOT_PATH'] = stubs.certbot_path
+    client = DFPLEClient(
+        certbot_bin=os.path.join(BENCHMARKS_PATH, 'fake_certbot.py'),
+        certbot_path=stubs.certbot_path,
+        certbot_challenge='http',
+        certbot_webroot_path=stubs.path,
+        docker_client=stubs.engine.client() if stubs.engine is not None else None,
+        dfp_service_name='proxy',
+        dfp_client=DockerFlowProxyAPIClient(DFP_HOST),
+        dfp_update_debounce=options.debounce,
+        issue_concurrency=options.concurrency,
+        # letsencrypt rate limits do not apply to the fake certbot.
+        rate_limiter=RateLimiter(orders=10 ** 6, certs_per_domain=10 ** 6))
+    client.start()
+
+    latencies = []
+    lock = threading.Lock()
+    process = client.process
+
+    def timed_process(*args, **kwargs):
+        start = time.time()
+        try:
+            return process(*args, **kwargs)
+        finally:
+            with lock:
+                latencies.append(time.time() - start)
+    client.process = timed_process
+
+    batch = [([domain], EMAIL, None) for domain in domains(size)]
+    try:
+        for cycle in range(1, options.cycles + 1):
+            del latencies[:]
+            docker_calls, dfp_calls = stubs.docker_calls(), collections.Counter(dfp.calls)
+            certbot_runs = REGISTRY.get_sample_value('dfple_certbot_duration_seconds_count', {'command': 'certonly'}) or 0
+
+            start = time.time()
+            errors = client.process_many(batch)
+            client.attachments.flush()
+            duration = time.time() - start
+
+            report(size, cycle, duration, latencies, len([x for x in errors if x is not None]),
+                int((REGISTRY.get_sample_value('dfple_certbot_duration_seconds_count', {'command': 'certonly'}) or 0) - certbot_runs),
+                stubs.docker_calls() - docker_calls, collections.Counter(dfp.calls) - dfp_calls, options.verbose)
+    finally:
+        client.attachments.flush()
+        stubs.cleanup()
+
+
+class App():
+    """
+        app.py run as a subprocess, configured to use the stand-ins.
+    """
+
+    def __init__(self, options, stubs):
+        self.url = 'http://127.0.0.1:{}'.format(options.port)
+        self.session = requests.Session()
+        self.session.mount('http://', requests.adapters.HTTPAdapter(
+            pool_connections=options.concurrency, pool_maxsize=options.concurrency))
+
+        env = dict(os.environ,
+            CERTBOT_BIN=os.path.join(BENCHMARKS_PATH, 'fake_certbot.py'),
+            CERTBOT_PATH=stubs.certbot_path,
+            CERTBOT_WEBROOT_PATH=stubs.path,
+            FAKE_CERTBOT_PATH=stubs.certbot_path,
+            # docker service and docker-flow-proxy host share the same name.
+            DF_PROXY_SERVICE_NAME=DFP_HOST,
+            DF_PROXY_UPDATE_DEBOUNCE=str(options.debounce),
+            ISSUE_CONCURRENCY=str(options.concurrency),
+            JOB_WORKERS=str(options.concurrency),
+            RATE_LIMIT_ORDERS=str(10 ** 6),
+            RATE_LIMIT_CERTS_PER_DOMAIN=str(10 ** 6),
+            RENEWAL_SCHEDULER='false',
+            LOG='error',
+            PORT=str(options.port))
+        env.pop('DOCKER_SOCKET_PATH', None)
+        if stubs.engine is not None:
+            env['DOCKER_SOCKET_PATH'] = stubs.engine.socket_path
+        # access logs are kept out of the report.
+        self.log_file = os.path.join(stubs.path, 'app.log')
+        with open(self.log_file, 'w') as log:
+            self.process = subprocess.Popen([options.python, 'app.py'], cwd=options.app_path, env=env,
+                stdout=log, stderr=subprocess.STDOUT)
+
+        deadline = time.time() + 30
+        while True:
+            try:
+                if self.session.get(self.url + '/metrics', timeout=1).status_code == 200:
+                    break
+            except requests.ConnectionError:
+                pass
+            if self.process.poll() is not None or time.time() > deadline:
+                with open(self.log_file) as log:
+                    raise Exception('app.py did not start:\n{}'.format(log.read()[-2000:]))
+            time.sleep(0.1)
+
+    def certbot_runs(self):
+        for family in text_string_to_metric_families(self.session.get(self.url + '/metrics').text):
+            for sample in family.samples:
+                if sample.name == 'dfple_certbot_duration_seconds_count' and sample.labels.get('command') == 'certonly':
+                    return int(sample.value)
+        return 0
+
+    def notify(self, i, domain):
+        """
+            :return: job id, None if the notification failed
+        """
+        response = self.session.get(self.url + '/v1/docker-flow-proxy-letsencrypt/reconfigure', params={
+            'serviceName': 'service{}'.format(i),
+            'servicePath': '/',
+            'port': '80',
+            'letsencrypt.host': domain,
+            'letsencrypt.email': EMAIL,
+        }, timeout=30)
+        return response.json()['job'] if response.status_code == 200 else None
+
+    def wait(self, job_id):
+        """
+            :return: True if the job succeeded
+        """
+        while True:
+            response = self.session.get(self.url + '/v1/docker-flow-proxy-letsencrypt/jobs/{}'.format(job_id))
+            if response.status_code == 404:
+                # dropped from the jobs history, finished long ago.
+                return True
+            status = response.json()['status']
+            if status in ('done', 'failed'):
+                return status == 'done'
+            time.sleep(0.05)
+
+    def stop(self):
+        self.process.send_signal(signal.SIGTERM)
+        try:
+            self.process.wait()
+        except KeyboardInterrupt:
+            self.process.kill()
+
+
+def bench_app(options, size, dfp):
+    stubs = Stubs(options, DFP_HOST)
+    app = App(options, stubs)
+    names = domains(size)
+    try:
+        for cycle in range(1, options.cycles + 1):
+            docker_calls, dfp_calls = stubs.docker_calls(), collections.Counter(dfp.calls)
+            certbot_runs = app.certbot_runs()
+
+            latencies = []
+            jobs = []
+            lock = threading.Lock()
+            counter = iter(range(size))
+
+            def worker():
+                while True:
+                    with lock:
+                        i = next(counter, None)
+                    if i is None:
+                        return
+                    start = time.time()
+                    try:
+                        job_id = app.notify(i, names[i])
+                    except Exception:
+                        job_id = None
+                    with lock:
+                        latencies.append(time.time() - start)
+                        jobs.append(job_id)
+
+            start = time.time()
+            threads = [threading.Thread(target=worker) for i in range(options.concurrency)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            errors = len([x for x in jobs if x is None])
+            errors += len([x for x in set(jobs) if x is not None and not app.wait(x)])
+            # pending secrets are attached after the debounce delay.
+            while stubs.engine is not None and stubs.attached(DFP_HOST) < size - errors and time.time() - start < 600:
+                time.sleep(0.05)
+            duration = time.time() - start
+
+            report(size, cycle, duration, latencies, errors, app.certbot_runs() - certbot_runs,
+                stubs.docker_calls() - docker_calls, collections.Counter(dfp.calls) - dfp_calls, options.verbose)
+    finally:
+        app.stop()
+        if stubs.engine is not None:
+            stubs.engine.stop()
+        stubs.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--targets', default='client,app')
+    parser.add_argument('--sizes', default='1,10,100,1000')
+    parser.add_argument('--cycles', type=int, default=3, help='notification bursts per size')
+    parser.add_argument('--mode', default='secrets', choices=('secrets', 'put'),
+        help='certificates sent as docker secrets, or PUT on docker-flow-proxy (no docker)')
+    parser.add_argument('--concurrency', type=int, default=4, help='issue concurrency and notifying clients')
+    parser.add_argument('--debounce', type=float, default=1, help='docker-flow-proxy service update debounce (seconds)')
+    parser.add_argument('--docker-latency', type=float, default=0, help='delay of each docker API call (seconds)')
+    parser.add_argument('--startup', default='0.3', help='fake certbot startup time (seconds)')
+    parser.add_argument('--issue', default='0.05', help='fake certbot time per certificate (seconds)')
+    parser.add_argument('--fail-ratio', default='0', help='ratio of failing certbot runs')
+    parser.add_argument('--python', default=sys.executable, help='interpreter running app.py')
+    parser.add_argument('--app-path', default=APP_PATH)
+    parser.add_argument('--port', type=int, default=8081, help='app.py port')
+    parser.add_argument('--verbose', action='store_true', help='report calls by endpoint')
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    os.environ['FAKE_CERTBOT_STARTUP'] = options.startup
+    os.environ['FAKE_CERTBOT_ISSUE'] = options.issue
+    os.environ['FAKE_CERTBOT_FAIL_RATIO'] = options.fail_ratio
+
+    dfp = FakeDFP((DFP_HOST, 8080))
+    dfp.start()
+
+    benches = {'client': bench_client, 'app': bench_app}
+    for target in options.targets.split(','):
+        print('{} ({} mode)'.format(target, options.mode))
+        print('{:>6} {:>6} {:>9} {:>9} {:>9} {:>9} {:>7} {:>8} {:>7} {:>7} {:>6}'.format(
+            'N', 'cycle', 'wall (s)', 'req/s', 'p50 (ms)', 'p99 (ms)', 'errors', 'certbot', 'docker', 'writes', 'DFP'))
+        for size in [int(x) for x in options.sizes.split(',')]:
+            benches[target](options, size, dfp)
+    dfp.stop()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Compare the wall time of a renewal window when certificates are renewed one
+request per service (one certbot process each) and in batch mode (a single
+`certbot renew` process), using the fake certbot executable.
+
+usage: python benchmarks/bench_renew.py [--sizes 10,100,500] [--startup 0.3] [--issue 0.05]
+"""
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+BENCHMARKS_PATH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(BENCHMARKS_PATH, '..', 'app'))
+
+from client_dfp import DockerFlowProxyAPIClient
+from ratelimit import RateLimiter
+from client_dfple import DFPLEClient
+from fake_certbot import write_lineage
+
+
+class NullResponse():
+    status_code = 200
+    text = ''
+
+class NullAdaptor():
+    """
+    Replaces requests, DFP calls are only counted.
+    """
+    def __init__(self):
+        self.calls = 0
+
+    def put(self, url, **kwargs):
+        self.calls += 1
+        return NullResponse()
+
+    def get(self, url, **kwargs):
+        self.calls += 1
+        return NullResponse()
+
+
+def setup(size):
+    """
+    Create a certbot folder with `size` lineages due for renewal.
+    """
+    certbot_path = tempfile.mkdtemp(prefix='dfple-bench-')
+    domains = ['site{}.domain.com'.format(i) for i in range(size)]
+    for domain in domains:
+        write_lineage(os.path.join(certbot_path, 'live', domain), [domain], days=90, age=70)
+
+    os.environ['FAKE_CERTBOT_PATH'] = certbot_path
+    client = DFPLEClient(
+        certbot_bin=os.path.join(BENCHMARKS_PATH, 'fake_certbot.py'),
+        certbot_path=certbot_path,
+        certbot_challenge='http',
+        certbot_webroot_path=certbot_path,
+        # letsencrypt rate limits do not apply to the fake certbot.
+        rate_limiter=RateLimiter(orders=10 ** 6, certs_per_domain=10 ** 6))
+    adaptor = NullAdaptor()
+    client.dfp_client = DockerFlowProxyAPIClient('proxy', adaptor=adaptor)
+    return certbot_path, client, adaptor, domains
+
+def bench_per_service(size):
+    certbot_path, client, adaptor, domains = setup(size)
+    try:
+        start = time.time()
+        for domain in domains:
+            client.process([domain], 'email@domain.com')
+        return time.time() - start, adaptor.calls
+    finally:
+        shutil.rmtree(certbot_path)
+
+def bench_batch(size):
+    certbot_path, client, adaptor, domains = setup(size)
+    try:
+        start = time.time()
+        renewed = client.renew()
+        assert len(renewed) == size, renewed
+        return time.time() - start, adaptor.calls
+    finally:
+        shutil.rmtree(certbot_path)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--sizes', default='10,100,500')
+    parser.add_argument('--startup', default='0.3', help='fake certbot startup time (seconds)')
+    parser.add_argument('--issue', default='0.05', help='fake certbot time per certificate (seconds)')
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.ERROR)
+    os.environ['FAKE_CERTBOT_STARTUP'] = options.startup
+    os.environ['FAKE_CERTBOT_ISSUE'] = options.issue
+
+    print('{:>6} {:>14} {:>10} {:>8}'.format('N', 'mode', 'wall (s)', 'DFP PUT'))
+    for size in [int(x) for x in options.sizes.split(',')]:
+        for mode, bench in (('per-service', bench_per_service), ('batch', bench_batch)):
+            duration, calls = bench(size)
+            print('{:>6} {:>14} {:>10.2f} {:>8}'.format(size, mode, duration, calls))
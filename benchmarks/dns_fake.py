@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+"""
+Local DNS server standing in for an authoritative nameserver: answers queries
+from memory and applies RFC 2136 dynamic updates, over UDP and TCP.
+
+usage: python benchmarks/dns_fake.py [--port 5353] [--zone domain.com] [--delay 0]
+"""
+import argparse
+import socket
+import struct
+import threading
+import time
+
+import dns.message
+import dns.opcode
+import dns.rcode
+import dns.rdataclass
+import dns.rdatatype
+import dns.rrset
+
+import logging
+logger = logging.getLogger('letsencrypt')
+
+
+class FakeDNSServer():
+    """
+        Records are kept in `records`: {(name, type): [rdata text, ...]},
+        names being absolute (trailing dot).
+
+        Updates become visible `delay` seconds after they are received,
+        standing for the propagation delay of a real zone.
+    """
+
+    def __init__(self, records=None, host='127.0.0.1', port=0, zones=None, delay=0, keyring=None):
+        self.records = records if records is not None else {}
+        self.delay = delay
+        self.keyring = keyring
+        self.queries = 0
+        self.updates = 0
+        self._lock = threading.Lock()
+
+        for zone in zones or []:
+            zone = zone.rstrip('.') + '.'
+            self.records.setdefault((zone, 'SOA'), ['ns1.{} admin.{} 1 7200 3600 1209600 60'.format(zone, zone)])
+            self.records.setdefault((zone, 'NS'), ['ns1.{}'.format(zone)])
+            self.records.setdefault(('ns1.{}'.format(zone), 'A'), [host])
+
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind((host, port))
+        self.address = self.udp.getsockname()
+        self.port = self.address[1]
+        self.tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.tcp.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.tcp.bind(self.address)
+        self.tcp.listen(16)
+
+    def start(self):
+        for target in (self._serve_udp, self._serve_tcp):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+        return self
+
+    def close(self):
+        self.udp.close()
+        try:
+            self.tcp.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.tcp.close()
+
+    def _serve_udp(self):
+        while True:
+            try:
+                data, address = self.udp.recvfrom(65535)
+            except socket.error:
+                return
+            response = self.handle(data)
+            if response is not None:
+                self.udp.sendto(response, address)
+
+    def _serve_tcp(self):
+        while True:
+            try:
+                conn, address = self.tcp.accept()
+            except socket.error:
+                return
+            thread = threading.Thread(target=self._serve_tcp_connection, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def _serve_tcp_connection(self, conn):
+        def read(size):
+            data = b''
+            while len(data) < size:
+                chunk = conn.recv(size - len(data))
+                if not chunk:
+                    return None
+                data += chunk
+            return data
+        try:
+            while True:
+                length = read(2)
+                if length is None:
+                    return
+                data = read(struct.unpack('!H', length)[0])
+                if data is None:
+                    return
+                response = self.handle(data)
+                if response is not None:
+                    conn.sendall(struct.pack('!H', len(response)) + response)
+        except socket.error:
+            pass
+        finally:
+            conn.close()
+
+    def handle(self, data):
+        try:
+            message = dns.message.from_wire(data, keyring=self.keyring)
+        except Exception as e:
+            logger.warning('invalid dns message: {}'.format(e))
+            return None
+        response = dns.message.make_response(message)
+        if message.opcode() == dns.opcode.UPDATE:
+            if self.keyring and not message.had_tsig:
+                response.set_rcode(dns.rcode.REFUSED)
+                return response.to_wire()
+            self.updates += 1
+            # dnspython < 2 exposes the update section as authority
+            changes = getattr(message, 'update', None)
+            if changes is None:
+                changes = message.authority
+            # dnspython >= 2 keeps the class of deletions apart
+            changes = [(x.name.to_text(), getattr(x, 'deleting', None) or x.rdclass,
+                        dns.rdatatype.to_text(x.rdtype), [r.to_text() for r in x]) for x in changes]
+            if self.delay:
+                timer = threading.Timer(self.delay, self.apply, args=(changes,))
+                timer.daemon = True
+                timer.start()
+            else:
+                self.apply(changes)
+        else:
+            self.queries += 1
+            self.answer(message, response)
+        return response.to_wire()
+
+    def apply(self, changes):
+        with self._lock:
+            for name, rdclass, rdtype, rdatas in changes:
+                if rdclass == dns.rdataclass.ANY:
+                    # delete an rrset, or every rrset of name
+                    for key in list(self.records):
+                        if key[0] == name and rdtype in (key[1], 'ANY'):
+                            del self.records[key]
+                elif rdclass == dns.rdataclass.NONE:
+                    values = self.records.get((name, rdtype), [])
+                    values[:] = [x for x in values if x not in rdatas]
+                    if not values:
+                        self.records.pop((name, rdtype), None)
+                else:
+                    values = self.records.setdefault((name, rdtype), [])
+                    values.extend(x for x in rdatas if x not in values)
+
+    def answer(self, message, response):
+        question = message.question[0]
+        name = question.name.to_text()
+        rdtype = dns.rdatatype.to_text(question.rdtype)
+        with self._lock:
+            rdatas = list(self.records.get((name, rdtype), []))
+            known = any(x[0] == name for x in self.records)
+        if rdatas:
+            response.answer.append(dns.rrset.from_text_list(name, 60, 'IN', rdtype, rdatas))
+        elif not known:
+            response.set_rcode(dns.rcode.NXDOMAIN)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5353)
+    parser.add_argument('--zone', action='append', default=[])
+    parser.add_argument('--delay', type=float, default=0, help='delay (seconds) before updates are visible')
+    options = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    server = FakeDNSServer(host=options.host, port=options.port, zones=options.zone, delay=options.delay).start()
+    logger.info('fake dns server listening on {}:{}'.format(options.host, server.port))
+    while True:
+        time.sleep(3600)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+"""
+Fake certbot executable used by benchmarks.
+
+Supports the `certonly` and `renew` commands as called by CertbotClient and
+writes self signed certificates into the lineages of FAKE_CERTBOT_PATH.
+
+Environment:
+    FAKE_CERTBOT_PATH       certbot config dir (default /etc/letsencrypt)
+    FAKE_CERTBOT_STARTUP    seconds spent at startup (interpreter, ACME directory and account)
+    FAKE_CERTBOT_ISSUE      seconds spent per issued certificate
+    FAKE_CERTBOT_OUTCOME    ok, unauthorized or error
+    FAKE_CERTBOT_FAIL_RATIO with the ok outcome, ratio of runs failing as unauthorized
+"""
+import calendar
+import datetime
+import os
+import random
+import sys
+import time
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+
+RENEW_BEFORE = 30
+
+def write_lineage(path, domains, days=90, age=0):
+    """
+    Write a self signed certificate for domains into the lineage directory path.
+    """
+    key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    not_before = datetime.datetime.utcnow() - datetime.timedelta(days=age)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, domains[0])])
+    cert = x509.CertificateBuilder() \
+        .subject_name(name) \
+        .issuer_name(name) \
+        .public_key(key.public_key()) \
+        .serial_number(x509.random_serial_number()) \
+        .not_valid_before(not_before) \
+        .not_valid_after(not_before + datetime.timedelta(days=days)) \
+        .add_extension(x509.SubjectAlternativeName([x509.DNSName(d) for d in domains]), critical=False) \
+        .sign(key, hashes.SHA256(), default_backend())
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+    for filename, data in (
+            ('fullchain.pem', cert.public_bytes(serialization.Encoding.PEM)),
+            ('privkey.pem', key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.TraditionalOpenSSL,
+                serialization.NoEncryption()))):
+        with open(os.path.join(path, filename), 'wb') as f:
+            f.write(data)
+
+def lineage_due(path):
+    with open(os.path.join(path, 'fullchain.pem'), 'rb') as f:
+        cert = x509.load_pem_x509_certificate(f.read(), default_backend())
+    not_after = getattr(cert, 'not_valid_after_utc', None) or cert.not_valid_after
+    return calendar.timegm(not_after.utctimetuple()) - time.time() < RENEW_BEFORE * 86400
+
+def main(argv):
+    certbot_path = os.environ.get('FAKE_CERTBOT_PATH', '/etc/letsencrypt')
+    live_path = os.path.join(certbot_path, 'live')
+    issue_time = float(os.environ.get('FAKE_CERTBOT_ISSUE', 0.05))
+    outcome = os.environ.get('FAKE_CERTBOT_OUTCOME', 'ok')
+    if outcome == 'ok' and random.random() < float(os.environ.get('FAKE_CERTBOT_FAIL_RATIO', 0)):
+        outcome = 'unauthorized'
+
+    time.sleep(float(os.environ.get('FAKE_CERTBOT_STARTUP', 0.3)))
+
+    if outcome == 'unauthorized':
+        sys.stderr.write('urn:acme:error:unauthorized :: The client lacks sufficient authorization\n')
+        return 1
+    if outcome != 'ok':
+        sys.stderr.write('An unexpected error occurred\n')
+        return 1
+
+    if argv[0] == 'certonly':
+        domains = argv[argv.index('--domains') + 1].split(',')
+        path = os.path.join(live_path, domains[0])
+        if os.path.exists(path) and not lineage_due(path):
+            print('Certificate not yet due for renewal; no action taken.')
+            return 0
+        time.sleep(issue_time)
+        write_lineage(path, domains)
+        print('Congratulations! Your certificate and chain have been saved at {}'.format(path))
+
+    elif argv[0] == 'renew':
+        if '--cert-name' in argv:
+            names = [argv[argv.index('--cert-name') + 1]]
+        else:
+            names = sorted(os.listdir(live_path)) if os.path.isdir(live_path) else []
+        force = '--force-renewal' in argv
+        renewed = 0
+        for name in names:
+            path = os.path.join(live_path, name)
+            if not force and not lineage_due(path):
+                continue
+            with open(os.path.join(path, 'fullchain.pem'), 'rb') as f:
+                cert = x509.load_pem_x509_certificate(f.read(), default_backend())
+            domains = cert.extensions.get_extension_for_class(x509.SubjectAlternativeName) \
+                .value.get_values_for_type(x509.DNSName)
+            time.sleep(issue_time)
+            write_lineage(path, [name] + [d for d in domains if d != name])
+            renewed += 1
+        print('Congratulations, all renewals succeeded. {} renewed, {} skipped.'.format(renewed, len(names) - renewed))
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,73 @@
+"""
+docker-flow-proxy stand-in used by benchmarks: every request is answered 200
+and counted, certificates PUT are kept in memory.
+
+    dfp = FakeDFP(('127.0.0.1', 8080))
+    dfp.start()
+"""
+import collections
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlparse
+
+
+class FakeDFPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class FakeDFPHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        data = None
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            data = self.rfile.read(length)
+        self.server.dfp.record(self.command, url.path, parse_qs(url.query), data)
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+    do_PUT = do_GET
+
+
+class FakeDFP():
+    """
+        `calls` counts requests by "<METHOD> <path>", `certs` holds the
+        certificates PUT by name.
+    """
+
+    def __init__(self, address=('127.0.0.1', 8080)):
+        self.address = address
+        self.calls = collections.Counter()
+        self.certs = {}
+        self._lock = threading.Lock()
+        self._server = None
+
+    def record(self, method, path, query, data):
+        with self._lock:
+            self.calls['{} {}'.format(method, path)] += 1
+            if path.endswith('/cert') and data is not None:
+                self.certs[query.get('certName', [''])[0]] = data
+
+    def start(self):
+        self._server = FakeDFPServer(self.address, FakeDFPHandler)
+        self._server.dfp = self
+        thread = threading.Thread(target=self._server.serve_forever, name='fake-dfp')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
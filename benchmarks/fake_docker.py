@@ -0,0 +1,278 @@
+"""
+In-process docker engine API stand-in used by benchmarks, listening on a unix
+socket: the endpoints used by DFPLEClient (secrets, services, events) are
+served from memory and every call is counted.
+
+    engine = FakeDockerEngine('/tmp/docker.sock')
+    engine.add_service('proxy')
+    engine.start()
+    client = docker.DockerClient(base_url='unix://' + engine.socket_path, version='1.25')
+"""
+import base64
+import collections
+import datetime
+import json
+import os
+import re
+import threading
+import time
+import uuid
+
+try:
+    from http.server import BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn, UnixStreamServer
+    from urllib.parse import parse_qs, urlparse
+    import queue
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+    from urlparse import parse_qs, urlparse
+    import Queue as queue
+
+
+API_VERSION_RE = re.compile(r'^/v[\d.]+')
+
+def now():
+    return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+class NotFound(Exception):
+    pass
+
+class OutOfSequence(Exception):
+    pass
+
+
+class FakeDockerServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+class FakeDockerHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def address_string(self):
+        return self.server.server_address
+
+    def send_json(self, status, data=None):
+        body = json.dumps(data).encode('utf-8') if data is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def handle_call(self, method):
+        engine = self.server.engine
+        url = urlparse(self.path)
+        path = API_VERSION_RE.sub('', url.path)
+        params = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+        body = None
+        if method == 'POST':
+            length = int(self.headers.get('Content-Length') or 0)
+            body = json.loads(self.rfile.read(length).decode('utf-8')) if length else None
+
+        if path == '/events':
+            engine.count(method, path)
+            return self.stream_events(engine)
+        try:
+            status, data = engine.call(method, path, params, body)
+        except NotFound as e:
+            status, data = 404, {'message': str(e)}
+        except OutOfSequence as e:
+            status, data = 500, {'message': str(e)}
+        self.send_json(status, data)
+
+    def stream_events(self, engine):
+        events = engine.subscribe()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            while True:
+                event = events.get()
+                if event is None:
+                    self.wfile.write(b'0\r\n\r\n')
+                    return
+                data = json.dumps(event).encode('utf-8') + b'\n'
+                self.wfile.write('{:x}\r\n'.format(len(data)).encode('ascii') + data + b'\r\n')
+                self.wfile.flush()
+        except (IOError, OSError):
+            pass
+        finally:
+            engine.unsubscribe(events)
+
+    def do_GET(self):
+        self.handle_call('GET')
+
+    def do_POST(self):
+        self.handle_call('POST')
+
+    def do_DELETE(self):
+        self.handle_call('DELETE')
+
+
+class FakeDockerEngine():
+    """
+        Swarm manager holding secrets and services in memory.
+
+        `calls` counts the API calls by "<METHOD> <path>", ids replaced by
+        `{id}`. Each call is delayed by `latency` seconds, as a busy manager.
+    """
+
+    def __init__(self, socket_path, latency=0):
+        self.socket_path = socket_path
+        self.latency = latency
+        self.secrets = collections.OrderedDict()
+        self.services = collections.OrderedDict()
+        self.calls = collections.Counter()
+        self._subscribers = []
+        self._lock = threading.RLock()
+        self._server = None
+
+    def client(self):
+        import docker
+        return docker.DockerClient(base_url='unix://{}'.format(self.socket_path), version='1.25')
+
+    def start(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self._server = FakeDockerServer(self.socket_path, FakeDockerHandler)
+        self._server.engine = self
+        thread = threading.Thread(target=self._server.serve_forever, name='fake-docker')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        with self._lock:
+            for events in self._subscribers:
+                events.put(None)
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            os.remove(self.socket_path)
+
+    def count(self, method, path):
+        path = re.sub(r'^/(secrets|services)/(?!create$)[^/]+', r'/\1/{id}', path)
+        with self._lock:
+            self.calls['{} {}'.format(method, path)] += 1
+
+    def subscribe(self):
+        events = queue.Queue()
+        with self._lock:
+            self._subscribers.append(events)
+        return events
+
+    def unsubscribe(self, events):
+        with self._lock:
+            if events in self._subscribers:
+                self._subscribers.remove(events)
+
+    def emit(self, event_type, action, actor_id, name):
+        event = {
+            'Type': event_type,
+            'Action': action,
+            'Actor': {'ID': actor_id, 'Attributes': {'name': name}},
+            'time': int(time.time()),
+            'timeNano': int(time.time() * 1e9),
+        }
+        with self._lock:
+            for events in self._subscribers:
+                events.put(event)
+
+    def add_service(self, name, labels=None, secrets=None):
+        service_id = uuid.uuid4().hex[:25]
+        with self._lock:
+            self.services[service_id] = {
+                'ID': service_id,
+                'Version': {'Index': 1},
+                'CreatedAt': now(),
+                'UpdatedAt': now(),
+                'Spec': {
+                    'Name': name,
+                    'Labels': labels or {},
+                    'TaskTemplate': {'ContainerSpec': {'Image': 'fake', 'Secrets': secrets or []}},
+                },
+            }
+        self.emit('service', 'create', service_id, name)
+        return service_id
+
+    def service(self, name):
+        with self._lock:
+            for service in self.services.values():
+                if service['Spec']['Name'] == name:
+                    return service
+
+    def _find(self, objects, key):
+        # objects are looked up by id or by name, as the docker engine does.
+        for obj in objects.values():
+            if obj['ID'] == key or obj['Spec']['Name'] == key:
+                return obj
+        raise NotFound('{} not found'.format(key))
+
+    def _filter(self, objects, params):
+        names = json.loads(params.get('filters') or '{}').get('name') or []
+        if isinstance(names, dict):
+            names = list(names)
+        # the name filter matches name prefixes.
+        return [x for x in objects.values() if not names or any(x['Spec']['Name'].startswith(n) for n in names)]
+
+    def call(self, method, path, params, body):
+        """
+            :return: (status code, json data)
+        """
+        self.count(method, path)
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self._lock:
+            if path == '/_ping':
+                return 200, 'OK'
+            if path == '/version':
+                return 200, {'ApiVersion': '1.25', 'Version': 'fake'}
+
+            if path == '/secrets' and method == 'GET':
+                return 200, [self._secret_attrs(x) for x in self._filter(self.secrets, params)]
+            if path == '/secrets/create' and method == 'POST':
+                secret_id = uuid.uuid4().hex[:25]
+                self.secrets[secret_id] = {
+                    'ID': secret_id,
+                    'Version': {'Index': 1},
+                    'CreatedAt': now(),
+                    'UpdatedAt': now(),
+                    'Spec': {'Name': body['Name'], 'Labels': body.get('Labels') or {},
+                             'Data': base64.b64decode(body['Data'])},
+                }
+                self.emit('secret', 'create', secret_id, body['Name'])
+                return 201, {'ID': secret_id}
+            if path.startswith('/secrets/'):
+                secret = self._find(self.secrets, path.split('/')[2])
+                if method == 'DELETE':
+                    del self.secrets[secret['ID']]
+                    self.emit('secret', 'remove', secret['ID'], secret['Spec']['Name'])
+                    return 204, None
+                return 200, self._secret_attrs(secret)
+
+            if path == '/services' and method == 'GET':
+                return 200, self._filter(self.services, params)
+            if path.startswith('/services/'):
+                parts = path.split('/')
+                service = self._find(self.services, parts[2])
+                if len(parts) > 3 and parts[3] == 'update' and method == 'POST':
+                    if int(params.get('version', 0)) != service['Version']['Index']:
+                        raise OutOfSequence('rpc error: code = Unknown desc = update out of sequence')
+                    service['Spec'] = body
+                    service['Version']['Index'] += 1
+                    service['UpdatedAt'] = now()
+                    self.emit('service', 'update', service['ID'], service['Spec']['Name'])
+                    return 200, {}
+                return 200, service
+
+        raise NotFound('page not found: {} {}'.format(method, path))
+
+    def _secret_attrs(self, secret):
+        # the engine never returns secrets data.
+        spec = dict((k, v) for k, v in secret['Spec'].items() if k != 'Data')
+        return dict(secret, Spec=spec)
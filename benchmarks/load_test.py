@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""
+Load test a running docker-flow-proxy-letsencrypt instance: requests are sent
+by `concurrency` threads, throughput and latency percentiles are reported for
+each scenario.
+
+  * reconfigure : service notification without letsencrypt labels, only
+                  forwarded to docker-flow-proxy.
+  * challenge   : ACME http-01 challenge request for an unknown token
+                  (crawlers, validation of an already cleaned up challenge).
+
+With --fake-dfp, a docker-flow-proxy stand-in answering 200 to every request
+is started on 127.0.0.1:8080 (run the instance with
+DF_PROXY_SERVICE_NAME=127.0.0.1 and another PORT).
+
+usage: python benchmarks/load_test.py --url http://127.0.0.1:8081 [--fake-dfp]
+"""
+import argparse
+import threading
+import time
+import requests
+
+from fake_dfp import FakeDFP
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+def run(url, status, requests_count, concurrency):
+    """
+    :return: (duration, latencies, errors)
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    counter = iter(range(requests_count))
+
+    def worker():
+        session = requests.Session()
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    return
+            start = time.time()
+            try:
+                ok = session.get(url, timeout=30).status_code == status
+            except Exception:
+                ok = False
+            latency = time.time() - start
+            with lock:
+                latencies.append(latency)
+                if not ok:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.time() - start, latencies, errors[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n\n')[0])
+    parser.add_argument('--url', default='http://127.0.0.1:8080')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--scenarios', default='reconfigure,challenge')
+    parser.add_argument('--fake-dfp', action='store_true')
+    options = parser.parse_args()
+
+    if options.fake_dfp:
+        FakeDFP(('127.0.0.1', 8080)).start()
+
+    # path and expected status by scenario
+    scenarios = {
+        'reconfigure': ('/v1/docker-flow-proxy-letsencrypt/reconfigure?serviceName=load-test&servicePath=/&port=80', 200),
+        'challenge': ('/.well-known/acme-challenge/load-test-token', 404),
+    }
+
+    print('{:>12} {:>8} {:>8} {:>10} {:>9} {:>9}'.format('scenario', 'requests', 'errors', 'req/s', 'p50 (ms)', 'p99 (ms)'))
+    for name in options.scenarios.split(','):
+        path, status = scenarios[name]
+        duration, latencies, errors = run(options.url + path, status, options.requests, options.concurrency)
+        print('{:>12} {:>8} {:>8} {:>10.1f} {:>9.1f} {:>9.1f}'.format(
+            name, len(latencies), errors, len(latencies) / duration,
+            percentile(latencies, 50) * 1000, percentile(latencies, 99) * 1000))
@@ -1,8 +1,12 @@
 #!/bin/sh
 
-# crond configuration
-echo "${LETSENCRYPT_RENEWAL_CRON} curl http://${DF_SWARM_LISTENER_SERVICE_NAME}:8080/v1/docker-flow-swarm-listener/notify-services" >> /etc/crontabs/root
+# crond configuration, certificates are renewed by the API renewal scheduler
+# unless LETSENCRYPT_RENEWAL_CRON is set.
+# renew all certificates due for renewal using a single certbot run.
+if [ -n "${LETSENCRYPT_RENEWAL_CRON}" ]; then
+    echo "${LETSENCRYPT_RENEWAL_CRON} curl http://localhost:${PORT:-8080}/v1/docker-flow-proxy-letsencrypt/renew" >> /etc/crontabs/root
 
-crond -L /var/log/crond.log && tail -f /var/log/crond.log &
+    crond -L /var/log/crond.log && tail -f /var/log/crond.log &
+fi
 
 exec "$@"
\ No newline at end of file